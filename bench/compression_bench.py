@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# desc: 响应体编码模式的CPU开销: 解压转发/原样转发/代理gzip/代理br, 输出每MB响应内容的代理CPU时间
+#   python bench/compression_bench.py [--engines requests uvicorn] [--modes decode passthrough gzip br]
+#                                     [--size 262144] [--duration 10] [--out result.json]
+import argparse
+import concurrent.futures
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import load_bench
+from load_bench import BENCH_DIR
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 模式: 代理配置, 上游是否返回gzip
+MODES = {
+    # 上游gzip, 代理解压后转发(原实现)
+    'decode': {'compression': {'mode': 'decode'}, 'gzip': True},
+    # 上游gzip, 代理原样转发
+    'passthrough': {'compression': {'mode': 'passthrough'}, 'gzip': True},
+    # 上游未压缩, 代理原样转发(基线)
+    'identity': {'compression': {'mode': 'passthrough'}, 'gzip': False},
+    # 上游未压缩, 代理压缩
+    'gzip': {'compression': {'mode': 'passthrough', 'encodings': ['gzip']}, 'gzip': False},
+    'br': {'compression': {'mode': 'passthrough', 'encodings': ['br']}, 'gzip': False},
+}
+# 只有requests引擎支持decode模式
+DECODE_ENGINES = {'requests'}
+
+
+def write_config(path: str, upstream_port: int, log_level: str, compression: dict):
+    load_bench.write_config(path, upstream_port, log_level, False)
+    lines = ['    compression:']
+    lines += [f'      {key}: {json.dumps(value)}' for key, value in compression.items()]
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def skip_reason(engine: str, mode: str):
+    if mode == 'decode' and engine not in DECODE_ENGINES:
+        return 'engine always passes encoded bodies through'
+    if mode == 'br' and brotli is None:
+        return 'brotli not installed'
+    return None
+
+
+def run_case(engine: str, mode: str, args, workdir: str, upstream_port: int) -> dict:
+    spec = MODES[mode]
+    config = os.path.join(workdir, f'{engine}-{mode}.yaml')
+    write_config(config, upstream_port, args.log_level, spec['compression'])
+    port = load_bench.free_port()
+    proc = load_bench.spawn(['serve', '--engine', engine, '--port', str(port), '--config', config,
+                             '--timeout', str(args.timeout)], workdir, os.path.join(workdir, f'{engine}.log'))
+    query = f'size={args.size}&type=text' + ('&gzip=1' if spec['gzip'] else '')
+    try:
+        load_bench.wait_port(port, proc)
+        clients = max(1, min(args.clients, args.concurrency))
+        specs = [{
+            'engine': engine, 'proxy_port': port, 'upstream_port': upstream_port, 'socks': False,
+            'method': 'GET', 'body': 0, 'headers': ['Accept-Encoding: gzip, br'],
+            'targets': [(f'/bench/{i}?{query}', f'127.0.0.1:{upstream_port}') for i in range(100)],
+            'concurrency': args.concurrency // clients + (1 if i < args.concurrency % clients else 0),
+            'idle': 0, 'warmup': args.warmup, 'duration': args.duration, 'timeout': args.timeout, 'seed': i,
+        } for i in range(clients)]
+        cpu_start = load_bench.cpu_seconds(proc.pid)
+        with concurrent.futures.ProcessPoolExecutor(clients) as pool:
+            results = list(pool.map(load_bench.run_load, specs))
+        cpu_end = load_bench.cpu_seconds(proc.pid)
+    finally:
+        load_bench.stop(proc)
+    requests = sum(len(r['latencies']) for r in results)
+    wire_mb = sum(r['bytes'] for r in results) / 1048576
+    content_mb = requests * args.size / 1048576
+    # 只统计计时阶段的请求, CPU时间按比例扣除预热
+    cpu = None
+    if cpu_start is not None and cpu_end is not None:
+        cpu = (cpu_end - cpu_start) * args.duration / (args.duration + args.warmup)
+    return {
+        'engine': engine,
+        'mode': mode,
+        'requests': requests,
+        'errors': sum(r['errors'] for r in results),
+        'rps': requests / args.duration,
+        'content_mb': content_mb,
+        'wire_mb': wire_mb,
+        'wire_ratio': wire_mb / content_mb if content_mb else None,
+        'cpu_s': cpu,
+        'cpu_ms_per_mb': cpu * 1000 / content_mb if cpu is not None and content_mb else None,
+    }
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='caul-bench-')
+    upstream_port = load_bench.free_port()
+    upstream = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'upstream.py'), '--port', str(upstream_port)],
+                                cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    results = []
+    try:
+        load_bench.wait_port(upstream_port, upstream)
+        for engine in args.engines:
+            for mode in args.modes:
+                reason = skip_reason(engine, mode)
+                if reason:
+                    results.append({'engine': engine, 'mode': mode, 'skipped': reason})
+                    continue
+                try:
+                    row = run_case(engine, mode, args, workdir, upstream_port)
+                except Exception as e:
+                    row = {'engine': engine, 'mode': mode, 'failed': str(e) or e.__class__.__name__}
+                    print(f'{engine:<9} {mode:<12} failed: {row["failed"]}', file=sys.stderr)
+                else:
+                    print(f"{engine:<9} {mode:<12} rps={row['rps']:8.1f} content={row['content_mb']:8.1f}MB "
+                          f"wire={row['wire_ratio'] or 0:5.2f}x cpu={row['cpu_ms_per_mb'] or 0:7.2f}ms/MB "
+                          f"errors={row['errors']}", file=sys.stderr)
+                results.append(row)
+    finally:
+        load_bench.stop(upstream)
+    output = json.dumps({'size': args.size, 'duration': args.duration, 'results': results}, indent=2)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(output)
+    print(output)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engines', nargs='+', choices=['requests', 'uvicorn'], default=['requests', 'uvicorn'])
+    parser.add_argument('--modes', nargs='+', choices=list(MODES), default=list(MODES))
+    parser.add_argument('--size', type=int, default=262144, help='响应内容大小(未压缩)')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=1)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--clients', type=int, default=max(1, min(4, (os.cpu_count() or 2) // 2)),
+                        help='压测进程数')
+    parser.add_argument('--timeout', type=int, default=10)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--out', default=None)
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
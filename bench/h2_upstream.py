@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+# desc: HTTP/2上游的本机替身: TLS(自签名证书)按--alpn协商h2或http/1.1, 需要安装h2
+#   python bench/h2_upstream.py --port 18443 --cert cert.pem --key key.pem [--alpn h2,http/1.1] [--max-streams 0]
+#                               [--settings-delay 0]
+#   GET  /any/path?size=1024&delay=20 -> 响应头x-proto/x-resumed(TLS会话是否恢复)/x-peak(峰值并发流数)
+#   GET  /any/path?reset=1            -> RST_STREAM(INTERNAL_ERROR), 不发送响应头
+#   GET  /any/path?refuse=key         -> 每个key第一次RST_STREAM(REFUSED_STREAM), 之后正常响应; always时总是拒绝
+#   POST /any/path                    -> 返回收到的字节数(http/1.1只支持Content-Length)
+import argparse
+import asyncio
+import ssl
+import urllib.parse
+
+import h2.config
+import h2.connection
+import h2.errors
+import h2.events
+import h2.settings
+
+MAX_SIZE = 64 * 1024 * 1024
+
+
+class Stats:
+    """所有连接的并发流数"""
+
+    def __init__(self):
+        self.active = 0
+        self.peak = 0
+        # 已拒绝过的refuse参数
+        self.refused = set()
+
+    def enter(self):
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+
+    def leave(self):
+        self.active -= 1
+
+
+class H2Upstream(asyncio.Protocol):
+
+    def __init__(self, stats: Stats, max_streams: int, settings_delay: float = 0):
+        self.stats = stats
+        self.max_streams = max_streams
+        self.settings_delay = settings_delay
+        self.transport = None
+        self.conn = None
+        # 延迟发送SETTINGS期间收到的数据
+        self.pending = None
+        self.resumed = False
+        self.buffer = b''
+        # stream_id -> (headers, 请求体字节数)
+        self.requests = {}
+        self.windows = {}
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        ssl_object = transport.get_extra_info('ssl_object')
+        self.resumed = bool(ssl_object and ssl_object.session_reused)
+        if ssl_object and ssl_object.selected_alpn_protocol() == 'h2':
+            self.conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False,
+                                                                             header_encoding='utf-8'))
+            if self.max_streams:
+                self.conn.local_settings = h2.settings.Settings(client=False, initial_values={
+                    h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: self.max_streams})
+            if self.settings_delay:
+                self.pending = bytearray()
+                asyncio.get_running_loop().call_later(self.settings_delay / 1000, self.initiate)
+            else:
+                self.initiate()
+
+    def initiate(self):
+        """发送SETTINGS, 之后处理期间收到的数据"""
+        if self.transport.is_closing():
+            return
+        self.conn.initiate_connection()
+        self.flush()
+        pending, self.pending = self.pending, None
+        pending and self.data_received(bytes(pending))
+
+    def flush(self):
+        data = self.conn.data_to_send()
+        if data and not self.transport.is_closing():
+            self.transport.write(data)
+
+    def data_received(self, data: bytes):
+        if self.conn is None:
+            self.http1(data)
+            return
+        if self.pending is not None:
+            self.pending += data
+            return
+        for event in self.conn.receive_data(data):
+            if isinstance(event, h2.events.RequestReceived):
+                self.requests[event.stream_id] = [dict(event.headers), 0]
+            elif isinstance(event, h2.events.DataReceived):
+                self.requests[event.stream_id][1] += len(event.data)
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+            elif isinstance(event, h2.events.StreamEnded):
+                asyncio.ensure_future(self.respond(event.stream_id))
+            elif isinstance(event, h2.events.StreamReset):
+                self.requests.pop(event.stream_id, None)
+            elif isinstance(event, (h2.events.WindowUpdated, h2.events.RemoteSettingsChanged)):
+                for waiter in self.windows.values():
+                    waiter.set()
+        self.flush()
+
+    async def respond(self, stream_id: int):
+        headers, received = self.requests[stream_id]
+        query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(headers.get(':path', '/')).query))
+        refuse = query.get('refuse')
+        if refuse and (refuse == 'always' or refuse not in self.stats.refused):
+            self.stats.refused.add(refuse)
+            self.conn.reset_stream(stream_id, h2.errors.ErrorCodes.REFUSED_STREAM)
+            self.flush()
+            return
+        if query.get('reset'):
+            self.conn.reset_stream(stream_id, h2.errors.ErrorCodes.INTERNAL_ERROR)
+            self.flush()
+            return
+        self.stats.enter()
+        try:
+            delay = float(query.get('delay', 0))
+            delay and await asyncio.sleep(delay / 1000)
+            if stream_id not in self.requests:
+                return
+            if headers.get(':method') in ('POST', 'PUT'):
+                body = b'received %d' % received
+            else:
+                body = b'x' * min(int(query.get('size', 1024)), MAX_SIZE)
+            self.conn.send_headers(stream_id, [
+                (':status', '200'), ('content-length', str(len(body))), ('x-proto', 'h2'),
+                ('x-resumed', str(int(self.resumed))), ('x-peak', str(self.stats.peak))])
+            await self.send_data(stream_id, body)
+        finally:
+            self.stats.leave()
+            self.requests.pop(stream_id, None)
+
+    async def send_data(self, stream_id: int, body: bytes):
+        view = memoryview(body)
+        while view:
+            if stream_id not in self.requests or self.transport.is_closing():
+                return
+            size = min(len(view), self.conn.local_flow_control_window(stream_id), self.conn.max_outbound_frame_size)
+            if size <= 0:
+                waiter = self.windows[stream_id] = asyncio.Event()
+                await waiter.wait()
+                self.windows.pop(stream_id, None)
+                continue
+            self.conn.send_data(stream_id, view[:size].tobytes())
+            view = view[size:]
+            self.flush()
+        self.conn.end_stream(stream_id)
+        self.flush()
+
+    def http1(self, data: bytes):
+        """ALPN协商为http/1.1: 请求体只支持Content-Length"""
+        self.buffer += data
+        while b'\r\n\r\n' in self.buffer:
+            head, rest = self.buffer.split(b'\r\n\r\n', 1)
+            lines = head.decode('latin-1').split('\r\n')
+            fields = dict(line.split(':', 1) for line in lines[1:] if ':' in line)
+            length = int({k.strip().lower(): v.strip() for k, v in fields.items()}.get('content-length', 0))
+            if len(rest) < length:
+                return
+            self.buffer = rest[length:]
+            method, target = lines[0].split(' ')[:2]
+            query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(target).query))
+            if method in ('POST', 'PUT'):
+                body = b'received %d' % length
+            else:
+                body = b'x' * min(int(query.get('size', 1024)), MAX_SIZE)
+            self.transport.write(b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\nX-Proto: http/1.1\r\n'
+                                 b'X-Resumed: %d\r\n\r\n' % (len(body), self.resumed) + body)
+
+    def connection_lost(self, exc):
+        for waiter in self.windows.values():
+            waiter.set()
+
+
+async def serve(args):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(args.cert, args.key)
+    context.set_alpn_protocols(args.alpn.split(','))
+    stats = Stats()
+    server = await asyncio.get_running_loop().create_server(lambda: H2Upstream(stats, args.max_streams,
+                                                                               args.settings_delay),
+                                                            host='127.0.0.1', port=args.port, ssl=context)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=18443)
+    parser.add_argument('--cert', required=True)
+    parser.add_argument('--key', required=True)
+    parser.add_argument('--alpn', default='h2,http/1.1')
+    # SETTINGS_MAX_CONCURRENT_STREAMS, 0为不限制
+    parser.add_argument('--max-streams', type=int, default=0)
+    # 新连接延迟多久(毫秒)发送SETTINGS, 模拟客户端在收到SETTINGS前发出多个请求
+    parser.add_argument('--settings-delay', type=float, default=0)
+    asyncio.run(serve(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
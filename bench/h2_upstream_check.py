@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+# desc: HTTP/2上游连接池的本机检查: 启动自签名证书的h2替身(bench/h2_upstream.py), 检查ALPN协商/HTTP/1.1回退,
+#   并发流数限制(含新连接收到SETTINGS之前的突发), 流被重置后连接可继续使用, 被拒绝的流重试/回退HTTP/1.1,
+#   TLS会话恢复, 以及requests/uvicorn引擎通过pool.http2转发
+#   python bench/h2_upstream_check.py [--engines requests uvicorn] [--out result.json]
+#   需要安装h2和openssl命令行
+import argparse
+import concurrent.futures
+import http.client
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import load_bench
+from load_bench import BENCH_DIR, SRC_DIR
+
+# 客户端每个连接的并发流数; 替身通过SETTINGS限制的并发流数
+LOCAL_STREAMS = 4
+REMOTE_STREAMS = 2
+# 限制并发流数的替身延迟发送SETTINGS(毫秒)
+SETTINGS_DELAY = 200
+# 经代理上传的请求体大小
+UPLOAD_SIZE = 4 * 1024 * 1024
+
+
+def make_cert(workdir: str) -> tuple:
+    """
+    生成localhost/127.0.0.1的自签名证书
+    :param workdir:
+    :return: (证书, 私钥)
+    """
+    openssl = shutil.which('openssl')
+    if openssl is None:
+        raise RuntimeError('openssl Not Found')
+    cert, key = os.path.join(workdir, 'cert.pem'), os.path.join(workdir, 'key.pem')
+    subprocess.run([openssl, 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1', '-subj', '/CN=localhost',
+                    '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1', '-keyout', key, '-out', cert],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+
+def start_upstream(workdir: str, cert: str, key: str, alpn: str, max_streams: int = 0,
+                   settings_delay: int = 0) -> tuple:
+    port = load_bench.free_port()
+    proc = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'h2_upstream.py'), '--port', str(port),
+                             '--cert', cert, '--key', key, '--alpn', alpn, '--max-streams', str(max_streams),
+                             '--settings-delay', str(settings_delay)],
+                            cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    load_bench.wait_port(port, proc)
+    return port, proc
+
+
+# ############################################################################
+# -----------------------------------pool-------------------------------------
+# ############################################################################
+
+def check_pool(cert: str, ports: dict) -> list:
+    """
+    在本进程中通过upstream.sessions(H2Adapter)请求替身
+    :param cert: 替身的证书, 作为pool.http2.ca_file
+    :param ports: alpn/h1/limited替身的端口
+    :return: 检查结果
+    """
+    sys.path.insert(0, SRC_DIR)
+    from caul_proxy import http2, upstream
+    from caul_proxy.config import Pool
+    upstream.sessions.configure(Pool(idle_timeout=1, http2={
+        'enabled': True, 'max_connections': 1, 'max_streams': LOCAL_STREAMS, 'ca_file': cert}))
+
+    def get(port: int, query: str = '') -> tuple:
+        with upstream.sessions.request('GET', f'https://localhost:{port}/check?{query}', timeout=10) as response:
+            body = response.content
+            return response.raw.version, response.headers, len(body)
+
+    def concurrent_get(port: int, count: int) -> list:
+        with concurrent.futures.ThreadPoolExecutor(count) as executor:
+            return list(executor.map(lambda _: get(port, 'delay=200&size=100'), range(count)))
+
+    results = []
+    version, headers, size = get(ports['alpn'], 'size=100000')
+    results.append(result('alpn_h2', version == 20 and headers.get('x-proto') == 'h2' and size == 100000,
+                          version=version, size=size))
+    version, headers, _ = get(ports['h1'])
+    results.append(result('alpn_fallback', version == 11 and headers.get('x-proto') == 'http/1.1'
+                          and http2.pool.stats()['http1_origins'] == 1, version=version))
+    # 并发流数: 不超过配置的max_streams, 也不超过上游SETTINGS的限制
+    for name, port, limit in (('stream_limit_local', ports['alpn'], LOCAL_STREAMS),
+                              ('stream_limit_remote', ports['limited'], REMOTE_STREAMS)):
+        start = time.monotonic()
+        responses = concurrent_get(port, limit * 3)
+        peak = max(int(headers.get('x-peak', 0)) for _, headers, _ in responses)
+        results.append(result(name, peak <= limit and all(v == 20 for v, _, _ in responses), peak=peak,
+                              limit=limit, seconds=round(time.monotonic() - start, 2)))
+    # 被拒绝的流: 重试成功仍使用HTTP/2; 总是被拒绝时回退到HTTP/1.1
+    version, headers, _ = get(ports['alpn'], 'refuse=once')
+    results.append(result('stream_refused_retry', version == 20 and headers.get('x-proto') == 'h2', version=version))
+    version, headers, _ = get(ports['alpn'], 'refuse=always')
+    results.append(result('stream_refused_http1', version == 11 and headers.get('x-proto') == 'http/1.1',
+                          version=version))
+    # 流被重置(未收到响应头)后释放并发数, 之后的请求不受影响
+    refused = 0
+    for _ in range(LOCAL_STREAMS * 2):
+        try:
+            get(ports['alpn'], 'reset=1')
+        except OSError:
+            refused += 1
+    version, _, _ = get(ports['alpn'])
+    streams = http2.pool.stats()['streams']
+    results.append(result('stream_reset', refused == LOCAL_STREAMS * 2 and version == 20 and streams == 0,
+                          refused=refused, open_streams=streams))
+    # 空闲连接关闭后重新连接, 恢复TLS会话
+    time.sleep(2.5)
+    version, headers, _ = get(ports['alpn'])
+    results.append(result('tls_resumption', version == 20 and headers.get('x-resumed') == '1',
+                          resumed=headers.get('x-resumed')))
+    upstream.sessions.close()
+    return results
+
+
+# ############################################################################
+# -----------------------------------engine-----------------------------------
+# ############################################################################
+
+def check_engine(engine: str, workdir: str, cert: str, ports: dict, args) -> list:
+    """
+    代理引擎转发绝对URL的HTTPS请求: h2替身使用HTTP/2, 只支持http/1.1的替身回退
+    """
+    config = os.path.join(workdir, f'{engine}.yaml')
+    with open(config, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(['caul:', '  proxy:', f'    log_level: {args.log_level}', '    reload_interval: 0',
+                           '    pool:', '      http2:', '        enabled: true', f'        ca_file: {cert}']) + '\n')
+    port = load_bench.free_port()
+    proc = load_bench.spawn(['serve', '--engine', engine, '--port', str(port), '--config', config,
+                             '--timeout', str(args.timeout)], workdir, os.path.join(workdir, f'{engine}.log'))
+    results = []
+    try:
+        load_bench.wait_port(port, proc)
+        # (检查名, 替身, 方法, 查询参数, 期望的协议): GET响应1000字节, POST返回收到的字节数
+        # 被拒绝的流: 重试后仍使用HTTP/2, 总是被拒绝时回退到HTTP/1.1
+        for name, upstream, method, query, proto in (
+                ('proxy_h2', 'alpn', 'GET', 'size=1000', 'h2'),
+                ('proxy_fallback', 'h1', 'GET', 'size=1000', 'http/1.1'),
+                ('proxy_h2_upload', 'alpn', 'POST', '', 'h2'),
+                ('proxy_fallback_upload', 'h1', 'POST', '', 'http/1.1'),
+                ('proxy_refused_retry', 'alpn', 'GET', f'size=1000&refuse={engine}', 'h2'),
+                ('proxy_refused_http1', 'alpn', 'GET', 'size=1000&refuse=always', 'http/1.1')):
+            body = b'u' * UPLOAD_SIZE if method == 'POST' else None
+            expected = b'received %d' % UPLOAD_SIZE if body else b'x' * 1000
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=args.timeout)
+            try:
+                conn.request(method, f'https://localhost:{ports[upstream]}/check?{query}', body=body)
+                response = conn.getresponse()
+                content = response.read()
+                ok = response.status == 200 and response.getheader('x-proto') == proto and content == expected
+                results.append(result(f'{engine}:{name}', ok, status=response.status,
+                                      proto=response.getheader('x-proto'), size=len(content)))
+            finally:
+                conn.close()
+    finally:
+        load_bench.stop(proc)
+    return results
+
+
+def result(name: str, ok: bool, **detail) -> dict:
+    print(f"{name:<30} {'ok' if ok else 'FAILED'} {detail}", file=sys.stderr)
+    return {'check': name, 'ok': bool(ok), **detail}
+
+
+def run(args) -> bool:
+    workdir = tempfile.mkdtemp(prefix='caul-h2-')
+    cert, key = make_cert(workdir)
+    upstreams = {}
+    try:
+        # limited: 延迟发送SETTINGS, 第一批并发请求在收到限制之前发出
+        for name, alpn, max_streams, delay in (('alpn', 'h2,http/1.1', 0, 0), ('h1', 'http/1.1', 0, 0),
+                                               ('limited', 'h2,http/1.1', REMOTE_STREAMS, SETTINGS_DELAY)):
+            upstreams[name] = start_upstream(workdir, cert, key, alpn, max_streams, delay)
+        ports = {name: port for name, (port, _) in upstreams.items()}
+        results = check_pool(cert, ports)
+        for engine in args.engines:
+            results.extend(check_engine(engine, workdir, cert, ports, args))
+    finally:
+        for _, proc in upstreams.values():
+            load_bench.stop(proc)
+    output = json.dumps({'results': results}, indent=2)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(output)
+    print(output)
+    return all(r['ok'] for r in results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--engines', nargs='*', choices=['requests', 'uvicorn'], default=['requests', 'uvicorn'])
+    parser.add_argument('--timeout', type=int, default=10)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--out', default=None)
+    sys.exit(0 if run(parser.parse_args()) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,438 @@
+# -*- coding: utf-8 -*-
+# desc: 各引擎的本机压测: 启动上游和代理子进程, 多进程并发压测, 输出JSON
+#   python bench/load_bench.py [--engines requests socks5_async] [--scenarios small_get upload]
+#                              [--duration 10] [--concurrency 50] [--clients 2] [--out result.json]
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(BENCH_DIR, '..', 'src')
+
+ENGINES = ['requests', 'socket', 'socks5', 'socks5_async', 'uvicorn']
+SOCKS_ENGINES = {'socks5', 'socks5_async'}
+# 支持CONNECT隧道的HTTP引擎
+TUNNEL_ENGINES = {'requests'}
+# 只有HTTP代理引擎会执行改写规则
+REWRITE_ENGINES = {'requests', 'uvicorn'}
+# 只转发GET请求的引擎
+GET_ONLY_ENGINES = {'socket'}
+
+# 场景: 请求方法, 响应大小, 请求体大小, 默认并发, 请求体是否chunked(每块UPLOAD_CHUNK字节)
+SCENARIOS = {
+    'small_get': {'method': 'GET', 'size': 1024, 'body': 0, 'concurrency': None},
+    'large_download': {'method': 'GET', 'size': 16 * 1024 * 1024, 'body': 0, 'concurrency': 4},
+    'upload': {'method': 'POST', 'size': 0, 'body': 4 * 1024 * 1024, 'concurrency': 8},
+    # 大请求体: 对比peak_rss_mb检查代理是否整体缓存在内存中
+    'large_upload': {'method': 'POST', 'size': 0, 'body': 128 * 1024 * 1024, 'concurrency': 2, 'chunked': True},
+    'idle_connections': {'method': 'GET', 'size': 1024, 'body': 0, 'concurrency': 4},
+    'rewrite_heavy': {'method': 'GET', 'size': 1024, 'body': 0, 'concurrency': None},
+}
+REWRITE_RULES = 1000
+UPLOAD_CHUNK = 1048576
+
+
+# ############################################################################
+# -----------------------------------load-------------------------------------
+# ############################################################################
+
+def build_request(spec: dict, path: str, host: str) -> bytes:
+    """
+    HTTP代理使用绝对URL, socks5隧道内使用路径
+    :param spec:
+    :param path:
+    :param host:
+    :return:
+    """
+    target = path if spec['socks'] else f'http://{host}{path}'
+    lines = [f"{spec['method']} {target} HTTP/1.1", f'Host: {host}', 'Connection: close']
+    if spec['body'] and spec.get('chunked'):
+        lines.append('Transfer-Encoding: chunked')
+    elif spec['body']:
+        lines.append(f"Content-Length: {spec['body']}")
+    lines.extend(spec.get('headers') or ())
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+
+async def socks5_connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, port: int):
+    writer.write(b'\x05\x01\x00')
+    await reader.readexactly(2)
+    writer.write(struct.pack('!BBBB4sH', 5, 1, 0, 1, socket.inet_aton('127.0.0.1'), port))
+    reply = await reader.readexactly(10)
+    if reply[1] != 0:
+        raise ConnectionError(f'SOCKS5 Reply {reply[1]}')
+
+
+async def http_connect(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, port: int):
+    writer.write(f'CONNECT 127.0.0.1:{port} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n\r\n'.encode('latin-1'))
+    head = await reader.readuntil(b'\r\n\r\n')
+    if b' 200 ' not in head.split(b'\r\n', 1)[0]:
+        raise ConnectionError(head.split(b'\r\n', 1)[0].decode('latin-1'))
+
+
+async def one_request(spec: dict, body: bytes) -> tuple:
+    """
+    发送一个请求并读取到连接关闭
+    :return: (状态码, 收到的字节数)
+    """
+    reader, writer = await asyncio.open_connection('127.0.0.1', spec['proxy_port'], limit=1048576)
+    try:
+        if spec['socks']:
+            await socks5_connect(reader, writer, spec['upstream_port'])
+        path, host = random.choice(spec['targets'])
+        writer.write(build_request(spec, path, host))
+        if body and spec.get('chunked'):
+            view = memoryview(body)
+            for offset in range(0, len(body), UPLOAD_CHUNK):
+                chunk = view[offset:offset + UPLOAD_CHUNK]
+                writer.write(b'%x\r\n' % len(chunk))
+                writer.write(chunk)
+                writer.write(b'\r\n')
+                await writer.drain()
+            writer.write(b'0\r\n\r\n')
+        elif body:
+            writer.write(body)
+        await writer.drain()
+        head = await reader.readuntil(b'\r\n\r\n')
+        status = int(head.split(b' ', 2)[1])
+        received = len(head)
+        while True:
+            data = await reader.read(1048576)
+            if not data:
+                break
+            received += len(data)
+        return status, received
+    finally:
+        writer.close()
+
+
+async def worker(spec: dict, result: dict, measure_from: float, deadline: float):
+    body = b'x' * spec['body']
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            status, received = await asyncio.wait_for(one_request(spec, body), spec['timeout'])
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ValueError, IndexError):
+            if time.monotonic() >= measure_from:
+                result['errors'] += 1
+            await asyncio.sleep(0.01)
+            continue
+        if start < measure_from:
+            continue
+        result['latencies'].append(time.monotonic() - start)
+        result['bytes'] += received + len(body)
+        result['statuses'][str(status)] = result['statuses'].get(str(status), 0) + 1
+
+
+async def hold_idle(spec: dict, count: int, ready: asyncio.Event, done: asyncio.Event, result: dict):
+    """
+    建立空闲连接: socks5/CONNECT隧道, 其他引擎为未发送请求的TCP连接
+    """
+    conns = []
+    for _ in range(count):
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', spec['proxy_port'])
+            if spec['socks']:
+                await socks5_connect(reader, writer, spec['upstream_port'])
+            elif spec['engine'] in TUNNEL_ENGINES:
+                await http_connect(reader, writer, spec['upstream_port'])
+            conns.append((reader, writer))
+        except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            result['idle_failed'] += 1
+    result['idle_opened'] = len(conns)
+    ready.set()
+    await done.wait()
+    result['idle_alive'] = sum(1 for reader, _ in conns if not reader.at_eof())
+    for _, writer in conns:
+        writer.close()
+
+
+async def run_load_async(spec: dict) -> dict:
+    result = {'latencies': [], 'bytes': 0, 'errors': 0, 'statuses': {}, 'idle_opened': 0, 'idle_alive': 0,
+              'idle_failed': 0}
+    idle_task = None
+    if spec['idle']:
+        ready, done = asyncio.Event(), asyncio.Event()
+        idle_task = asyncio.ensure_future(hold_idle(spec, spec['idle'], ready, done, result))
+        await ready.wait()
+    now = time.monotonic()
+    measure_from = now + spec['warmup']
+    deadline = measure_from + spec['duration']
+    await asyncio.gather(*(worker(spec, result, measure_from, deadline) for _ in range(spec['concurrency'])))
+    if idle_task is not None:
+        done.set()
+        await idle_task
+    return result
+
+
+def run_load(spec: dict) -> dict:
+    """压测子进程入口"""
+    random.seed(spec['seed'])
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    return asyncio.run(run_load_async(spec))
+
+
+# ############################################################################
+# -----------------------------------process----------------------------------
+# ############################################################################
+
+def serve_engine(engine: str, port: int, config: str, timeout: int):
+    """
+    代理子进程入口, 与main.main的启动步骤一致
+    """
+    sys.path.insert(0, SRC_DIR)
+    from caul_proxy import acl, ratelimit, shaping
+    from caul_proxy.config import settings
+    from caul_proxy.plugins import runner
+    from caul_proxy.resolver import dns
+    import importlib
+    settings.load_yaml(config)
+    acl.load(settings)
+    ratelimit.load(settings)
+    dns.configure(settings.dns)
+    shaping.shaper.configure(settings.shaping)
+    runner.load_plugins(settings)
+    importlib.import_module(f'caul_proxy.server_{engine}').start_server(ip='127.0.0.1', port=port, timeout=timeout)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_port(port: int, proc: subprocess.Popen, timeout: float = 15):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'Process Exited: {proc.args}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f'Port {port} Not Ready')
+
+
+def spawn(args: list, cwd: str, log: str) -> subprocess.Popen:
+    with open(log, 'ab') as f:
+        return subprocess.Popen([sys.executable, os.path.abspath(__file__), *args], cwd=cwd,
+                                stdout=f, stderr=subprocess.STDOUT)
+
+
+def stop(proc: subprocess.Popen):
+    proc.terminate()
+    try:
+        proc.wait(5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def cpu_seconds(pid: int) -> float:
+    """进程CPU时间(user + system), 仅Linux"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def peak_rss_mb(pid: int) -> float:
+    """进程峰值内存(VmHWM), 仅Linux"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def write_config(path: str, upstream_port: int, log_level: str, rewrite: bool):
+    """
+    生成代理配置, rewrite时生成REWRITE_RULES条域名/URI规则
+    """
+    lines = ['caul:', '  proxy:', f'    log_level: {log_level}', '    reload_interval: 0',
+             '    pool:', '      max_per_host: 256', '      max_total: 1024']
+    if rewrite:
+        lines.append('    domains:')
+        for i in range(REWRITE_RULES):
+            lines += [f"      - pattern: '(?P<sub>.*)\\.svc{i}\\.bench$'",
+                      "        replace: '127.0.0.1'", f'        port: {upstream_port}']
+        lines.append('    uris:')
+        for i in range(REWRITE_RULES):
+            lines += ['      - rewriter: RegexRewriter', f"        pattern: '/api{i}/(?P<path>.*)'",
+                      "        replace: '/v1/$path'"]
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+def targets(scenario: dict, upstream_port: int, rewrite: bool) -> list:
+    """
+    请求的(路径, Host)列表
+    """
+    query = f"size={scenario['size']}"
+    if not rewrite:
+        return [(f'/bench/{i}?{query}', f'127.0.0.1:{upstream_port}') for i in range(100)]
+    rng = random.Random(1)
+    return [(f'/api{rng.randrange(REWRITE_RULES)}/items/{i}?{query}',
+             f'app{rng.randrange(10)}.svc{rng.randrange(REWRITE_RULES)}.bench') for i in range(500)]
+
+
+def percentile_ms(values: list, p: float):
+    if not values:
+        return None
+    return values[min(int(len(values) * p), len(values) - 1)] * 1000
+
+
+def run_case(engine: str, name: str, args, workdir: str, upstream_port: int) -> dict:
+    scenario = SCENARIOS[name]
+    rewrite = name == 'rewrite_heavy'
+    config = os.path.join(workdir, f'{engine}-{name}.yaml')
+    write_config(config, upstream_port, args.log_level, rewrite)
+    port = free_port()
+    proc = spawn(['serve', '--engine', engine, '--port', str(port), '--config', config,
+                  '--timeout', str(args.timeout)], workdir, os.path.join(workdir, f'{engine}.log'))
+    try:
+        wait_port(port, proc)
+        concurrency = scenario['concurrency'] or args.concurrency
+        clients = max(1, min(args.clients, concurrency))
+        specs = [{
+            'engine': engine, 'proxy_port': port, 'upstream_port': upstream_port,
+            'socks': engine in SOCKS_ENGINES, 'method': scenario['method'], 'body': scenario['body'],
+            'chunked': scenario.get('chunked', False),
+            'targets': targets(scenario, upstream_port, rewrite),
+            'concurrency': concurrency // clients + (1 if i < concurrency % clients else 0),
+            'idle': args.idle // clients if name == 'idle_connections' else 0,
+            'warmup': args.warmup, 'duration': args.duration, 'timeout': args.timeout, 'seed': i,
+        } for i in range(clients)]
+        cpu_start = cpu_seconds(proc.pid)
+        with concurrent.futures.ProcessPoolExecutor(clients) as pool:
+            results = list(pool.map(run_load, specs))
+        cpu_end = cpu_seconds(proc.pid)
+        cpu = cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None
+        rss = peak_rss_mb(proc.pid)
+    finally:
+        stop(proc)
+    latencies = sorted(v for r in results for v in r['latencies'])
+    statuses = {}
+    for r in results:
+        for status, n in r['statuses'].items():
+            statuses[status] = statuses.get(status, 0) + n
+    total_bytes = sum(r['bytes'] for r in results)
+    row = {
+        'engine': engine,
+        'scenario': name,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': sum(r['errors'] for r in results),
+        'statuses': statuses,
+        'rps': len(latencies) / args.duration,
+        'p50_ms': percentile_ms(latencies, 0.5),
+        'p99_ms': percentile_ms(latencies, 0.99),
+        'p999_ms': percentile_ms(latencies, 0.999),
+        'mb_s': total_bytes / args.duration / 1048576,
+        # 包含预热阶段
+        'cpu_s': cpu,
+        'cpu_pct': cpu / (args.duration + args.warmup) * 100 if cpu is not None else None,
+        'peak_rss_mb': rss,
+    }
+    if name == 'idle_connections':
+        row.update(idle_opened=sum(r['idle_opened'] for r in results),
+                   idle_alive=sum(r['idle_alive'] for r in results),
+                   idle_failed=sum(r['idle_failed'] for r in results))
+    return row
+
+
+def skip_reason(engine: str, name: str):
+    if name == 'rewrite_heavy' and engine not in REWRITE_ENGINES:
+        return 'engine does not rewrite'
+    if SCENARIOS[name]['method'] != 'GET' and engine in GET_ONLY_ENGINES:
+        return 'engine only forwards GET'
+    return None
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='caul-bench-')
+    upstream_port = free_port()
+    upstream = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'upstream.py'), '--port', str(upstream_port),
+                                 '--latency-ms', str(args.latency_ms), '--chunk', str(args.chunk)],
+                                cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    results = []
+    try:
+        wait_port(upstream_port, upstream)
+        for engine in args.engines:
+            for name in args.scenarios:
+                reason = skip_reason(engine, name)
+                if reason:
+                    results.append({'engine': engine, 'scenario': name, 'skipped': reason})
+                    continue
+                try:
+                    row = run_case(engine, name, args, workdir, upstream_port)
+                except Exception as e:
+                    row = {'engine': engine, 'scenario': name, 'failed': str(e) or e.__class__.__name__}
+                    print(f'{engine:<13} {name:<17} failed: {row["failed"]}', file=sys.stderr)
+                else:
+                    print(f"{engine:<13} {name:<17} rps={row['rps']:8.1f} p50={row['p50_ms'] or 0:7.2f}ms "
+                          f"p99={row['p99_ms'] or 0:8.2f}ms {row['mb_s']:8.2f}MB/s cpu={row['cpu_pct'] or 0:5.1f}% "
+                          f"rss={row['peak_rss_mb'] or 0:6.1f}MB errors={row['errors']}", file=sys.stderr)
+                results.append(row)
+    finally:
+        stop(upstream)
+    output = json.dumps({'latency_ms': args.latency_ms, 'chunk': args.chunk, 'duration': args.duration,
+                         'results': results}, indent=2)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(output)
+    print(output)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command')
+    # 代理子进程
+    serve = commands.add_parser('serve')
+    serve.add_argument('--engine', choices=ENGINES, required=True)
+    serve.add_argument('--port', type=int, required=True)
+    serve.add_argument('--config', required=True)
+    serve.add_argument('--timeout', type=int, default=30)
+    # 压测
+    parser.add_argument('--engines', nargs='+', choices=ENGINES, default=ENGINES)
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=1)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--clients', type=int, default=max(1, min(4, (os.cpu_count() or 2) // 2)),
+                        help='压测进程数')
+    parser.add_argument('--idle', type=int, default=1000, help='idle_connections场景的空闲连接数')
+    parser.add_argument('--latency-ms', type=float, default=0, help='上游响应延迟')
+    parser.add_argument('--chunk', type=int, default=0, help='上游响应分块大小, 0为Content-Length')
+    parser.add_argument('--timeout', type=int, default=10)
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--out', default=None)
+    args = parser.parse_args()
+    if args.command == 'serve':
+        serve_engine(args.engine, args.port, args.config, args.timeout)
+    else:
+        run(args)
+
+
+if __name__ == '__main__':
+    main()
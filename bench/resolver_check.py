@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+# desc: DNS缓存的本机检查: 用可替换的getaddrinfo(Resolver(conf, getaddrinfo=...))模拟解析结果,
+#   检查TTL过期, 失败结果缓存, 并发解析合并, 无法编码的域名, IPv6/IPv4交替排列及Happy Eyeballs回退到下一个地址
+#   python bench/resolver_check.py [--out result.json]
+import argparse
+import concurrent.futures
+import json
+import socket
+import sys
+import threading
+import time
+
+from load_bench import SRC_DIR
+
+sys.path.insert(0, SRC_DIR)
+
+from caul_proxy.config import Dns  # noqa: E402
+from caul_proxy.resolver import Resolver  # noqa: E402
+
+
+class StubResolver:
+    """
+    按域名返回预设的地址或错误, 记录每个域名的调用次数
+    """
+
+    def __init__(self, answers: dict, delay: float = 0):
+        self.answers = answers
+        self.delay = delay
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, host, port, family=0, type=0, proto=0, flags=0):
+        with self._lock:
+            self.calls[host] = self.calls.get(host, 0) + 1
+        self.delay and time.sleep(self.delay)
+        answer = self.answers[host]
+        if isinstance(answer, BaseException):
+            raise answer
+        return [(family, socket.SOCK_STREAM, 6, '', (ip, port) if family == socket.AF_INET else (ip, port, 0, 0))
+                for family, ip in answer]
+
+
+def result(name: str, ok: bool, **detail) -> dict:
+    print(f"{name:<20} {'ok' if ok else 'FAILED'} {detail}", file=sys.stderr)
+    return {'check': name, 'ok': bool(ok), **detail}
+
+
+def check_ttl() -> dict:
+    stub = StubResolver({'ttl.test': [(socket.AF_INET, '192.0.2.1')]})
+    resolver = Resolver(Dns(ttl=1), getaddrinfo=stub)
+    for _ in range(5):
+        resolver.resolve('ttl.test', 80)
+    cached = stub.calls['ttl.test']
+    time.sleep(1.1)
+    resolver.resolve('ttl.test', 80)
+    return result('ttl', cached == 1 and stub.calls['ttl.test'] == 2, cached_calls=cached,
+                  expired_calls=stub.calls['ttl.test'])
+
+
+def check_negative() -> dict:
+    stub = StubResolver({'missing.test': socket.gaierror(socket.EAI_NONAME, 'Name or service not known')})
+    resolver = Resolver(Dns(negative_ttl=1), getaddrinfo=stub)
+    errors = []
+    for _ in range(3):
+        try:
+            resolver.resolve('missing.test', 80)
+        except socket.gaierror as e:
+            errors.append(e)
+    cached = stub.calls['missing.test']
+    # 每次抛出新的异常, 错误码不变
+    fresh = len({id(e) for e in errors}) == len(errors) and all(e.errno == socket.EAI_NONAME for e in errors)
+    time.sleep(1.1)
+    try:
+        resolver.resolve('missing.test', 80)
+    except socket.gaierror:
+        pass
+    return result('negative_cache', len(errors) == 3 and cached == 1 and fresh and stub.calls['missing.test'] == 2,
+                  errors=len(errors), cached_calls=cached, fresh_errors=fresh, expired_calls=stub.calls['missing.test'])
+
+
+def check_invalid_host(threads: int) -> dict:
+    """
+    标签超过63字节的域名: getaddrinfo在IDNA编码时抛出UnicodeError, 应与解析失败相同(合并/缓存/计入错误)
+    """
+    host = 'a' * 70 + '.com'
+    calls = []
+
+    def getaddrinfo(*args, **kwargs):
+        calls.append(args[0])
+        time.sleep(0.2)
+        # 编码失败, 不会发出查询
+        return socket.getaddrinfo(*args, **kwargs)
+
+    resolver = Resolver(Dns(), getaddrinfo=getaddrinfo)
+
+    def resolve(_):
+        try:
+            return resolver.resolve(host, 443)
+        except Exception as e:
+            return e
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        errors = list(executor.map(resolve, range(threads)))
+    errors.append(resolve(None))
+    failed = all(isinstance(e, socket.gaierror) and e.errno == socket.EAI_NONAME for e in errors)
+    stats = resolver.stats()['hosts'][host]['resolve']
+    return result('invalid_host', failed and len(calls) == 1 and stats['errors'] == 1, calls=len(calls),
+                  errors=sorted({type(e).__name__ for e in errors}), stat_errors=stats['errors'])
+
+
+def check_single_flight(threads: int) -> dict:
+    stub = StubResolver({'flight.test': [(socket.AF_INET, '192.0.2.2')],
+                         'flight-fail.test': socket.gaierror(socket.EAI_AGAIN, 'Temporary failure')}, delay=0.2)
+    resolver = Resolver(Dns(), getaddrinfo=stub)
+
+    def resolve(host: str):
+        try:
+            return resolver.resolve(host, 80)
+        except socket.gaierror as e:
+            return e
+
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        answers = list(executor.map(resolve, ['flight.test'] * threads))
+        failures = list(executor.map(resolve, ['flight-fail.test'] * threads))
+    ok = (stub.calls['flight.test'] == 1 and all(a == [(socket.AF_INET, ('192.0.2.2', 80))] for a in answers)
+          and stub.calls['flight-fail.test'] == 1 and all(isinstance(e, socket.gaierror) for e in failures))
+    return result('single_flight', ok, threads=threads, calls=stub.calls['flight.test'],
+                  failed_calls=stub.calls['flight-fail.test'])
+
+
+def check_order() -> dict:
+    stub = StubResolver({'dual.test': [(socket.AF_INET6, '2001:db8::1'), (socket.AF_INET6, '2001:db8::2'),
+                                       (socket.AF_INET, '192.0.2.1'), (socket.AF_INET, '192.0.2.2'),
+                                       (socket.AF_INET, '192.0.2.1')]})
+    resolver = Resolver(Dns(), getaddrinfo=stub)
+    order = [sockaddr[0] for _, sockaddr in resolver.resolve('dual.test', 443)]
+    expected = ['2001:db8::1', '192.0.2.1', '2001:db8::2', '192.0.2.2']
+    return result('interleave', order == expected, order=order)
+
+
+def check_fallback(delay: float) -> list:
+    """
+    第一个地址连接被拒绝(127.0.0.2未监听)或无响应时, 回退到下一个监听的地址
+    """
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(8)
+    port = listener.getsockname()[1]
+    results = []
+    try:
+        for name, first in (('fallback_refused', '127.0.0.2'), ('fallback_blackhole', '192.0.2.1')):
+            stub = StubResolver({'fallback.test': [(socket.AF_INET, first), (socket.AF_INET, '127.0.0.1')]})
+            resolver = Resolver(Dns(happy_eyeballs_delay=delay, connect_timeout=5), getaddrinfo=stub)
+            start = time.monotonic()
+            try:
+                sock = resolver.create_connection(('fallback.test', port))
+            except OSError as e:
+                results.append(result(name, False, error=str(e)))
+                continue
+            elapsed = time.monotonic() - start
+            peer = sock.getpeername()[0]
+            sock.close()
+            # 无响应的地址最多等待一个delay
+            results.append(result(name, peer == '127.0.0.1' and elapsed < delay + 1, peer=peer,
+                                  elapsed_ms=round(elapsed * 1000, 1)))
+    finally:
+        listener.close()
+    return results
+
+
+def run(args) -> bool:
+    results = [check_ttl(), check_negative(), check_single_flight(args.threads), check_invalid_host(args.threads),
+               check_order()]
+    results.extend(check_fallback(args.delay))
+    output = json.dumps({'results': results}, indent=2)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            f.write(output)
+    print(output)
+    return all(r['ok'] for r in results)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--delay', type=float, default=0.25, help='happy_eyeballs_delay')
+    parser.add_argument('--out', default=None)
+    sys.exit(0 if run(parser.parse_args()) else 1)
+
+
+if __name__ == '__main__':
+    main()
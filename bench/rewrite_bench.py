@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# desc: 改写规则微基准, 对比线性扫描/规则索引/索引+缓存
+#   python bench/rewrite_bench.py [--rules 10 100 1000] [--requests 20000]
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import urllib3.util  # noqa: E402
+
+from caul_proxy.config import Domain, Uri  # noqa: E402
+from caul_proxy.plugins import NS_RW_URI, CACHE_RW_DOMAIN, CACHE_RW_URI, rewriter, runner  # noqa: E402
+
+
+def make_rules(n: int):
+    domains = [Domain(pattern=rf'(?P<sub>.*)\.svc{i}\.caul$', replace=f'$sub.backend{i}.local', port=8000 + i)
+               for i in range(n)]
+    uris = [Uri(rewriter='RegexRewriter', pattern=f'/api{i}/(?P<ver>v[0-9]+)/(?P<path>.*)',
+                replace=f'/$ver/service{i}/$path') for i in range(n)]
+    return domains, uris
+
+
+def make_urls(n: int, count: int, distinct: int):
+    pool = []
+    for _ in range(distinct):
+        i = random.randrange(n)
+        host = f'app{random.randrange(100)}.svc{i}.caul' if random.random() < 0.9 else 'example.com'
+        pool.append(urllib3.util.parse_url(f'http://{host}/api{random.randrange(n)}/v1/items/{random.randrange(1000)}'))
+    return [random.choice(pool) for _ in range(count)]
+
+
+def linear(url: urllib3.util.Url):
+    """改写前的实现: 逐条正则匹配, 再search一次并逐个str.replace"""
+    base = None
+    for rw in CACHE_RW_DOMAIN:
+        if rw.rex.match(url.host):
+            res = rw.rex.search(url.host)
+            host = rw.replace
+            for k, v in res.groupdict().items():
+                host = host.replace(f'${k}', v)
+            for i in range(len(res.groups())):
+                host = host.replace(f'${i}', res.group(i + 1))
+            base = f'{url.scheme}://{host}:{rw.port}'
+            break
+    if base is None:
+        base = f'{url.scheme}://{url.host}:{url.port or 80}'
+    uri = url.request_uri
+    for rw in CACHE_RW_URI:
+        if rw.rex.match(url.request_uri):
+            res = rw.rex.search(url.request_uri)
+            uri = rw.replace
+            for k, v in res.groupdict().items():
+                uri = uri.replace(f'${k}', v)
+            for i in range(len(res.groups())):
+                uri = uri.replace(f'${i}', res.group(i + 1))
+            break
+    return base + uri
+
+
+def indexed(url: urllib3.util.Url):
+    return runner.rewrite_domain(url) + runner.rewrite_uri(url)
+
+
+def timeit(func, urls) -> float:
+    start = time.perf_counter()
+    for url in urls:
+        func(url)
+    return (time.perf_counter() - start) / len(urls) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rules', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--distinct', type=int, default=500)
+    args = parser.parse_args()
+    random.seed(1)
+    NS_RW_URI.update(RegexRewriter=rewriter.RegexRewriter)
+    results = []
+    for n in args.rules:
+        domains, uris = make_rules(n)
+        runner.init_domain_rewriter(domains)
+        runner.init_uri_rewriter(uris)
+        urls = make_urls(n, args.requests, args.distinct)
+        # 结果一致性
+        for url in urls[:1000]:
+            assert linear(url) == indexed(url), url
+        row = {'rules': n, 'linear_us': timeit(linear, urls)}
+        runner.init_cache(0)
+        row['indexed_us'] = timeit(indexed, urls)
+        runner.init_cache(10240)
+        row['cached_us'] = timeit(indexed, urls)
+        row['cache'] = runner.cache_stats()
+        results.append(row)
+        print(f"rules={n:<5} linear={row['linear_us']:8.2f}us indexed={row['indexed_us']:6.2f}us "
+              f"cached={row['cached_us']:6.2f}us", file=sys.stderr)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# desc: 压测用的上游服务, 响应大小/延迟/分块由query参数或命令行默认值控制
+#   python bench/upstream.py --port 18000 [--size 1024] [--latency-ms 0] [--chunk 0]
+#   GET  /any/path?size=1048576&delay=20&chunk=65536
+#   GET  /any/path?size=1048576&type=text[&gzip=1] -> 可压缩的JSON文本, gzip时返回预先压缩的响应体
+#   POST /any/path -> 读取请求体(Content-Length或chunked), 返回收到的字节数
+import argparse
+import asyncio
+import functools
+import gzip
+import urllib.parse
+
+MAX_SIZE = 64 * 1024 * 1024
+
+
+class Upstream:
+
+    def __init__(self, size: int = 1024, latency_ms: float = 0, chunk: int = 0):
+        self.size = size
+        self.latency_ms = latency_ms
+        self.chunk = chunk
+        self.payload = memoryview(b'x' * MAX_SIZE)
+        # 1MB重复, 超出gzip窗口(32KB), 不影响压缩率
+        self.text = memoryview(text_payload(1048576) * (MAX_SIZE // 1048576))
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                    return
+                lines = head.decode('latin-1').split('\r\n')
+                method, target, version = lines[0].split(' ', 2)
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        name, value = line.split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+                received = await self.read_body(reader, headers)
+                query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(target).query))
+                delay = float(query.get('delay', self.latency_ms))
+                if delay:
+                    await asyncio.sleep(delay / 1000)
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                if method == 'POST' or method == 'PUT':
+                    await self.respond(writer, b'received %d' % received, 0, keep_alive)
+                else:
+                    size = min(int(query.get('size', self.size)), MAX_SIZE)
+                    content_type, encoding = 'application/octet-stream', None
+                    if query.get('type') == 'text':
+                        content_type, body = 'application/json', self.text[:size]
+                        if query.get('gzip'):
+                            encoding, body = 'gzip', self.gzipped(size)
+                    else:
+                        body = self.payload[:size]
+                    body = body if method != 'HEAD' else b''
+                    await self.respond(writer, body, int(query.get('chunk', self.chunk)), keep_alive,
+                                       content_type, encoding)
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def read_body(reader: asyncio.StreamReader, headers: dict) -> int:
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            received = 0
+            while True:
+                size = int((await reader.readline()).split(b';', 1)[0].strip(), 16)
+                if not size:
+                    await reader.readline()
+                    return received
+                received += len(await reader.readexactly(size))
+                await reader.readline()
+        length = int(headers.get('content-length') or 0)
+        received = 0
+        while received < length:
+            data = await reader.read(min(length - received, 1048576))
+            if not data:
+                raise ConnectionError('Incomplete Body')
+            received += len(data)
+        return received
+
+    @functools.lru_cache(maxsize=16)
+    def gzipped(self, size: int) -> bytes:
+        return gzip.compress(self.text[:size], 6)
+
+    @staticmethod
+    async def respond(writer: asyncio.StreamWriter, body, chunk: int, keep_alive: bool,
+                      content_type: str = 'application/octet-stream', encoding: str = None):
+        head = ['HTTP/1.1 200 OK', f'Content-Type: {content_type}',
+                f'Connection: {"keep-alive" if keep_alive else "close"}']
+        if encoding:
+            head.append(f'Content-Encoding: {encoding}')
+        if chunk:
+            head.append('Transfer-Encoding: chunked')
+        else:
+            head.append(f'Content-Length: {len(body)}')
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        if not chunk:
+            writer.write(body)
+        else:
+            for i in range(0, len(body), chunk):
+                part = body[i:i + chunk]
+                writer.write(b'%x\r\n' % len(part))
+                writer.write(part)
+                writer.write(b'\r\n')
+                await writer.drain()
+            writer.write(b'0\r\n\r\n')
+        await writer.drain()
+
+
+def text_payload(size: int) -> bytes:
+    """
+    类似API响应的JSON文本(gzip约压缩到1/5~1/10)
+    :param size:
+    :return:
+    """
+    lines = []
+    total = 0
+    i = 0
+    while total < size:
+        line = (f'{{"id": {i}, "name": "item-{i * 7919 % 100003}", "price": {i * 37 % 10000 / 100}, '
+                f'"tags": ["caul", "proxy", "t{i % 13}"], "active": {str(i % 3 == 0).lower()}}},\n').encode()
+        lines.append(line)
+        total += len(line)
+        i += 1
+    return b''.join(lines)[:size]
+
+
+async def serve(host: str, port: int, upstream: Upstream):
+    server = await asyncio.start_server(upstream.handle, host=host, port=port, backlog=4096, reuse_address=True)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18000)
+    parser.add_argument('--size', type=int, default=1024)
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--chunk', type=int, default=0)
+    args = parser.parse_args()
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    asyncio.run(serve(args.host, args.port, Upstream(args.size, args.latency_ms, args.chunk)))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,9 @@ a = Analysis(
     pathex=['./src','./.venv/Lib/site-packages','./.venv/lib/python3.7/site-packages/'],
     binaries=[] ,
     datas=[] ,
-    hiddenimports=[''],
+    hiddenimports=['caul_proxy.server_requests', 'caul_proxy.server_socket',
+                   'caul_proxy.server_socks5', 'caul_proxy.server_socks5_async',
+                   'caul_proxy.server_uvicorn', 'caul_proxy.server_h2'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
@@ -0,0 +1,187 @@
+import atexit
+import collections
+import json
+import logging
+import os
+import random
+import threading
+import time
+import typing
+
+from caul_proxy import metrics
+from caul_proxy.config import settings, logger
+
+RECORDS = metrics.Counter('caul_access_log_records_total',
+                          'Access log records: written, dropped (queue full) or sampled out', ('result',))
+
+
+class Record(typing.NamedTuple):
+    time: float
+    engine: str
+    client: str
+    method: str
+    target: str
+    protocol: str
+    status: int
+    duration: float
+    up: int = 0
+    down: int = 0
+    cache: str = ''
+
+
+class AccessLog:
+    """
+    访问日志: 请求线程/协程只把记录放入队列, 后台线程批量格式化并写出
+    队列满时丢弃并计数, 不阻塞请求
+    """
+
+    def __init__(self):
+        self.queue: typing.Deque[Record] = collections.deque()
+        self.wakeup = threading.Event()
+        self.thread: typing.Optional[threading.Thread] = None
+        self.file: typing.Optional[typing.TextIO] = None
+        self.file_path: typing.Optional[str] = None
+        self._lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            # worker进程重新启动写线程, 不写父进程残留的记录
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self.queue.clear()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self._lock = threading.Lock()
+
+    def log(self, engine: str, client: str, method: str, target: str, protocol: str, status: int,
+            duration: float, up: int = 0, down: int = 0, cache: str = '', failed: bool = None):
+        """
+        记录一次请求, 成功的请求按sample_rate采样
+        :param engine:
+        :param client: 客户端地址
+        :param method:
+        :param target: 转发的URL或隧道目标
+        :param protocol:
+        :param status: HTTP状态码或SOCKS5应答码
+        :param duration: 耗时(秒)
+        :param up: 客户端到上游的字节数
+        :param down: 上游到客户端的字节数
+        :param cache: X-Cache
+        :param failed: 是否失败, 默认按HTTP状态码判断(0或>=400)
+        :return:
+        """
+        conf = settings.access_log
+        if not conf.enabled or (not conf.path and not logger.isEnabledFor(logging.INFO)):
+            return
+        if failed is None:
+            failed = not 0 < status < 400
+        if not failed and conf.sample_rate < 1 and random.random() >= conf.sample_rate:
+            RECORDS.inc('sampled_out')
+            return
+        if len(self.queue) >= conf.queue_size:
+            RECORDS.inc('dropped')
+            return
+        self.queue.append(Record(time.time(), engine, client, method, target, protocol, status, duration,
+                                 up, down, cache))
+        if self.thread is None:
+            self.start()
+        elif len(self.queue) >= conf.batch_size:
+            self.wakeup.set()
+
+    def start(self):
+        with self._lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='AccessLog', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(settings.access_log.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        写出队列中的记录
+        :return:
+        """
+        conf = settings.access_log
+        batch = []
+        try:
+            while True:
+                batch.append(self.queue.popleft())
+        except IndexError:
+            pass
+        if not batch:
+            return
+        try:
+            if conf.path:
+                self.open(conf.path).write(''.join(format_record(record, conf.format) + '\n' for record in batch))
+                self.file.flush()
+            else:
+                self.close()
+                for record in batch:
+                    logger.handle(log_record(record, conf.format))
+        except Exception as e:
+            logger.warning(f'Access Log: {e}')
+            RECORDS.inc('dropped', value=len(batch))
+            return
+        RECORDS.inc('written', value=len(batch))
+
+    def open(self, path: str) -> typing.TextIO:
+        """
+        打开(或重新加载配置后切换)日志文件
+        :param path:
+        :return:
+        """
+        if self.file is None or self.file_path != path:
+            self.close()
+            self.file = open(path, 'a', encoding='utf-8')
+            self.file_path = path
+        return self.file
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            self.file_path = None
+
+
+def format_record(record: Record, fmt: str = 'text') -> str:
+    """
+    json: 每行一个JSON对象; text: 与日志相同的格式
+    :param record:
+    :param fmt:
+    :return:
+    """
+    if fmt == 'json':
+        data = record._asdict()
+        data['time'] = round(record.time, 3)
+        data['duration'] = round(record.duration, 6)
+        return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+    return f'{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.time))} - access - INFO - {message(record)}'
+
+
+def message(record: Record) -> str:
+    text = f'{record.client} {record.method} {record.target} {record.protocol} {record.status}'
+    if record.cache:
+        text += f' {record.cache}'
+    return f'{text} up={record.up} down={record.down} time={record.duration:.3f}s'
+
+
+def log_record(record: Record, fmt: str = 'text') -> logging.LogRecord:
+    """
+    输出到日志时, 时间使用请求完成的时间
+    :param record:
+    :param fmt:
+    :return:
+    """
+    msg = format_record(record, 'json') if fmt == 'json' else message(record)
+    result = logging.LogRecord('access', logging.INFO, __file__, 0, msg, None, None)
+    result.created = record.time
+    result.msecs = (record.time - int(record.time)) * 1000
+    return result
+
+
+access = AccessLog()
+log = access.log
+atexit.register(access.flush)
@@ -0,0 +1,153 @@
+import bisect
+import ipaddress
+import re
+from typing import List, Tuple, Optional
+
+from caul_proxy import util
+from caul_proxy.config import Config, logger
+
+
+class AddressList:
+    """
+    客户端地址列表: IP/CIDR合并为有序区间二分查找, 其他按正则匹配
+    """
+
+    def __init__(self, patterns: List[str]):
+        ranges = {4: [], 6: []}
+        regexes = []
+        for pattern in patterns or []:
+            network = parse_network(pattern)
+            if network is None:
+                regexes.append(pattern)
+                continue
+            ranges[network.version].append((int(network.network_address), int(network.broadcast_address)))
+        self.ranges = {version: merge(items) for version, items in ranges.items()}
+        self.starts = {version: [start for start, _ in items] for version, items in self.ranges.items()}
+        self.rex = compile_any(regexes)
+        self.empty = not patterns
+
+    def match(self, host: str) -> bool:
+        address = parse_address(host)
+        if address is not None:
+            starts = self.starts[address.version]
+            index = bisect.bisect_right(starts, int(address)) - 1
+            if index >= 0 and int(address) <= self.ranges[address.version][index][1]:
+                return True
+        return self.rex is not None and self.rex.match(host) is not None
+
+
+class Acl:
+    """
+    准入控制: 命中黑名单拒绝; 白名单非空时必须命中白名单. 按客户端地址缓存结果
+    """
+
+    def __init__(self, allows: List[str] = None, denys: List[str] = None, cache_size: int = 65536):
+        self.allows = AddressList(allows)
+        self.denys = AddressList(denys)
+        self.cache = util.LRUCache(cache_size)
+
+    def is_allow(self, host: str) -> bool:
+        return self.allows.empty or self.allows.match(host)
+
+    def is_deny(self, host: str) -> bool:
+        return not self.denys.empty and self.denys.match(host)
+
+    def admit(self, host: str) -> bool:
+        if self.allows.empty and self.denys.empty:
+            return True
+        decision = self.cache.get(host)
+        if decision is None:
+            decision = not self.is_deny(host) and self.is_allow(host)
+            self.cache.set(host, decision)
+        return decision
+
+
+def parse_network(pattern: str) -> Optional[ipaddress._BaseNetwork]:
+    """
+    解析IP/CIDR, 不是地址时返回None(按正则处理)
+    :param pattern:
+    :return:
+    """
+    try:
+        return ipaddress.ip_network(pattern.strip(), strict=False)
+    except ValueError:
+        return None
+
+
+def parse_address(host: str) -> Optional[ipaddress._BaseAddress]:
+    try:
+        address = ipaddress.ip_address(host.split('%', 1)[0])
+    except ValueError:
+        return None
+    # IPv4映射的IPv6地址按IPv4匹配
+    if address.version == 6 and address.ipv4_mapped is not None:
+        return address.ipv4_mapped
+    return address
+
+
+def merge(ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """
+    合并重叠/相邻区间
+    :param ranges:
+    :return:
+    """
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def compile_any(patterns: List[str]) -> Optional[re.Pattern]:
+    """
+    多个正则合并为一个
+    :param patterns:
+    :return:
+    """
+    if not patterns:
+        return None
+    try:
+        return re.compile('|'.join(f'(?:{p})' for p in patterns))
+    except re.error:
+        # 分组名重复等无法合并的情况, 逐个校验后再报错
+        for p in patterns:
+            re.compile(p)
+        raise
+
+
+ACL = Acl()
+
+
+def load(settings: Config):
+    """
+    根据配置编译ACL
+    :param settings:
+    :return:
+    """
+    swap(build(settings))
+    logger.debug(f'ACL loaded: allows={len(settings.allows or [])} denys={len(settings.denys or [])}')
+
+
+def build(settings: Config) -> Acl:
+    """
+    编译ACL, 不影响当前使用的ACL
+    :param settings:
+    :return:
+    """
+    return Acl(settings.allows, settings.denys)
+
+
+def swap(access: Acl):
+    global ACL
+    ACL = access
+
+
+def admit(host: str) -> bool:
+    """
+    客户端是否允许访问
+    :param host:
+    :return:
+    """
+    return ACL.admit(host)
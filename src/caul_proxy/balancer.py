@@ -0,0 +1,350 @@
+import concurrent.futures
+import http.client
+import math
+import os
+import random
+import ssl
+import threading
+import time
+import weakref
+from typing import List, Optional, Dict, Tuple
+
+import urllib3.util
+
+from caul_proxy import metrics, util
+from caul_proxy.config import Backend as BackendConf, Outlier, HealthCheck, logger
+from caul_proxy.resolver import dns
+
+STRATEGIES = ('round_robin', 'least_outstanding', 'peak_ewma')
+# 计为后端失败的状态码(网关错误), 连接错误和超时也计为失败
+FAILURE_STATUS = frozenset({502, 503, 504})
+# peak_ewma: 还没有延迟数据的后端, 每个未完成请求的代价(秒), 也是失败请求计入的最小延迟
+PENALTY = 1.0
+# 健康检查的并发数
+CHECK_THREADS = 8
+
+REQUESTS = metrics.Counter('caul_backend_requests_total', 'Requests per pooled backend by result',
+                           ('rule', 'backend', 'result'))
+EJECTIONS = metrics.Counter('caul_backend_ejections_total', 'Backends ejected for consecutive failures',
+                            ('rule', 'backend'))
+
+
+class Backend:
+    """多后端规则中的一个上游, 状态由所属Balancer的锁保护"""
+    __slots__ = ('pool', 'host', 'port', 'weight', 'label', 'outstanding', 'ewma', 'stamp', 'current',
+                 'failures', 'ejections', 'ejected_until', 'healthy', 'checks')
+
+    def __init__(self, pool: 'Balancer', host: str, port: Optional[int], weight: int):
+        self.pool = pool
+        self.host = host
+        self.port = port
+        self.weight = max(weight, 1)
+        self.label = f'{host}:{port}' if port else host
+        self.outstanding = 0
+        # 延迟EWMA(秒)及更新时间
+        self.ewma = 0.0
+        self.stamp = 0.0
+        # 平滑加权轮询的当前权重
+        self.current = 0
+        # 连续失败次数, 摘除次数
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.healthy = True
+        # 健康检查: 连续成功为正, 连续失败为负
+        self.checks = 0
+
+    def base(self, url: urllib3.util.Url) -> str:
+        port = self.port or url.port or (80 if url.scheme.lower() == 'http' else 443)
+        return f'{url.scheme}://{self.host}:{port}'
+
+    def available(self, now: float) -> bool:
+        return self.healthy and now >= self.ejected_until
+
+    def cost(self, now: float, decay: float) -> float:
+        """
+        peak_ewma的代价: 延迟EWMA(随空闲时间衰减) * (未完成请求数 + 1) / 权重
+        :param now:
+        :param decay:
+        :return:
+        """
+        if not self.ewma:
+            return PENALTY * self.outstanding / self.weight
+        ewma = self.ewma * math.exp(-max(now - self.stamp, 0.0) / decay)
+        return ewma * (self.outstanding + 1) / self.weight
+
+    def observe(self, elapsed: float, now: float, decay: float):
+        """
+        更新延迟EWMA: 比当前值慢时直接取该值(peak), 否则按时间衰减平滑
+        :param elapsed:
+        :param now:
+        :param decay:
+        :return:
+        """
+        if elapsed > self.ewma:
+            self.ewma = elapsed
+        else:
+            w = math.exp(-max(now - self.stamp, 0.0) / decay)
+            self.ewma = self.ewma * w + elapsed * (1 - w)
+        self.stamp = now
+
+
+class Balancer:
+    """
+    一个域名规则的多个后端: 按策略选择, 连续失败时摘除(outlier), 可选主动健康检查
+    没有可用的后端时在全部后端中选择
+    """
+
+    def __init__(self, name: str, backends: List[BackendConf], strategy: str = 'round_robin', port: int = None,
+                 decay_seconds: float = 10, outlier: Outlier = None, health_check: HealthCheck = None):
+        if strategy not in STRATEGIES:
+            raise ValueError(f'Unknown Balancer: {strategy}')
+        if not backends:
+            raise ValueError(f'No Backends: {name}')
+        self.name = name
+        self.strategy = strategy
+        self.decay_seconds = decay_seconds or 10
+        self.outlier = outlier or Outlier()
+        self.health_check = health_check or HealthCheck()
+        self.backends = [Backend(self, b.host, b.port or port, b.weight) for b in backends]
+        # least_outstanding相同时轮流选择
+        self._offset = 0
+        self._lock = threading.Lock()
+        self.next_check = 0.0
+        if self.health_check.interval:
+            checker.add(self)
+
+    def pick(self) -> Backend:
+        """
+        选择一个后端
+        :return:
+        """
+        if self.health_check.interval:
+            checker.ensure()
+        now = time.monotonic()
+        with self._lock:
+            candidates = [b for b in self.backends if b.available(now)] or self.backends
+            if len(candidates) == 1:
+                return candidates[0]
+            if self.strategy == 'round_robin':
+                return self._round_robin(candidates)
+            if self.strategy == 'least_outstanding':
+                return self._least_outstanding(candidates)
+            return self._peak_ewma(candidates, now)
+
+    @staticmethod
+    def _round_robin(candidates: List[Backend]) -> Backend:
+        # 平滑加权轮询: 权重大的后端不会连续被选中
+        total = 0
+        best = None
+        for backend in candidates:
+            backend.current += backend.weight
+            total += backend.weight
+            if best is None or backend.current > best.current:
+                best = backend
+        best.current -= total
+        return best
+
+    def _least_outstanding(self, candidates: List[Backend]) -> Backend:
+        n = len(candidates)
+        start = self._offset % n
+        self._offset += 1
+        return min((candidates[(start + i) % n] for i in range(n)),
+                   key=lambda b: (b.outstanding + 1) / b.weight)
+
+    def _peak_ewma(self, candidates: List[Backend], now: float) -> Backend:
+        # 随机取两个比较代价(power of two choices)
+        if len(candidates) > 2:
+            candidates = random.sample(candidates, 2)
+        return min(candidates, key=lambda b: b.cost(now, self.decay_seconds))
+
+    def acquire(self, backend: Backend):
+        with self._lock:
+            backend.outstanding += 1
+
+    def release(self, backend: Backend, elapsed: float, ok: bool):
+        """
+        请求结束: 更新未完成请求数/延迟, 连续失败达到阈值时摘除
+        :param backend:
+        :param elapsed: 到响应头的耗时, 失败时按不低于当前EWMA和PENALTY计入
+        :param ok:
+        :return:
+        """
+        now = time.monotonic()
+        conf = self.outlier
+        ejected = 0.0
+        with self._lock:
+            backend.outstanding -= 1
+            # 失败(连接拒绝/网关错误)通常很快返回, 按惩罚延迟计入, 避免peak_ewma偏向出错的后端
+            if not ok:
+                elapsed = max(elapsed, backend.ewma, PENALTY)
+            backend.observe(elapsed, now, self.decay_seconds)
+            if ok:
+                backend.failures = 0
+            else:
+                backend.failures += 1
+                if (conf.consecutive_failures and backend.failures >= conf.consecutive_failures
+                        and now >= backend.ejected_until and self._can_eject(now)):
+                    # 恢复后超过max_ejection_seconds未再摘除, 时长重新计算
+                    if now - backend.ejected_until > conf.max_ejection_seconds:
+                        backend.ejections = 0
+                    backend.ejections += 1
+                    backend.failures = 0
+                    ejected = min(conf.ejection_seconds * backend.ejections, conf.max_ejection_seconds)
+                    backend.ejected_until = now + ejected
+        REQUESTS.inc(self.name, backend.label, 'ok' if ok else 'failed')
+        if ejected:
+            EJECTIONS.inc(self.name, backend.label)
+            logger.warning(f'Eject Backend {backend.label} ({self.name}) For {ejected:g}s')
+
+    def _can_eject(self, now: float) -> bool:
+        percent = self.outlier.max_ejection_percent
+        if not percent:
+            return False
+        ejected = sum(1 for b in self.backends if now < b.ejected_until)
+        return ejected < max(len(self.backends) * percent // 100, 1)
+
+    def check(self, backend: Backend):
+        """
+        主动健康检查一个后端
+        :param backend:
+        :return:
+        """
+        ok = probe(backend, self.health_check)
+        conf = self.health_check
+        changed = False
+        with self._lock:
+            if ok:
+                backend.checks = max(backend.checks, 0) + 1
+                if not backend.healthy and backend.checks >= conf.healthy_threshold:
+                    backend.healthy = changed = True
+            else:
+                backend.checks = min(backend.checks, 0) - 1
+                if backend.healthy and -backend.checks >= conf.unhealthy_threshold:
+                    backend.healthy, changed = False, True
+        if changed:
+            logger.warning(f'Backend {backend.label} ({self.name}) {"Healthy" if ok else "Unhealthy"}')
+
+    def stats(self) -> Dict[Tuple[str, str], float]:
+        """
+        {(backend, stat): value}
+        :return:
+        """
+        now = time.monotonic()
+        values = {}
+        with self._lock:
+            for b in self.backends:
+                values[(b.label, 'outstanding')] = b.outstanding
+                decayed = b.ewma * math.exp(-max(now - b.stamp, 0.0) / self.decay_seconds)
+                values[(b.label, 'ewma_seconds')] = decayed
+                values[(b.label, 'ejected')] = 0 if now >= b.ejected_until else 1
+                values[(b.label, 'healthy')] = 1 if b.healthy else 0
+        return values
+
+
+class Lease:
+    """
+    一次转发占用的后端: 收到响应头时记录延迟和结果, release时计入后端
+    未收到响应头(连接错误/超时)时计为失败
+    """
+    __slots__ = ('backend', 'start', 'elapsed', 'ok', 'released')
+
+    def __init__(self, backend: Backend):
+        self.backend = backend
+        self.start = time.monotonic()
+        self.elapsed: Optional[float] = None
+        self.ok = False
+        self.released = False
+        backend.pool.acquire(backend)
+
+    def response(self, status: int):
+        self.elapsed = time.monotonic() - self.start
+        self.ok = status not in FAILURE_STATUS
+
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        elapsed = self.elapsed if self.elapsed is not None else time.monotonic() - self.start
+        self.backend.pool.release(self.backend, elapsed, self.ok)
+
+
+# 健康检查不校验证书, 只判断是否可用
+_INSECURE = ssl.create_default_context()
+_INSECURE.check_hostname = False
+_INSECURE.verify_mode = ssl.CERT_NONE
+
+
+def probe(backend: Backend, conf: HealthCheck) -> bool:
+    """
+    TCP连接或HTTP GET检查
+    :param backend:
+    :param conf:
+    :return:
+    """
+    https = (conf.scheme or 'http').lower() == 'https'
+    port = conf.port or backend.port or (443 if https else 80)
+    try:
+        if not conf.path:
+            dns.create_connection((backend.host, port), timeout=conf.timeout).close()
+            return True
+        if https:
+            conn = http.client.HTTPSConnection(backend.host, port, timeout=conf.timeout, context=_INSECURE)
+        else:
+            conn = http.client.HTTPConnection(backend.host, port, timeout=conf.timeout)
+        try:
+            conn.request('GET', conf.path, headers={'User-Agent': 'CaulProxy-HealthCheck'})
+            return conn.getresponse().status < 400
+        finally:
+            conn.close()
+    except (OSError, http.client.HTTPException) as e:
+        logger.debug(f'Health Check {backend.label}: {util.err_msg(e)}')
+        return False
+
+
+class Checker:
+    """
+    主动健康检查: 每个进程一个后台线程, 第一次选择后端时启动(worker进程各自检查)
+    只弱引用Balancer, 重新加载后旧规则的后端不再检查
+    """
+
+    def __init__(self):
+        self.balancers = weakref.WeakSet()
+        self.thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self.thread = None
+        self._lock = threading.Lock()
+
+    def add(self, balancer: Balancer):
+        with self._lock:
+            self.balancers.add(balancer)
+
+    def ensure(self):
+        if self.thread is not None:
+            return
+        with self._lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='HealthCheck', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        with concurrent.futures.ThreadPoolExecutor(CHECK_THREADS, thread_name_prefix='HealthCheck') as executor:
+            while True:
+                now = time.monotonic()
+                with self._lock:
+                    balancers = list(self.balancers)
+                due = [b for b in balancers if b.next_check <= now]
+                for balancer in due:
+                    balancer.next_check = now + balancer.health_check.interval
+                futures = [executor.submit(balancer.check, backend)
+                           for balancer in due for backend in balancer.backends]
+                concurrent.futures.wait(futures)
+                wait = min((b.next_check for b in balancers), default=now + 1) - time.monotonic()
+                time.sleep(min(max(wait, 0.05), 1))
+
+
+checker = Checker()
@@ -0,0 +1,592 @@
+import email.utils
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, List, BinaryIO, Mapping, Iterable, Iterator
+
+from requests.structures import CaseInsensitiveDict
+
+from caul_proxy import util, upstream, metrics
+from caul_proxy.config import Cache, settings, logger
+
+# 默认可缓存的状态码(RFC 7231 6.1)
+CACHEABLE_STATUS = {200, 203, 204, 300, 301, 404, 405, 410, 414, 501}
+# 不随缓存保存的header, Content-Encoding与保存的响应体一致时保留
+SKIP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'content-length', 'set-cookie', 'age'}
+# 304响应中不用于更新缓存的header
+KEEP_HEADERS = {'content-length', 'content-encoding', 'content-type', 'transfer-encoding'}
+# 启发式过期时间上限(秒)
+HEURISTIC_MAX = 86400
+# header估算大小
+HEADER_SIZE = 64
+
+
+class Entry:
+    """缓存的响应: 内存层保存body, 磁盘层保存文件路径"""
+    __slots__ = ('key', 'url', 'status', 'reason', 'headers', 'body', 'path', 'size',
+                 'stored', 'initial_age', 'lifetime', 'swr', 'no_cache')
+
+    def __init__(self, key: str, url: str, status: int, reason: str, headers: CaseInsensitiveDict,
+                 default_swr: int = 0):
+        self.key = key
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body: Optional[bytes] = None
+        self.path: Optional[str] = None
+        self.size = 0
+        self.stored = time.time()
+        self.initial_age = 0
+        self.lifetime = 0
+        self.swr = 0
+        self.no_cache = False
+        self.update(headers, default_swr)
+
+    def update(self, headers: CaseInsensitiveDict, default_swr: int = 0):
+        """
+        根据响应header计算有效期
+        :param headers:
+        :param default_swr:
+        :return:
+        """
+        cc = parse_cache_control(headers.get('Cache-Control'))
+        self.stored = time.time()
+        date = parse_date(headers.get('Date')) or self.stored
+        self.initial_age = max(seconds(headers.get('Age')) or 0, self.stored - date, 0)
+        self.lifetime = freshness(headers, cc, date, self.status)
+        swr = seconds(cc.get('stale-while-revalidate'))
+        self.swr = 0 if 'must-revalidate' in cc or 'proxy-revalidate' in cc else \
+            (swr if swr is not None else default_swr)
+        self.no_cache = 'no-cache' in cc
+
+    def age(self, now: float = None) -> float:
+        return self.initial_age + (now or time.time()) - self.stored
+
+    def fresh(self, now: float = None) -> bool:
+        return not self.no_cache and self.age(now) < self.lifetime
+
+    def stale_usable(self, now: float = None) -> bool:
+        """过期但在stale-while-revalidate时间内"""
+        return not self.no_cache and self.age(now) < self.lifetime + self.swr
+
+    def validators(self) -> dict:
+        headers = {}
+        if self.headers.get('ETag'):
+            headers['If-None-Match'] = self.headers['ETag']
+        if self.headers.get('Last-Modified'):
+            headers['If-Modified-Since'] = self.headers['Last-Modified']
+        return headers
+
+    def refreshed(self, headers: Mapping[str, str], default_swr: int = 0) -> 'Entry':
+        """
+        304后合并header, 返回新的Entry(body不变)
+        :param headers:
+        :param default_swr:
+        :return:
+        """
+        merged = CaseInsensitiveDict(self.headers)
+        for header, value in headers.items():
+            if header.lower() not in KEEP_HEADERS and header.lower() not in SKIP_HEADERS:
+                merged[header] = value
+        entry = Entry(self.key, self.url, self.status, self.reason, merged, default_swr)
+        entry.body, entry.path, entry.size = self.body, self.path, self.size
+        return entry
+
+    def weight(self) -> int:
+        return self.size + HEADER_SIZE * len(self.headers)
+
+
+class _Tier:
+    """按字节数限制大小的LRU"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.size = 0
+        self.evictions = 0
+        self.entries: 'OrderedDict[str, Entry]' = OrderedDict()
+
+    def get(self, key: str) -> Optional[Entry]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, entry: Entry) -> List[Entry]:
+        """
+        保存并淘汰超出容量的条目
+        :param entry:
+        :return: 被替换/淘汰的条目
+        """
+        dropped = []
+        old = self.pop(entry.key)
+        if old is not None:
+            dropped.append(old)
+        self.entries[entry.key] = entry
+        self.size += entry.weight()
+        while self.size > self.capacity and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.weight()
+            self.evictions += 1
+            dropped.append(evicted)
+        return dropped
+
+    def pop(self, key: str) -> Optional[Entry]:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.weight()
+        return entry
+
+    def clear(self) -> List[Entry]:
+        dropped = list(self.entries.values())
+        self.entries.clear()
+        self.size = 0
+        return dropped
+
+    def stats(self) -> dict:
+        return {'items': len(self.entries), 'bytes': self.size, 'capacity': self.capacity,
+                'evictions': self.evictions}
+
+
+class Recorder:
+    """
+    边转发边缓存响应体, 超过memory_item_size时写入磁盘层目录
+    """
+
+    def __init__(self, cache: 'ResponseCache', entry: Entry):
+        self.cache = cache
+        self.entry = entry
+        self.buffer = bytearray()
+        self.file: Optional[BinaryIO] = None
+        self.size = 0
+        self.aborted = False
+
+    def write(self, data: bytes):
+        if self.aborted:
+            return
+        self.size += len(data)
+        if self.size > self.cache.max_item_size:
+            self.abort()
+            return
+        if self.file is not None:
+            self.file.write(data)
+            return
+        self.buffer += data
+        if len(self.buffer) > self.cache.memory_item_size:
+            if not self.cache.disk_dir:
+                self.abort()
+                return
+            fd, path = tempfile.mkstemp(suffix='.cache', dir=self.cache.disk_dir)
+            self.file = os.fdopen(fd, 'wb')
+            self.entry.path = path
+            self.file.write(self.buffer)
+            self.buffer = bytearray()
+
+    def tee(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        """
+        边转发边写入
+        :param chunks:
+        :return:
+        """
+        for data in chunks:
+            self.write(data)
+            yield data
+
+    def commit(self):
+        if self.aborted:
+            return
+        if self.file is not None:
+            self.file.close()
+        else:
+            self.entry.body = bytes(self.buffer)
+        self.entry.size = self.size
+        self.entry.headers['Content-Length'] = str(self.size)
+        self.cache.put(self.entry)
+
+    def abort(self):
+        self.aborted = True
+        self.buffer = bytearray()
+        if self.file is not None:
+            self.file.close()
+            remove(self.entry.path)
+            self.file = None
+
+
+class ResponseCache:
+    """
+    GET响应缓存: 内存层(小响应) + 磁盘层(大响应, sendfile发送)
+    key为改写后的url + Vary指定的请求header
+    """
+
+    def __init__(self, conf: Cache = None):
+        self._lock = threading.Lock()
+        # url -> Vary的header名称
+        self.variants = util.LRUCache(65536)
+        # url -> keys, 用于失效
+        self.keys: Dict[str, set] = {}
+        # 正在后台重新验证的key
+        self.revalidating = set()
+        self.memory = _Tier(0)
+        self.disk = _Tier(0)
+        self.counters = {'hits': 0, 'stale_hits': 0, 'revalidated': 0, 'misses': 0, 'stores': 0,
+                         'bytes_saved': 0}
+        self.configure(conf or Cache())
+
+    def configure(self, conf: Cache):
+        self.enabled = conf.enabled
+        self.memory_item_size = conf.memory_item_size
+        self.max_item_size = conf.max_item_size
+        self.default_swr = conf.stale_while_revalidate
+        # 每个进程使用以pid命名的子目录: --workers时各worker的索引独立, 重启的worker不影响其他worker的文件
+        self.disk_dir = os.path.join(conf.disk_dir, str(os.getpid())) if conf.disk_dir else None
+        self.clear()
+        self.memory.capacity = conf.memory_size
+        self.disk.capacity = conf.disk_size
+        if self.enabled and self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+            # 索引不持久化, 清理本进程之前的文件及已退出进程的目录
+            for name in os.listdir(self.disk_dir):
+                if name.endswith('.cache'):
+                    remove(os.path.join(self.disk_dir, name))
+            prune(conf.disk_dir)
+
+    def key(self, url: str, req_headers: Mapping[str, str]) -> str:
+        names = self.variants.get(url) or ()
+        if not names:
+            return url
+        values = [f"{name}:{' '.join((req_headers.get(name) or '').split())}" for name in names]
+        return '\n'.join([url, *values])
+
+    def lookup(self, url: str, req_headers: Mapping[str, str]) -> Optional[Entry]:
+        """
+        查找缓存, 请求指定no-store时不使用缓存
+        :param url:
+        :param req_headers:
+        :return:
+        """
+        if 'no-store' in parse_cache_control(req_headers.get('Cache-Control')):
+            return None
+        key = self.key(url, req_headers)
+        with self._lock:
+            entry = self.memory.get(key) or self.disk.get(key)
+            if entry is None:
+                self.counters['misses'] += 1
+            return entry
+
+    def open(self, entry: Entry) -> Optional[BinaryIO]:
+        """
+        打开磁盘层文件, 已被淘汰时返回None
+        :param entry:
+        :return:
+        """
+        try:
+            return open(entry.path, 'rb')
+        except FileNotFoundError:
+            return None
+
+    def record(self, url: str, req_headers: Mapping[str, str], status: int, reason: str,
+               headers: Mapping[str, str], decoded: bool = False) -> Optional[Recorder]:
+        """
+        响应可缓存时返回Recorder
+        :param url:
+        :param req_headers:
+        :param status:
+        :param reason:
+        :param headers:
+        :param decoded: 保存的是解压后的响应体
+        :return:
+        """
+        if not self.enabled or not storable(req_headers, status, headers):
+            return None
+        length = seconds(headers.get('Content-Length'))
+        if decoded:
+            length = None
+        if length is not None and length > (self.max_item_size if self.disk_dir else self.memory_item_size):
+            return None
+        skip = SKIP_HEADERS.union(upstream.DECODED_HEADERS) if decoded else SKIP_HEADERS
+        stored = CaseInsensitiveDict({k: v for k, v in headers.items() if k.lower() not in skip})
+        names = {n.strip().lower() for n in (headers.get('Vary') or '').split(',') if n.strip()}
+        # 编码后的响应体只返回给接受该编码的客户端
+        if stored.get('Content-Encoding'):
+            names.add('accept-encoding')
+        names = tuple(sorted(names))
+        if names != (self.variants.get(url) or ()):
+            self.variants.set(url, names)
+        entry = Entry(self.key(url, req_headers), url, status, reason, stored, self.default_swr)
+        return Recorder(self, entry)
+
+    def put(self, entry: Entry):
+        tier = self.disk if entry.path else self.memory
+        with self._lock:
+            dropped = tier.put(entry)
+            # 换层: 删除另一层中的旧条目
+            other = (self.memory if entry.path else self.disk).pop(entry.key)
+            if other is not None:
+                dropped.append(other)
+            self.keys.setdefault(entry.url, set()).add(entry.key)
+            self.counters['stores'] += 1
+            self._unindex(dropped, entry)
+
+    def refresh(self, entry: Entry, headers: Mapping[str, str]) -> Entry:
+        """
+        304: 更新header和有效期
+        :param entry:
+        :param headers:
+        :return:
+        """
+        fresh = entry.refreshed(headers, self.default_swr)
+        tier = self.disk if entry.path else self.memory
+        with self._lock:
+            # 已被淘汰的不再放回
+            if tier.entries.get(entry.key) is entry:
+                self._unindex(tier.put(fresh), fresh)
+        return fresh
+
+    def invalidate(self, url: str):
+        """
+        不安全方法(POST/PUT等)成功后删除该url的所有缓存
+        :param url:
+        :return:
+        """
+        with self._lock:
+            dropped = []
+            for key in self.keys.pop(url, ()):
+                for tier in (self.memory, self.disk):
+                    entry = tier.pop(key)
+                    if entry is not None:
+                        dropped.append(entry)
+            self._unindex(dropped)
+
+    def hit(self, entry: Entry, kind: str = 'hits'):
+        with self._lock:
+            self.counters[kind] += 1
+            self.counters['bytes_saved'] += entry.size
+
+    def _unindex(self, dropped: List[Entry], current: Entry = None):
+        for entry in dropped:
+            if current is None or entry.key != current.key:
+                keys = self.keys.get(entry.url)
+                if keys is not None:
+                    keys.discard(entry.key)
+                    if not keys:
+                        self.keys.pop(entry.url, None)
+            if entry.path and (current is None or entry.path != current.path):
+                remove(entry.path)
+
+    def revalidate_async(self, entry: Entry, req_headers: Mapping[str, str], timeout: float = None,
+                         url: str = None):
+        """
+        stale-while-revalidate: 后台重新验证, 同一key只有一个
+        :param entry:
+        :param req_headers:
+        :param timeout:
+        :param url: 请求的上游url, 默认为缓存的url
+        :return:
+        """
+        with self._lock:
+            if entry.key in self.revalidating:
+                return
+            self.revalidating.add(entry.key)
+        headers = dict(req_headers.items())
+        thread = threading.Thread(target=self._revalidate, args=(entry, headers, timeout, url or entry.url),
+                                  daemon=True)
+        thread.start()
+
+    def _revalidate(self, entry: Entry, req_headers: dict, timeout: float, url: str):
+        try:
+            headers = {k: v for k, v in req_headers.items() if k.lower() not in CONDITIONAL_HEADERS}
+            headers.update(entry.validators())
+            with upstream.sessions.request('GET', url=url, headers=headers, timeout=timeout) as response:
+                if response.status_code == 304:
+                    self.refresh(entry, response.headers)
+                    return
+                decode = settings.compression.mode == 'decode'
+                recorder = self.record(entry.url, req_headers, response.status_code, response.reason,
+                                       response.headers, decode and upstream.is_decoded(response))
+                if recorder is None:
+                    return
+                try:
+                    for content in upstream.iter_body(response, decode):
+                        recorder.write(content)
+                except BaseException:
+                    recorder.abort()
+                    raise
+                recorder.commit()
+        except Exception as e:
+            logger.warning(f'Revalidate {entry.url}: {util.err_msg(e)}')
+        finally:
+            with self._lock:
+                self.revalidating.discard(entry.key)
+
+    def clear(self):
+        with self._lock:
+            dropped = self.memory.clear() + self.disk.clear()
+            self.keys.clear()
+        for entry in dropped:
+            entry.path and remove(entry.path)
+        self.variants.clear()
+
+    def stats(self) -> dict:
+        """
+        命中率, 节省流量, 各层大小和淘汰次数
+        :return:
+        """
+        with self._lock:
+            counters = dict(self.counters)
+            served = counters['hits'] + counters['stale_hits'] + counters['revalidated']
+            total = served + counters['misses']
+            return {
+                **counters,
+                'hit_ratio': served / total if total else 0.0,
+                'memory': self.memory.stats(),
+                'disk': self.disk.stats(),
+            }
+
+
+# 重新验证时由代理生成的条件请求header
+CONDITIONAL_HEADERS = {'if-none-match', 'if-modified-since', 'if-match', 'if-unmodified-since', 'if-range'}
+
+
+def parse_cache_control(value: Optional[str]) -> Dict[str, Optional[str]]:
+    """
+    解析Cache-Control: {指令: 参数}
+    :param value:
+    :return:
+    """
+    directives = {}
+    for part in (value or '').split(','):
+        name, _, arg = part.strip().partition('=')
+        if name:
+            directives[name.strip().lower()] = arg.strip().strip('"') or None
+    return directives
+
+
+def parse_date(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+
+def seconds(value: Optional[str]) -> Optional[int]:
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def freshness(headers: Mapping[str, str], cc: Dict[str, Optional[str]], date: float, status: int) -> float:
+    """
+    有效期(RFC 7234 4.2.1): s-maxage > max-age > Expires > 启发式(Last-Modified)
+    :param headers:
+    :param cc:
+    :param date:
+    :param status:
+    :return:
+    """
+    for directive in ('s-maxage', 'max-age'):
+        if directive in cc:
+            return seconds(cc[directive]) or 0
+    if headers.get('Expires'):
+        expires = parse_date(headers['Expires'])
+        return max(expires - date, 0) if expires else 0
+    last_modified = parse_date(headers.get('Last-Modified'))
+    if last_modified and status in CACHEABLE_STATUS:
+        return min(max(date - last_modified, 0) / 10, HEURISTIC_MAX)
+    return 0
+
+
+def storable(req_headers: Mapping[str, str], status: int, headers: Mapping[str, str]) -> bool:
+    """
+    共享缓存是否可以保存该响应(RFC 7234 3)
+    :param req_headers:
+    :param status:
+    :param headers:
+    :return:
+    """
+    if status not in CACHEABLE_STATUS:
+        return False
+    req_cc = parse_cache_control(req_headers.get('Cache-Control'))
+    cc = parse_cache_control(headers.get('Cache-Control'))
+    if 'no-store' in req_cc or 'no-store' in cc or 'private' in cc:
+        return False
+    if req_headers.get('Authorization') and not ({'public', 's-maxage', 'must-revalidate'} & cc.keys()):
+        return False
+    if headers.get('Set-Cookie') or (headers.get('Vary') or '').strip() == '*':
+        return False
+    # 没有有效期也没有校验器时缓存无意义
+    return bool({'max-age', 's-maxage', 'no-cache'} & cc.keys() or headers.get('Expires')
+                or headers.get('ETag') or headers.get('Last-Modified'))
+
+
+def must_revalidate(req_headers: Mapping[str, str]) -> bool:
+    """
+    请求要求重新验证(no-cache/max-age=0)
+    :param req_headers:
+    :return:
+    """
+    cc = parse_cache_control(req_headers.get('Cache-Control'))
+    return 'no-cache' in cc or cc.get('max-age') == '0' or 'no-cache' in (req_headers.get('Pragma') or '')
+
+
+def not_modified(entry: Entry, req_headers: Mapping[str, str]) -> bool:
+    """
+    客户端的If-None-Match与缓存一致
+    :param entry:
+    :param req_headers:
+    :return:
+    """
+    etag = entry.headers.get('ETag')
+    match = req_headers.get('If-None-Match')
+    if not etag or not match:
+        return False
+    tags = {weak(t.strip()) for t in match.split(',')}
+    return '*' in tags or weak(etag) in tags
+
+
+def weak(etag: str) -> str:
+    """弱比较: 去掉W/前缀"""
+    return etag[2:] if etag.startswith('W/') else etag
+
+
+def remove(path: str):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def prune(disk_dir: str):
+    """
+    删除已退出进程的磁盘层子目录
+    :param disk_dir: 配置的磁盘层目录
+    :return:
+    """
+    for name in os.listdir(disk_dir):
+        path = os.path.join(disk_dir, name)
+        if name.isdigit() and os.path.isdir(path) and not alive(int(name)):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def alive(pid: int) -> bool:
+    # Windows的os.kill会结束进程, 不探测
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+responses = ResponseCache()
+
+metrics.GaugeFunc('caul_response_cache', 'Response cache hits, bytes saved and evictions per tier',
+                  lambda: metrics.flatten(responses.stats()), ('stat',))
@@ -0,0 +1,275 @@
+import bisect
+import threading
+from typing import Dict, List, Optional, Tuple, Mapping, Iterable, Iterator, Callable, ContextManager
+
+from caul_proxy import metrics
+from caul_proxy.config import Coalesce, logger
+
+REQUESTS = metrics.Counter('caul_coalesce_requests_total', 'Coalesced GETs by role (leader went upstream)',
+                           ('role',))
+FALLBACKS = metrics.Counter('caul_coalesce_fallbacks_total', 'Followers that made their own upstream request',
+                            ('reason',))
+# fallback时需要与共享响应一致的header
+SAME_HEADERS = ('ETag', 'Last-Modified', 'Content-Length', 'Content-Encoding')
+
+Headers = List[Tuple[str, str]]
+
+
+class Behind(Exception):
+    """跟随者无法继续读取共享响应: lagged(落后超过缓冲)/failed(leader出错)/timeout"""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class Result:
+    """
+    上游响应: 状态, header及转发的响应体
+    headers: 上游响应头(用于缓存); items: 转发给客户端的响应头
+    """
+    __slots__ = ('status', 'reason', 'headers', 'items', 'decoded', 'chunks', 'shared')
+
+    def __init__(self, status: int, reason: str, headers: Mapping[str, str], items: Headers, decoded: bool,
+                 chunks: Iterable[bytes], shared: bool = False):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.items = items
+        self.decoded = decoded
+        self.chunks = chunks
+        # 跟随者共享leader的响应, 不再缓存
+        self.shared = shared
+
+
+class Flight:
+    """
+    一组合并的请求: leader转发上游响应时写入共享缓冲, 跟随者按各自的偏移读取
+    缓冲只保留最近buffer_size字节, 落后更多的跟随者改为自己请求
+    """
+
+    def __init__(self, key: str, buffer_size: int):
+        self.key = key
+        self.buffer_size = buffer_size
+        self.cond = threading.Condition()
+        self.result: Optional[Result] = None
+        # 缓冲的块及其在响应体中的偏移
+        self.chunks: List[bytes] = []
+        self.offsets: List[int] = []
+        self.start = 0
+        self.size = 0
+        self.done = False
+        self.failed = False
+
+    def joinable(self) -> bool:
+        return not self.failed and self.start == 0
+
+    def publish(self, result: Result) -> Result:
+        """
+        leader收到响应头: 通知跟随者, 返回写入共享缓冲的响应
+        :param result:
+        :return:
+        """
+        with self.cond:
+            self.result = Result(result.status, result.reason, result.headers, list(result.items), result.decoded,
+                                 ())
+            self.cond.notify_all()
+        return Result(result.status, result.reason, result.headers, result.items, result.decoded,
+                      self._tee(result.chunks))
+
+    def _tee(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        for data in chunks:
+            if data:
+                self._append(data)
+            yield data
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+
+    def _append(self, data: bytes):
+        with self.cond:
+            self.chunks.append(data)
+            self.offsets.append(self.size)
+            self.size += len(data)
+            # 丢弃超出缓冲的旧数据, 至少保留最新的一块
+            drop = 0
+            while len(self.chunks) - drop > 1 and self.size - self.offsets[drop + 1] >= self.buffer_size:
+                drop += 1
+            if drop:
+                del self.chunks[:drop]
+                del self.offsets[:drop]
+                self.start = self.offsets[0]
+            self.cond.notify_all()
+
+    def close(self, failed: bool):
+        """
+        leader结束: 出错或未收到响应头时跟随者改为自己请求, 否则响应体已全部写入
+        :param failed:
+        :return:
+        """
+        with self.cond:
+            if not self.done:
+                if failed or self.result is None:
+                    self.failed = True
+                else:
+                    self.done = True
+            self.cond.notify_all()
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        跟随者等待leader的响应头
+        :param timeout:
+        :return: leader出错/超时时返回False
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.result is not None or self.failed, timeout):
+                FALLBACKS.inc('timeout')
+                return False
+            if self.result is None:
+                FALLBACKS.inc('failed')
+                return False
+            return True
+
+    def read(self, offset: int, timeout: float = None) -> bytes:
+        """
+        读取offset开始的数据
+        :param offset:
+        :param timeout:
+        :return: 响应体结束时返回b''
+        """
+        with self.cond:
+            while True:
+                if offset < self.start:
+                    raise Behind('lagged')
+                if offset < self.size:
+                    i = bisect.bisect_right(self.offsets, offset) - 1
+                    chunk = self.chunks[i]
+                    return chunk[offset - self.offsets[i]:] if offset > self.offsets[i] else chunk
+                if self.done:
+                    return b''
+                if self.failed:
+                    raise Behind('failed')
+                if not self.cond.wait(timeout):
+                    raise Behind('timeout')
+
+    def follow(self, refetch: Callable[[], ContextManager[Result]], timeout: float = None) -> Result:
+        """
+        跟随者的响应
+        :param refetch: 无法继续共享时自己请求上游
+        :param timeout:
+        :return:
+        """
+        result = self.result
+        return Result(result.status, result.reason, result.headers, list(result.items), result.decoded,
+                      self._follow(refetch, timeout), shared=True)
+
+    def _follow(self, refetch: Callable[[], ContextManager[Result]], timeout: float = None) -> Iterator[bytes]:
+        offset = 0
+        try:
+            while True:
+                data = self.read(offset, timeout)
+                if not data:
+                    return
+                offset += len(data)
+                yield data
+        except Behind as e:
+            FALLBACKS.inc(e.reason)
+            logger.debug(f'Coalesce {self.key}: {e.reason} At {offset}, Fallback')
+        # 已发送部分响应体, 自己请求并跳过已发送的部分
+        with refetch() as result:
+            if not same_response(self.result, result):
+                raise ConnectionError(f'Coalesced Response Changed: {self.key}')
+            yield from skip(result.chunks, offset)
+
+
+def same_response(shared: Result, own: Result) -> bool:
+    if shared.status != own.status or shared.decoded != own.decoded:
+        return False
+    return all(shared.headers.get(name) == own.headers.get(name) for name in SAME_HEADERS)
+
+
+def skip(chunks: Iterable[bytes], size: int) -> Iterator[bytes]:
+    """
+    跳过前size字节
+    :param chunks:
+    :param size:
+    :return:
+    """
+    for data in chunks:
+        if size >= len(data):
+            size -= len(data)
+            continue
+        yield data[size:] if size else data
+        size = 0
+
+
+class Flights:
+    """
+    按 method + 改写后的url + 指定请求header 合并并发的GET(singleflight)
+    """
+
+    def __init__(self, conf: Coalesce = None):
+        self._lock = threading.Lock()
+        self.flights: Dict[str, Flight] = {}
+        self.configure(conf or Coalesce())
+
+    def configure(self, conf: Coalesce):
+        self.enabled = conf.enabled
+        self.headers = list(conf.headers)
+        self.buffer_size = conf.buffer_size
+
+    def key(self, method: str, url: str, req_headers: Mapping[str, str], validators: Mapping[str, str] = None
+            ) -> str:
+        """
+        合并的key, 代理发送的条件请求header也参与
+        :param method:
+        :param url:
+        :param req_headers:
+        :param validators:
+        :return:
+        """
+        parts = [method, url]
+        for name in self.headers:
+            value = req_headers.get(name)
+            if value is not None:
+                parts.append(f'{name.lower()}:{value}')
+        for name, value in (validators or {}).items():
+            parts.append(f'proxy-{name.lower()}:{value}')
+        return '\n'.join(parts)
+
+    def join(self, key: str) -> Tuple[Flight, bool]:
+        """
+        加入进行中的请求, 没有或已无法加入时成为leader
+        :param key:
+        :return: (flight, 是否leader)
+        """
+        with self._lock:
+            flight = self.flights.get(key)
+            if flight is not None and flight.joinable():
+                REQUESTS.inc('follower')
+                return flight, False
+            flight = self.flights[key] = Flight(key, self.buffer_size)
+        REQUESTS.inc('leader')
+        return flight, True
+
+    def leave(self, flight: Flight, failed: bool):
+        """
+        leader结束
+        :param flight:
+        :param failed:
+        :return:
+        """
+        with self._lock:
+            if self.flights.get(flight.key) is flight:
+                del self.flights[flight.key]
+        flight.close(failed)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'flights': len(self.flights)}
+
+
+flights = Flights()
+
+metrics.GaugeFunc('caul_coalesce', 'Coalesced upstream GETs in flight',
+                  lambda: metrics.flatten(flights.stats()), ('stat',))
@@ -0,0 +1,149 @@
+import typing
+import zlib
+
+from caul_proxy import metrics, util
+from caul_proxy.config import Compression
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BYTES = metrics.Counter('caul_compression_bytes_total', 'Bytes before (in) and after (out) on-the-fly compression',
+                        ('encoding', 'direction'))
+# 不压缩的状态码: 无响应体或范围请求
+SKIP_STATUS = frozenset({204, 206, 304})
+# 流式响应, 压缩器缓冲会延迟事件
+SKIP_TYPES = frozenset({'text/event-stream'})
+
+Headers = typing.List[typing.Tuple[str, str]]
+
+
+class Compressor:
+    """流式压缩: gzip(zlib) 或 br(brotli)"""
+
+    def __init__(self, encoding: str, conf: Compression):
+        self.encoding = encoding
+        self.size_in = 0
+        self.size_out = 0
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=conf.brotli_quality)
+            self._compress, self._flush = self._compressor.process, self._compressor.finish
+        else:
+            # wbits=31: gzip格式
+            self._compressor = zlib.compressobj(conf.gzip_level, zlib.DEFLATED, 31)
+            self._compress, self._flush = self._compressor.compress, self._compressor.flush
+
+    def compress(self, data: bytes) -> bytes:
+        self.size_in += len(data)
+        data = self._compress(data)
+        self.size_out += len(data)
+        return data
+
+    def flush(self) -> bytes:
+        """
+        结束压缩, 返回剩余数据
+        :return:
+        """
+        data = self._flush()
+        self.size_out += len(data)
+        BYTES.inc(self.encoding, 'in', value=self.size_in)
+        BYTES.inc(self.encoding, 'out', value=self.size_out)
+        return data
+
+
+def available(encoding: str) -> bool:
+    return encoding == 'gzip' or (encoding == 'br' and brotli is not None)
+
+
+def eligible(conf: Compression, method: str, status: int, headers: Headers) -> bool:
+    """
+    响应是否可以压缩: 未编码, 类型在mime_types中, 长度未知或不小于min_size
+    :param conf:
+    :param method:
+    :param status:
+    :param headers: 转发给客户端的响应头
+    :return:
+    """
+    if not conf.encodings or method == 'HEAD' or status < 200 or status in SKIP_STATUS:
+        return False
+    if (util.header_value(headers, 'Content-Encoding') or 'identity').strip().lower() != 'identity':
+        return False
+    if 'no-transform' in (util.header_value(headers, 'Cache-Control') or '').lower():
+        return False
+    mime = (util.header_value(headers, 'Content-Type') or '').split(';', 1)[0].strip().lower()
+    if not mime or mime in SKIP_TYPES:
+        return False
+    if not any(mime.startswith(t) if t.endswith('/') else mime == t for t in conf.mime_types):
+        return False
+    length = util.header_value(headers, 'Content-Length')
+    return not (length and length.strip().isdigit() and int(length) < conf.min_size)
+
+
+def negotiate(accept_encoding: typing.Optional[str], encodings: typing.Iterable[str]) -> typing.Optional[str]:
+    """
+    按配置的优先顺序选择客户端接受(q>0)的编码
+    :param accept_encoding: Accept-Encoding: br;q=1.0, gzip;q=0.8, *;q=0.1
+    :param encodings:
+    :return: 都不接受时返回None
+    """
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        name, *params = item.split(';')
+        q = 1.0
+        for param in params:
+            key, _, value = param.strip().partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[name.strip().lower()] = q
+    for encoding in encodings:
+        if available(encoding) and accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return None
+
+
+def transform(headers: Headers, encoding: typing.Optional[str]) -> Headers:
+    """
+    添加Vary: Accept-Encoding; 压缩时去掉Content-Length(及identity), 强ETag改为弱ETag
+    :param headers:
+    :param encoding:
+    :return:
+    """
+    result = []
+    vary = False
+    for k, v in headers:
+        name = k.lower()
+        if name == 'vary':
+            vary = vary or '*' in v or 'accept-encoding' in v.lower()
+        elif encoding and name in ('content-length', 'content-encoding'):
+            continue
+        elif encoding and name == 'etag' and not v.startswith('W/'):
+            v = f'W/{v}'
+        result.append((k, v))
+    if not vary:
+        result.append(('Vary', 'Accept-Encoding'))
+    if encoding:
+        result.append(('Content-Encoding', encoding))
+    return result
+
+
+def prepare(conf: Compression, method: str, status: int, accept_encoding: typing.Optional[str],
+            headers: Headers) -> typing.Tuple[Headers, typing.Optional[Compressor]]:
+    """
+    按客户端Accept-Encoding决定是否压缩响应
+    :param conf:
+    :param method:
+    :param status:
+    :param accept_encoding:
+    :param headers: 转发给客户端的响应头
+    :return: 调整后的响应头, 压缩器(不压缩时为None)
+    """
+    if not eligible(conf, method, status, headers):
+        return headers, None
+    encoding = negotiate(accept_encoding, conf.encodings)
+    return transform(headers, encoding), Compressor(encoding, conf) if encoding else None
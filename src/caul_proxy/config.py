@@ -1,19 +1,61 @@
 import logging
 import sys
 from logging.handlers import RotatingFileHandler
-from typing import Optional, List
+from typing import Optional, List, Dict, Iterable, Tuple
 
 import yaml
 from pydantic import BaseModel
 
 # will print
 logger = logging.getLogger()
+# init_logger添加的handler, 重新加载配置时不重复添加
+_handlers: List[logging.Handler] = []
+
+
+class Backend(BaseModel):
+    host: str
+    # 为空时使用规则的port或请求的端口
+    port: Optional[int]
+    weight: Optional[int] = 1
+
+
+class Outlier(BaseModel):
+    # 连续失败(连接错误/超时/502/503/504)该次数后摘除后端, 0为不摘除
+    consecutive_failures: Optional[int] = 5
+    # 第n次摘除的时长为n*ejection_seconds, 不超过max_ejection_seconds
+    ejection_seconds: Optional[float] = 30
+    max_ejection_seconds: Optional[float] = 300
+    # 同时摘除的后端比例上限(%), 至少可摘除一个
+    max_ejection_percent: Optional[int] = 50
+
+
+class HealthCheck(BaseModel):
+    # 主动检查间隔(秒), 0为不检查
+    interval: Optional[float] = 0
+    # 为空时只检查TCP连接, 否则GET该路径, 状态码<400为健康
+    path: Optional[str] = None
+    scheme: Optional[str] = 'http'
+    # 为空时使用后端的端口
+    port: Optional[int] = None
+    timeout: Optional[float] = 2
+    # 连续失败/成功该次数后标记为不健康/健康
+    unhealthy_threshold: Optional[int] = 3
+    healthy_threshold: Optional[int] = 2
 
 
 class Domain(BaseModel):
     pattern: str
-    replace: str
+    # 单个上游; 配置backends时不使用
+    replace: Optional[str]
     port: Optional[int]
+    # 多个上游, 每个请求按balancer选择
+    backends: Optional[List[Backend]] = []
+    # round_robin(加权轮询)/least_outstanding(最少未完成请求)/peak_ewma(延迟峰值EWMA)
+    balancer: Optional[str] = 'round_robin'
+    # peak_ewma的延迟衰减时间(秒)
+    decay_seconds: Optional[float] = 10
+    outlier: Optional[Outlier] = Outlier()
+    health_check: Optional[HealthCheck] = HealthCheck()
 
 
 class Uri(BaseModel):
@@ -23,26 +65,280 @@ class Uri(BaseModel):
     full: Optional[bool] = False
 
 
+class Http2(BaseModel):
+    # HTTPS上游通过ALPN协商HTTP/2时多路复用连接(需要安装h2), 协商为HTTP/1.1时使用原连接池
+    enabled: Optional[bool] = False
+    # 单个上游的最大HTTP/2连接数
+    max_connections: Optional[int] = 2
+    # 每个连接的最大并发流数, 不超过上游SETTINGS的限制
+    max_streams: Optional[int] = 100
+    # 每个流的接收窗口(字节)
+    window_size: Optional[int] = 1048576
+    # 是否校验HTTPS上游证书; ca_file为CA证书文件或目录(如自签名的测试上游), 为空时使用系统CA
+    verify: Optional[bool] = True
+    ca_file: Optional[str] = ''
+
+
+class Pool(BaseModel):
+    # 单个上游(scheme/host/port)的最大连接数
+    max_per_host: Optional[int] = 10
+    # 所有上游的最大并发连接数
+    max_total: Optional[int] = 100
+    # 上游空闲多久(秒)后关闭其连接
+    idle_timeout: Optional[int] = 60
+    http2: Optional[Http2] = Http2()
+
+
+class Body(BaseModel):
+    # 请求体超过该大小(字节)时写入临时文件
+    spool_size: Optional[int] = 1048576
+    # 临时文件目录, 为空时使用系统临时目录
+    spool_dir: Optional[str] = None
+
+
+class Relay(BaseModel):
+    # auto: Linux下使用splice, 否则recv_into/sendall; copy: 始终recv_into/sendall
+    mode: Optional[str] = 'auto'
+    # 单方向缓冲区(管道)大小
+    buffer_size: Optional[int] = 262144
+
+
+class Shaping(BaseModel):
+    # 隧道转发(SOCKS5/CONNECT/socket引擎)的带宽限制(字节/秒), 每个方向分别计算, 0为不限制
+    per_connection: Optional[int] = 0
+    per_client: Optional[int] = 0
+    total: Optional[int] = 0
+    # 令牌桶容量: 按对应速率可传输的秒数
+    burst_seconds: Optional[float] = 0.25
+    # 连续传输不超过该字节数的流视为交互流量: 不等待客户端/全局限制(仍计入), 0为不区分
+    interactive_bytes: Optional[int] = 65536
+    # 空闲超过该时间(秒)后重新计算连续传输的字节数
+    interactive_idle: Optional[float] = 1.0
+
+
+class Limit(BaseModel):
+    # 每秒请求数(令牌补充速度), 0为不限制
+    rate: Optional[float] = 0
+    # 突发请求数(令牌桶容量), 为0时取max(rate, 1)
+    burst: Optional[float] = 0
+    # 并发连接数, 0为不限制
+    max_connections: Optional[int] = 0
+
+
+class RateLimit(BaseModel):
+    # 每个客户端IP的限制
+    client: Optional[Limit] = Limit()
+    # 每个SOCKS5用户名的限制(认证后), 与客户端IP的限制同时生效
+    user: Optional[Limit] = Limit()
+    # 不限制的客户端: IP, CIDR 或正则
+    exempt: Optional[List[str]] = []
+    # 空闲超过该时间(秒)且没有连接的客户端状态被回收
+    idle_timeout: Optional[float] = 300
+
+
+class Socks5(BaseModel):
+    # 用户名/密码(RFC 1929), 为空时不需要认证
+    users: Optional[Dict[str, str]] = {}
+
+
+class H2Server(BaseModel):
+    # h2引擎: 配置证书时为TLS(ALPN h2), 否则为明文h2c(prior knowledge)
+    certfile: Optional[str] = ''
+    keyfile: Optional[str] = ''
+    # 每个客户端连接的最大并发流数
+    max_streams: Optional[int] = 100
+    # 每个流的接收窗口(字节): 上游读取前客户端最多可发送的数据
+    window_size: Optional[int] = 1048576
+    # 连接的接收窗口(字节), 所有流共享
+    connection_window: Optional[int] = 16777216
+
+
+class Dns(BaseModel):
+    # 解析结果缓存时间(秒)
+    ttl: Optional[int] = 60
+    # 解析失败的缓存时间(秒)
+    negative_ttl: Optional[int] = 5
+    cache_size: Optional[int] = 4096
+    # 连接上游超时(秒)
+    connect_timeout: Optional[float] = 10
+    # Happy Eyeballs: 上一个地址未连上时, 间隔多久(秒)尝试下一个
+    happy_eyeballs_delay: Optional[float] = 0.25
+
+
+class Cache(BaseModel):
+    # 是否缓存GET响应(RFC 7234)
+    enabled: Optional[bool] = False
+    # 内存层总大小(字节)
+    memory_size: Optional[int] = 67108864
+    # 响应体超过该大小(字节)时放入磁盘层
+    memory_item_size: Optional[int] = 1048576
+    # 磁盘层目录, 为空时不启用磁盘层; 每个进程使用其下以pid命名的子目录
+    disk_dir: Optional[str] = None
+    # 磁盘层总大小(字节)
+    disk_size: Optional[int] = 1073741824
+    # 单个响应体最大缓存大小(字节)
+    max_item_size: Optional[int] = 104857600
+    # 响应未指定stale-while-revalidate时, 过期后仍可使用的时间(秒)
+    stale_while_revalidate: Optional[int] = 0
+
+
+class Coalesce(BaseModel):
+    # 合并相同的并发GET(requests引擎): 只有一个请求发往上游, 其他请求共享其响应
+    enabled: Optional[bool] = False
+    # 除method和url外参与合并的请求header, 值不同的请求不合并
+    headers: Optional[List[str]] = ['Accept', 'Accept-Encoding', 'Accept-Language', 'Authorization', 'Cookie',
+                                    'Range', 'If-None-Match', 'If-Modified-Since']
+    # 共享缓冲(字节): 落后超过该大小的请求改为自己请求上游; 响应体超过该大小后新的请求不再加入
+    buffer_size: Optional[int] = 8388608
+
+
+class Executor(BaseModel):
+    # socket引擎: 处理连接的最大线程数
+    threads: Optional[int] = 64
+    # 等待处理的连接数上限
+    queue_size: Optional[int] = 256
+    # listen积压队列长度
+    backlog: Optional[int] = 1024
+    # 等待队列满时: reject立即返回503; pause暂停accept, 由内核积压队列承接
+    overload: Optional[str] = 'reject'
+    # 连接排队超过该时间(秒)时直接返回503, 0为不限制
+    queue_timeout: Optional[float] = 10
+
+
+class AccessLog(BaseModel):
+    enabled: Optional[bool] = True
+    # text: 与日志相同的格式; json: 每行一个JSON对象
+    format: Optional[str] = 'text'
+    # 输出文件, 为空时输出到日志(stdout/stdout.log)
+    path: Optional[str] = None
+    # 成功请求(status<400)的采样比例, 失败的请求全部记录
+    sample_rate: Optional[float] = 1.0
+    # 等待写出的记录数上限, 超过时丢弃
+    queue_size: Optional[int] = 65536
+    # 积压到batch_size条或每隔flush_interval(秒)写出一次
+    batch_size: Optional[int] = 512
+    flush_interval: Optional[float] = 0.5
+
+
+class Cors(BaseModel):
+    # 添加到响应的CORS header, allow_origin为空时不添加
+    allow_origin: Optional[str] = '*'
+    allow_methods: Optional[str] = 'GET, POST'
+    allow_headers: Optional[str] = None
+    expose_headers: Optional[str] = None
+    allow_credentials: Optional[bool] = False
+    max_age: Optional[int] = None
+
+    def headers(self) -> List[Tuple[str, str]]:
+        if not self.allow_origin:
+            return []
+        headers = [('Access-Control-Allow-Origin', self.allow_origin)]
+        for name, value in (('Access-Control-Allow-Methods', self.allow_methods),
+                            ('Access-Control-Allow-Headers', self.allow_headers),
+                            ('Access-Control-Expose-Headers', self.expose_headers)):
+            if value:
+                headers.append((name, value))
+        if self.allow_credentials:
+            headers.append(('Access-Control-Allow-Credentials', 'true'))
+        if self.max_age is not None:
+            headers.append(('Access-Control-Max-Age', str(self.max_age)))
+        return headers
+
+
+class Compression(BaseModel):
+    # requests引擎: passthrough原样转发上游编码后的响应体; decode解压后转发
+    mode: Optional[str] = 'passthrough'
+    # 上游未压缩时按客户端Accept-Encoding压缩, 按优先顺序(br需要安装brotli), 为空时不压缩
+    encodings: Optional[List[str]] = []
+    # Content-Length小于该值(字节)时不压缩
+    min_size: Optional[int] = 1024
+    # 可压缩的Content-Type, 以/结尾时匹配前缀
+    mime_types: Optional[List[str]] = ['text/', 'application/json', 'application/javascript', 'application/xml',
+                                       'image/svg+xml']
+    gzip_level: Optional[int] = 6
+    brotli_quality: Optional[int] = 4
+
+
+class Plugins(BaseModel):
+    # 单次钩子/插件rewriter调用的耗时预算(毫秒), 0为不限制
+    budget_ms: Optional[float] = 5
+    # 单独指定插件的预算(毫秒) {name: ms}
+    budgets: Optional[Dict[str, float]] = {}
+    # 连续超出预算该次数后跳过插件bypass_seconds秒, 0为只记录日志
+    bypass_after: Optional[int] = 0
+    bypass_seconds: Optional[float] = 60
+    # 不启用的钩子插件
+    disabled: Optional[List[str]] = []
+    # 钩子插件的初始化参数 {name: {key: value}}
+    options: Optional[Dict[str, dict]] = {}
+
+
+class Admin(BaseModel):
+    # 管理端口(/metrics), 0为不启动
+    host: Optional[str] = '127.0.0.1'
+    port: Optional[int] = 0
+
+
 class Config(BaseModel):
     log_level: Optional[str] = 'INFO'
     plugin_dir: Optional[str] = ''
     allows: Optional[List[str]] = []
     denys: Optional[List[str]] = []
+    rate_limit: Optional[RateLimit] = RateLimit()
     domains: Optional[List[Domain]] = []
     uris: Optional[List[Uri]] = []
+    # 改写结果缓存条数, 0为不缓存
+    rewrite_cache: Optional[int] = 10240
+    # 检查配置文件变化的间隔(秒), 0为只在SIGHUP时重新加载
+    reload_interval: Optional[float] = 2
+    pool: Optional[Pool] = Pool()
+    body: Optional[Body] = Body()
+    relay: Optional[Relay] = Relay()
+    shaping: Optional[Shaping] = Shaping()
+    socks5: Optional[Socks5] = Socks5()
+    h2_server: Optional[H2Server] = H2Server()
+    dns: Optional[Dns] = Dns()
+    cache: Optional[Cache] = Cache()
+    coalesce: Optional[Coalesce] = Coalesce()
+    executor: Optional[Executor] = Executor()
+    access_log: Optional[AccessLog] = AccessLog()
+    cors: Optional[Cors] = Cors()
+    compression: Optional[Compression] = Compression()
+    plugins: Optional[Plugins] = Plugins()
+    admin: Optional[Admin] = Admin()
 
     def load_yaml(self, path: str):
         # 加载yaml
+        conf = Config.read_yaml(path)
+        if conf is None:
+            return
+        self.update(conf)
+        # 设置日志参数
+        self.init_logger()
+
+    @staticmethod
+    def read_yaml(path: str) -> Optional['Config']:
+        """
+        读取并校验配置文件, 不修改当前配置
+        :param path:
+        :return: 文件为空时返回None
+        """
         with open(path, 'r', encoding='utf-8') as f:
             data: dict = yaml.load(f, Loader=yaml.FullLoader)
         if not data:
-            return
+            return None
         data_proxy: dict = data["caul"]["proxy"]
-        conf = Config(**data_proxy)
-        for key in data_proxy.keys():
+        return Config(**data_proxy)
+
+    def update(self, conf: 'Config', keys: Iterable[str] = None):
+        """
+        使用conf的配置项, 默认只使用配置文件中出现的
+        :param conf:
+        :param keys:
+        :return:
+        """
+        for key in keys or conf.__fields_set__:
             setattr(self, key, getattr(conf, key))
-        # 设置日志参数
-        self.init_logger()
 
     def init_logger(self):
         # logger format
@@ -50,6 +346,9 @@ class Config(BaseModel):
             fmt="%(asctime)s - %(name)s:%(lineno)d - %(levelname)s - %(message)s",
             datefmt="%Y-%m-%d %H:%M:%S",
         )
+        logger.setLevel(self.log_level)
+        if _handlers:
+            return
         # stdout logger
         handler_std = logging.StreamHandler(sys.stdout)
         handler_std.setFormatter(fmt)
@@ -60,9 +359,9 @@ class Config(BaseModel):
             maxBytes=10240000,
             backupCount=30, encoding='utf8')
         handler_file.setFormatter(fmt)
+        _handlers.extend([handler_std, handler_file])
         logger.addHandler(handler_std)
         logger.addHandler(handler_file)
-        logger.setLevel(self.log_level)
 
 
 settings = Config()
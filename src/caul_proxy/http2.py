@@ -0,0 +1,928 @@
+import asyncio
+import collections
+import http.client
+import os
+import selectors
+import socket
+import ssl
+import threading
+import time
+from typing import Dict, List, Optional, Tuple, Iterable, Mapping, Union, BinaryIO
+
+import requests
+import urllib3.response
+import urllib3.util
+from requests.adapters import HTTPAdapter
+from urllib3._collections import HTTPHeaderDict
+
+from caul_proxy import metrics
+from caul_proxy.config import Pool as PoolConf, logger
+from caul_proxy.resolver import dns
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+    import h2.exceptions
+    import h2.settings
+except ImportError:
+    h2 = None
+
+ALPN = ['h2', 'http/1.1']
+# 协商为HTTP/1.1的上游, 多久(秒)后重新尝试HTTP/2
+HTTP1_RECHECK = 600
+# 连接级接收窗口(字节)
+CONNECTION_WINDOW = 16777216
+READ_SIZE = 65536
+# 待写出的数据超过该大小时, 发送请求体的线程等待
+OUTBOUND_LIMIT = 1048576
+# I/O线程检查空闲连接的间隔(秒)
+SWEEP_INTERVAL = 1.0
+# 流被上游拒绝(未处理)时重试的次数, 仍被拒绝则改用HTTP/1.1
+REFUSED_RETRIES = 2
+# HTTP/2中不允许的连接相关header, Host由:authority代替
+CONNECTION_HEADERS = frozenset({'connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'upgrade',
+                                'host', 'te'})
+
+CONNECTIONS = metrics.Counter('caul_upstream_h2_connections_total',
+                              'TLS connections opened by the HTTP/2 pool by ALPN protocol and session reuse',
+                              ('protocol', 'tls'))
+STREAMS = metrics.Counter('caul_upstream_h2_streams_total', 'HTTP/2 upstream streams by result', ('result',))
+
+Headers = List[Tuple[str, str]]
+
+
+class RefusedStream(ConnectionError):
+    """上游未处理该流(REFUSED_STREAM, GOAWAY的last_stream_id之后, 或请求头未发出), 可以安全重试"""
+
+
+def _wake(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class Stream:
+    """
+    一个HTTP/2请求: 响应头/数据由I/O线程写入, 请求线程读取(或在asyncio中等待)
+    读取后才归还流量控制窗口, 客户端读得慢时只阻塞该流
+    """
+
+    def __init__(self, conn: 'Connection', stream_id: int, timeout: float = None):
+        self.conn = conn
+        self.stream_id = stream_id
+        self.timeout = timeout
+        self.cond = threading.Condition(conn.lock)
+        self.status: Optional[int] = None
+        self.headers: Optional[Headers] = None
+        # (数据, 流量控制长度)
+        self.chunks = collections.deque()
+        self.ended = False
+        self.error: Optional[Exception] = None
+        self.released = False
+        self.waiter: Optional[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = None
+
+    def notify(self):
+        """I/O线程持有连接的锁时调用"""
+        self.cond.notify_all()
+        if self.waiter is not None:
+            loop, future = self.waiter
+            self.waiter = None
+            loop.call_soon_threadsafe(_wake, future)
+
+    def _has_response(self) -> bool:
+        return self.headers is not None or self.error is not None
+
+    def _readable(self) -> bool:
+        return bool(self.chunks) or self.ended or self.error is not None
+
+    def response(self, timeout: float = None) -> Tuple[int, Headers]:
+        """
+        等待响应头
+        :param timeout:
+        :return: (状态码, header列表)
+        """
+        with self.cond:
+            if not self.cond.wait_for(self._has_response, timeout):
+                raise socket.timeout('HTTP/2 Response Timeout')
+            if self.headers is None:
+                raise self.error
+            return self.status, self.headers
+
+    def read1(self, amt: int = None) -> bytes:
+        """
+        读取已收到的数据, 没有时等待
+        :param amt:
+        :return: 响应体结束时返回b''
+        """
+        try:
+            with self.cond:
+                if not self.cond.wait_for(self._readable, self.timeout):
+                    raise socket.timeout('HTTP/2 Read Timeout')
+                data = self._take(amt)
+        except BaseException:
+            self.close()
+            raise
+        if data:
+            self.conn.flush()
+        else:
+            self.release('complete')
+        return data
+
+    def read(self, amt: int = None) -> bytes:
+        buffer = bytearray()
+        while amt is None or len(buffer) < amt:
+            data = self.read1(None if amt is None else amt - len(buffer))
+            if not data:
+                break
+            buffer += data
+        return bytes(buffer)
+
+    def _take(self, amt: int = None) -> bytes:
+        if not self.chunks:
+            if self.error is not None:
+                raise self.error
+            return b''
+        data, flow = self.chunks[0]
+        if amt is None or amt >= len(data):
+            self.chunks.popleft()
+        else:
+            self.chunks[0] = (data[amt:], 0)
+            data = data[:amt]
+        if flow:
+            self.conn.ack(self.stream_id, flow)
+        return data
+
+    async def response_async(self, timeout: float = None) -> Tuple[int, Headers]:
+        await self._wait_async(self._has_response, timeout)
+        return self.response(0)
+
+    async def read_async(self) -> bytes:
+        await self._wait_async(self._readable, self.timeout)
+        return self.read1()
+
+    async def _wait_async(self, predicate, timeout: float = None):
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            with self.cond:
+                if predicate():
+                    return
+                future = loop.create_future()
+                self.waiter = (loop, future)
+            remaining = None if deadline is None else deadline - loop.time()
+            if remaining is not None and remaining <= 0:
+                raise socket.timeout('HTTP/2 Read Timeout')
+            try:
+                await asyncio.wait_for(future, remaining)
+            except asyncio.TimeoutError:
+                raise socket.timeout('HTTP/2 Read Timeout') from None
+
+    @property
+    def closed(self) -> bool:
+        return self.released
+
+    def isclosed(self) -> bool:
+        return self.released
+
+    def close(self):
+        """提前关闭: 响应未结束时重置流"""
+        if self.released:
+            return
+        if not self.ended and self.error is None:
+            self.conn.cancel(self.stream_id)
+            self.release('cancelled')
+        else:
+            self.release('complete' if self.error is None else 'failed')
+
+    def release(self, result: str):
+        if self.released:
+            return
+        self.released = True
+        STREAMS.inc('failed' if self.error is not None else result)
+        self.conn.release(self)
+
+
+class Connection:
+    """
+    一个HTTP/2连接: h2状态由lock保护, socket只由I/O线程读写
+    """
+
+    def __init__(self, origin: 'Origin', sock: ssl.SSLSocket, conf: PoolConf):
+        self.origin = origin
+        self.sock = sock
+        self.lock = threading.Lock()
+        # 等待发送窗口或写缓冲
+        self.writable = threading.Condition(self.lock)
+        self.h2 = h2.connection.H2Connection(h2.config.H2Configuration(client_side=True, header_encoding=None))
+        self.streams: Dict[int, Stream] = {}
+        # 已分配的流数(含正在发送请求头的)
+        self.active = 0
+        self.max_streams = max(conf.http2.max_streams, 1)
+        self.idle_timeout = conf.idle_timeout
+        self.outbound = bytearray()
+        # closed: 不再分配新的流(GOAWAY/出错/空闲); dead: socket已关闭
+        self.closed = False
+        self.dead = False
+        # 收到上游的SETTINGS前并发流数未知, 只分配一个流
+        self.settled = False
+        self.events = 0
+        self.session_saved = False
+        self.last_used = time.monotonic()
+        self.h2.initiate_connection()
+        self.h2.update_settings({h2.settings.SettingCodes.ENABLE_PUSH: 0,
+                                 h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: conf.http2.window_size})
+        self.h2.increment_flow_control_window(CONNECTION_WINDOW - 65535)
+
+    def _limit(self) -> int:
+        if not self.settled:
+            return 1
+        return min(self.max_streams, self.h2.remote_settings.max_concurrent_streams)
+
+    def reserve(self) -> bool:
+        with self.lock:
+            if self.closed or self.active >= self._limit():
+                return False
+            self.active += 1
+            return True
+
+    def capacity(self) -> int:
+        with self.lock:
+            if self.closed:
+                return 0
+            return self._limit() - self.active
+
+    def request(self, headers: Headers, body, timeout: float = None) -> Stream:
+        """
+        在已reserve的连接上发送请求
+        :param headers: 含伪header
+        :param body: bytes/文件/可迭代对象/None
+        :param timeout:
+        :return:
+        """
+        try:
+            with self.lock:
+                if self.closed:
+                    raise RefusedStream('HTTP/2 Connection Closed')
+                stream = Stream(self, self.h2.get_next_available_stream_id(), timeout)
+                try:
+                    self.h2.send_headers(stream.stream_id, headers, end_stream=body is None)
+                except h2.exceptions.TooManyStreamsError as e:
+                    # 上游调低了并发流数
+                    raise RefusedStream(f'HTTP/2 Too Many Streams: {e}') from e
+                self.streams[stream.stream_id] = stream
+        except BaseException:
+            self.release(None)
+            raise
+        self.flush()
+        if body is not None:
+            try:
+                self.send_body(stream, body, timeout)
+            except BaseException:
+                stream.close()
+                raise
+        return stream
+
+    def send_body(self, stream: Stream, body, timeout: float = None):
+        """
+        按流量控制窗口发送请求体
+        :param stream:
+        :param body:
+        :param timeout:
+        :return:
+        """
+        sid = stream.stream_id
+        for data in iter_chunks(body):
+            view = memoryview(data)
+            while view:
+                with self.lock:
+                    if not self.writable.wait_for(lambda: self._can_send(stream), timeout):
+                        raise socket.timeout('HTTP/2 Send Timeout')
+                    if stream.error is not None or stream.ended:
+                        # 上游已响应并关闭流, 不再需要请求体
+                        return
+                    if self.dead:
+                        raise ConnectionError('HTTP/2 Connection Closed')
+                    size = min(len(view), self.h2.local_flow_control_window(sid), self.h2.max_outbound_frame_size)
+                    self.h2.send_data(sid, view[:size].tobytes())
+                view = view[size:]
+                self.flush()
+        with self.lock:
+            if stream.error is None and not stream.ended and not self.dead:
+                self.h2.end_stream(sid)
+        self.flush()
+
+    def _can_send(self, stream: Stream) -> bool:
+        if self.dead or stream.error is not None or stream.ended:
+            return True
+        try:
+            return self.h2.local_flow_control_window(stream.stream_id) > 0 and len(self.outbound) < OUTBOUND_LIMIT
+        except h2.exceptions.StreamClosedError:
+            stream.ended = True
+            return True
+
+    def ack(self, stream_id: int, size: int):
+        """持有锁时调用: 归还接收窗口"""
+        if not self.dead:
+            self.h2.acknowledge_received_data(size, stream_id)
+
+    def cancel(self, stream_id: int):
+        with self.lock:
+            if not self.dead:
+                try:
+                    self.h2.reset_stream(stream_id, h2.errors.ErrorCodes.CANCEL)
+                except h2.exceptions.StreamClosedError:
+                    pass
+        self.flush()
+
+    def release(self, stream: Optional[Stream]):
+        with self.lock:
+            if stream is not None:
+                self.streams.pop(stream.stream_id, None)
+            self.active -= 1
+            self.last_used = time.monotonic()
+            done = self.closed and not self.active
+        self.origin.notify()
+        if done:
+            self.flush()
+
+    def flush(self):
+        reactor.flush(self)
+
+    # ---------- 以下由I/O线程调用 ----------
+
+    def on_readable(self):
+        for _ in range(16):
+            try:
+                data = self.sock.recv(READ_SIZE)
+            except (ssl.SSLWantReadError, ssl.SSLWantWriteError, BlockingIOError):
+                return
+            except OSError as e:
+                self.fail(e)
+                return
+            if not data:
+                self.fail(ConnectionError('HTTP/2 Connection Closed By Upstream'))
+                return
+            settled = self.settled
+            with self.lock:
+                try:
+                    events = self.h2.receive_data(data)
+                except h2.exceptions.ProtocolError as e:
+                    self.outbound += self.h2.data_to_send()
+                    events = None
+                    error = e
+                if events is not None:
+                    for event in events:
+                        self.dispatch(event)
+            if events is None:
+                self.fail(ConnectionError(f'HTTP/2 Protocol Error: {error}'))
+                return
+            if self.settled and not settled:
+                # 可以分配更多的流, 唤醒等待的请求
+                self.origin.notify()
+            self.save_session()
+            if not self.sock.pending():
+                return
+
+    def dispatch(self, event):
+        """持有锁时处理h2事件"""
+        stream = self.streams.get(getattr(event, 'stream_id', None) or 0)
+        if isinstance(event, h2.events.ResponseReceived):
+            if stream is not None:
+                headers = [(k.decode('latin-1'), v.decode('latin-1')) for k, v in event.headers]
+                stream.status = int(next(v for k, v in headers if k == ':status'))
+                stream.headers = [(k, v) for k, v in headers if not k.startswith(':')]
+                stream.notify()
+        elif isinstance(event, h2.events.DataReceived):
+            if stream is not None:
+                stream.chunks.append((event.data, event.flow_controlled_length))
+                stream.notify()
+            else:
+                # 已取消的流
+                self.h2.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, h2.events.StreamEnded):
+            if stream is not None:
+                stream.ended = True
+                stream.notify()
+                self.writable.notify_all()
+        elif isinstance(event, h2.events.StreamReset):
+            if stream is not None:
+                error = RefusedStream if event.error_code == h2.errors.ErrorCodes.REFUSED_STREAM else ConnectionError
+                stream.error = error(f'HTTP/2 Stream Reset: {event.error_code!r}')
+                stream.notify()
+                self.writable.notify_all()
+        elif isinstance(event, (h2.events.WindowUpdated, h2.events.RemoteSettingsChanged)):
+            if isinstance(event, h2.events.RemoteSettingsChanged):
+                self.settled = True
+            self.writable.notify_all()
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            # GOAWAY: 已处理的流继续, 其余失败, 不再分配新的流
+            self.closed = True
+            for sid, s in self.streams.items():
+                if event.last_stream_id is None or sid > event.last_stream_id:
+                    s.error = RefusedStream(f'HTTP/2 GOAWAY: {event.error_code!r}')
+                    s.notify()
+            self.writable.notify_all()
+
+    def save_session(self):
+        """保存TLS会话(TLS 1.3收到ticket后), 重新连接时恢复"""
+        if self.session_saved:
+            return
+        session = self.sock.session
+        if session is None or (self.sock.version() == 'TLSv1.3' and not session.has_ticket):
+            return
+        self.session_saved = True
+        self.origin.session = (self.sock.context, session)
+
+    def on_writable(self) -> bool:
+        """
+        写出h2的数据
+        :return: 是否还有数据没有写出
+        """
+        with self.lock:
+            if self.dead:
+                return False
+            self.outbound += self.h2.data_to_send()
+            while self.outbound:
+                try:
+                    sent = self.sock.send(self.outbound[:READ_SIZE])
+                except (ssl.SSLWantWriteError, ssl.SSLWantReadError, BlockingIOError):
+                    break
+                except OSError as e:
+                    error = e
+                    break
+                del self.outbound[:sent]
+            else:
+                error = None
+            if len(self.outbound) < OUTBOUND_LIMIT:
+                self.writable.notify_all()
+            pending = bool(self.outbound)
+        if error is not None:
+            self.fail(error)
+            return False
+        return pending
+
+    def fail(self, error: Exception):
+        """连接出错: 未完成的流失败"""
+        with self.lock:
+            self.closed = True
+            for stream in self.streams.values():
+                if not stream.ended and stream.error is None:
+                    stream.error = error if isinstance(error, OSError) else ConnectionError(str(error))
+                    stream.notify()
+            self.writable.notify_all()
+        logger.debug(f'HTTP/2 {self.origin.host}:{self.origin.port}: {error}')
+        self.shutdown(graceful=False)
+
+    def shutdown(self, graceful: bool = True):
+        with self.lock:
+            if self.dead:
+                return
+            self.closed = True
+            if graceful:
+                try:
+                    self.h2.close_connection()
+                    self.sock.send(self.h2.data_to_send())
+                except (OSError, h2.exceptions.ProtocolError):
+                    pass
+            self.dead = True
+            self.writable.notify_all()
+        self.sock.close()
+        self.origin.remove(self)
+
+    def idle(self, now: float) -> bool:
+        return not self.active and (self.closed or now - self.last_used > self.idle_timeout)
+
+
+class Reactor:
+    """
+    所有HTTP/2上游连接的I/O线程: 非阻塞读写socket
+    同一个TLS连接不能在多个线程同时读写, 请求线程只修改h2状态, 由该线程写出
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.selector: Optional[selectors.BaseSelector] = None
+        self.waker: Optional[Tuple[socket.socket, socket.socket]] = None
+        self.added: List[Connection] = []
+        self.pending = set()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self.thread = None
+        self.selector = None
+        self.waker = None
+        self.added = []
+        self.pending = set()
+
+    def ensure(self):
+        if self.thread is not None:
+            return
+        with self._lock:
+            if self.thread is None:
+                self.selector = selectors.DefaultSelector()
+                self.waker = socket.socketpair()
+                for sock in self.waker:
+                    sock.setblocking(False)
+                self.selector.register(self.waker[0], selectors.EVENT_READ)
+                self.thread = threading.Thread(target=self.run, name='Http2Upstream', daemon=True)
+                self.thread.start()
+
+    def add(self, conn: Connection):
+        self.ensure()
+        with self._lock:
+            self.added.append(conn)
+        self._wake()
+
+    def flush(self, conn: Connection):
+        with self._lock:
+            self.pending.add(conn)
+        self._wake()
+
+    def _wake(self):
+        try:
+            self.waker[1].send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def run(self):
+        connections = set()
+        last_sweep = time.monotonic()
+        while True:
+            touched = set()
+            for key, mask in self.selector.select(SWEEP_INTERVAL):
+                conn = key.data
+                if conn is None:
+                    try:
+                        while key.fileobj.recv(4096):
+                            pass
+                    except (BlockingIOError, OSError):
+                        pass
+                    continue
+                if mask & selectors.EVENT_READ:
+                    conn.on_readable()
+                touched.add(conn)
+            with self._lock:
+                added, self.added = self.added, []
+                pending, self.pending = self.pending, set()
+            for conn in added:
+                if not conn.dead:
+                    conn.events = selectors.EVENT_READ
+                    self.selector.register(conn.sock, conn.events, conn)
+                    connections.add(conn)
+            touched.update(added, pending)
+            now = time.monotonic()
+            if now - last_sweep >= SWEEP_INTERVAL:
+                last_sweep = now
+                touched.update(c for c in connections if c.idle(now))
+            for conn in touched:
+                if conn in connections:
+                    self._update(conn, connections, now)
+
+    def _update(self, conn: Connection, connections: set, now: float):
+        if not conn.dead and conn.idle(now):
+            conn.shutdown()
+        if conn.dead:
+            connections.discard(conn)
+            try:
+                self.selector.unregister(conn.sock)
+            except (KeyError, ValueError, OSError):
+                pass
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if conn.on_writable() else 0)
+        if conn.dead:
+            self._update(conn, connections, now)
+        elif events != conn.events:
+            conn.events = events
+            self.selector.modify(conn.sock, events, conn)
+
+
+reactor = Reactor()
+
+
+class Origin:
+    """一个HTTPS上游(host/port)的HTTP/2连接及TLS会话"""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.cond = threading.Condition()
+        self.connections: List[Connection] = []
+        self.connecting = 0
+        # 协商为HTTP/1.1时, 在该时间之前不再尝试HTTP/2
+        self.http1_until = 0.0
+        # (SSLContext, SSLSession)
+        self.session: Optional[Tuple[ssl.SSLContext, ssl.SSLSession]] = None
+
+    def notify(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def remove(self, conn: Connection):
+        with self.cond:
+            if conn in self.connections:
+                self.connections.remove(conn)
+            self.cond.notify_all()
+
+    def multiplexed(self) -> bool:
+        return bool(self.connections) and self.http1_until <= time.monotonic()
+
+
+class Pool:
+    """
+    HTTP/2上游连接: 每个上游最多max_connections个连接, 每个连接最多max_streams个并发流
+    TLS握手时通过ALPN协商, 上游选择HTTP/1.1时返回None由调用方使用HTTP/1.1
+    """
+
+    def __init__(self, conf: PoolConf = None):
+        self._lock = threading.Lock()
+        self.origins: Dict[Tuple[str, int], Origin] = {}
+        self.contexts: Dict[Tuple[Union[bool, str], bool], ssl.SSLContext] = {}
+        self.configure(conf or PoolConf())
+
+    def configure(self, conf: PoolConf):
+        self.conf = conf
+        self.enabled = bool(conf.http2.enabled and h2 is not None)
+        # 上游证书校验: CA文件/目录, 或是否校验
+        self.verify: Union[bool, str] = conf.http2.ca_file or bool(conf.http2.verify)
+        if conf.http2.enabled and h2 is None:
+            logger.warning('HTTP/2 Upstream Disabled: h2 Not Installed')
+
+    def origin(self, url: str, create: bool = False) -> Optional[Origin]:
+        url_parts = urllib3.util.parse_url(url)
+        if (url_parts.scheme or '').lower() != 'https' or not url_parts.host:
+            return None
+        key = (url_parts.host.lower(), url_parts.port or 443)
+        origin = self.origins.get(key)
+        if origin is None and create:
+            with self._lock:
+                origin = self.origins.get(key)
+                if origin is None:
+                    origin = self.origins[key] = Origin(*key)
+        return origin
+
+    def multiplexed(self, url: str) -> bool:
+        """
+        上游是否已协商HTTP/2(并发由流数限制)
+        :param url:
+        :return:
+        """
+        if not self.enabled:
+            return False
+        origin = self.origin(url)
+        return origin is not None and origin.multiplexed()
+
+    def open(self, method: str, url: str, headers: Mapping[str, str], body=None, timeout: float = None,
+             verify: Union[bool, str] = None) -> Optional[Stream]:
+        """
+        发送请求
+        :param method:
+        :param url:
+        :param headers:
+        :param body: bytes/文件/可迭代对象/None
+        :param timeout: 连接/发送的超时, 也用于读取
+        :param verify: 是否校验证书, 或CA文件/目录, 默认使用配置
+        :return: 上游不支持HTTP/2时返回None
+        """
+        verify = self.verify if verify is None else verify
+        origin = self.origin(url, create=True)
+        if origin is None or origin.http1_until > time.monotonic():
+            return None
+        conn = self._acquire(origin, verify, timeout)
+        if conn is None:
+            return None
+        url_parts = urllib3.util.parse_url(url)
+        return conn.request(request_headers(method, url_parts, headers), body, timeout)
+
+    def _acquire(self, origin: Origin, verify: Union[bool, str], timeout: float = None) -> Optional[Connection]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with origin.cond:
+            while True:
+                if origin.http1_until > time.monotonic():
+                    return None
+                for conn in sorted(origin.connections, key=Connection.capacity, reverse=True):
+                    if conn.reserve():
+                        return conn
+                if len(origin.connections) + origin.connecting < max(self.conf.http2.max_connections, 1):
+                    origin.connecting += 1
+                    break
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0 or not origin.cond.wait(remaining):
+                    raise socket.timeout(f'HTTP/2 Streams Exhausted: {origin.host}:{origin.port}')
+        conn = None
+        try:
+            conn = self._connect(origin, verify, timeout)
+            conn is not None and conn.reserve()
+        finally:
+            with origin.cond:
+                origin.connecting -= 1
+                if conn is not None:
+                    origin.connections.append(conn)
+                origin.cond.notify_all()
+        return conn
+
+    def _connect(self, origin: Origin, verify: Union[bool, str], timeout: float = None) -> Optional[Connection]:
+        context = self.context(verify)
+        session = origin.session[1] if origin.session and origin.session[0] is context else None
+        sock = dns.create_connection((origin.host, origin.port), timeout=timeout)
+        try:
+            sock = context.wrap_socket(sock, server_hostname=origin.host, session=session)
+        except BaseException:
+            sock.close()
+            raise
+        protocol = sock.selected_alpn_protocol() or 'http/1.1'
+        CONNECTIONS.inc(protocol, 'resumed' if sock.session_reused else 'full')
+        if protocol != 'h2':
+            sock.close()
+            origin.http1_until = time.monotonic() + HTTP1_RECHECK
+            logger.info(f'HTTP/2 {origin.host}:{origin.port}: ALPN {protocol}, Use HTTP/1.1')
+            return None
+        sock.setblocking(False)
+        conn = Connection(origin, sock, self.conf)
+        reactor.add(conn)
+        return conn
+
+    def context(self, verify: Union[bool, str], alpn: bool = True) -> ssl.SSLContext:
+        """
+        按证书校验方式共享SSLContext(TLS会话只能在同一个context中恢复)
+        :param verify:
+        :param alpn: 是否协商h2, 否则只用于HTTP/1.1
+        :return:
+        """
+        key = (verify if isinstance(verify, str) else bool(verify), alpn)
+        context = self.contexts.get(key)
+        if context is not None:
+            return context
+        with self._lock:
+            context = self.contexts.get(key)
+            if context is None:
+                if isinstance(verify, str):
+                    context = ssl.create_default_context(cafile=None if os.path.isdir(verify) else verify,
+                                                         capath=verify if os.path.isdir(verify) else None)
+                else:
+                    context = ssl.create_default_context()
+                    if not verify:
+                        context.check_hostname = False
+                        context.verify_mode = ssl.CERT_NONE
+                alpn and context.set_alpn_protocols(ALPN)
+                self.contexts[key] = context
+        return context
+
+    def fallback_ssl(self) -> Union[bool, ssl.SSLContext]:
+        """
+        HTTP/1.1回退请求(aiohttp)的ssl参数, 与HTTP/2使用相同的证书校验
+        :return:
+        """
+        if self.verify is True:
+            return True
+        return self.context(self.verify, alpn=False) if self.verify else False
+
+    def stats(self) -> dict:
+        with self._lock:
+            origins = list(self.origins.values())
+        now = time.monotonic()
+        connections = [c for o in origins for c in list(o.connections)]
+        return {
+            'origins': sum(1 for o in origins if o.connections),
+            'http1_origins': sum(1 for o in origins if o.http1_until > now),
+            'connections': len(connections),
+            'streams': sum(c.active for c in connections),
+        }
+
+
+def request_headers(method: str, url_parts: urllib3.util.Url, headers: Mapping[str, str]) -> Headers:
+    """
+    HTTP/2请求头: 伪header在前, 名称小写, 去掉连接相关的header
+    :param method:
+    :param url_parts:
+    :param headers:
+    :return:
+    """
+    authority = url_parts.host if not url_parts.port or url_parts.port == 443 else f'{url_parts.host}:{url_parts.port}'
+    result = [(':method', method), (':scheme', 'https'), (':authority', authority),
+              (':path', url_parts.request_uri)]
+    for name, value in headers.items():
+        name = name.lower()
+        if name not in CONNECTION_HEADERS and value is not None:
+            result.append((name, value))
+    return result
+
+
+def body_position(body) -> Optional[int]:
+    """
+    可重放的请求体的起始位置
+    :param body:
+    :return: bytes/None为0, 可seek的文件为当前位置, 迭代器为None
+    """
+    if body is None or isinstance(body, (bytes, bytearray, memoryview, str)):
+        return 0
+    try:
+        return body.tell() if hasattr(body, 'seek') else None
+    except OSError:
+        return None
+
+
+def rewind(body, position: Optional[int]) -> bool:
+    """
+    重试前回到请求体的起始位置
+    :param body:
+    :param position: body_position的返回值
+    :return: 无法重放时返回False
+    """
+    if position is None:
+        return False
+    if hasattr(body, 'seek'):
+        body.seek(position)
+    return True
+
+
+def iter_chunks(body: Union[bytes, str, BinaryIO, Iterable[bytes]], size: int = READ_SIZE) -> Iterable[bytes]:
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    if isinstance(body, (bytes, bytearray, memoryview)):
+        return (body,)
+    if hasattr(body, 'read'):
+        return iter(lambda: body.read(size), b'')
+    return body
+
+
+pool = Pool()
+
+metrics.GaugeFunc('caul_upstream_h2', 'HTTP/2 upstream connections and open streams',
+                  lambda: metrics.flatten(pool.stats()) if pool.enabled else {}, ('stat',))
+
+
+def split_timeout(timeout) -> Tuple[Optional[float], Optional[float]]:
+    """requests的timeout: 数值或(connect, read)"""
+    if isinstance(timeout, tuple):
+        return timeout[0], timeout[1]
+    return timeout, timeout
+
+
+class H2Adapter(HTTPAdapter):
+    """
+    requests的传输: HTTPS上游协商为h2时通过HTTP/2多路复用发送, 否则使用HTTP/1.1连接池
+    响应体包装为urllib3的HTTPResponse, 解压/原样转发/缓存与HTTP/1.1一致
+    """
+
+    def send(self, request: requests.PreparedRequest, stream: bool = False, timeout=None, verify=True, cert=None,
+             proxies=None) -> requests.Response:
+        if not pool.enabled or cert or proxies and any(proxies.values()):
+            return super().send(request, stream, timeout, verify, cert, proxies)
+        connect_timeout, read_timeout = split_timeout(timeout)
+        # 未指定时(requests默认True)使用配置的证书校验, HTTP/1.1回退相同
+        if verify is True:
+            verify = pool.verify
+        position = body_position(request.body)
+        h2_stream = None
+        for _ in range(REFUSED_RETRIES + 1):
+            try:
+                h2_stream = pool.open(request.method, request.url, request.headers, request.body, connect_timeout,
+                                      verify)
+                if h2_stream is not None:
+                    h2_stream.timeout = read_timeout
+                    status, headers = h2_stream.response(read_timeout)
+                break
+            except BaseException as e:
+                # 未收到响应头(流被重置/超时): 关闭流, 归还连接的并发数
+                h2_stream is not None and h2_stream.close()
+                h2_stream = None
+                # 上游未处理的流: 重试, 仍被拒绝时使用HTTP/1.1
+                if isinstance(e, RefusedStream) and rewind(request.body, position):
+                    continue
+                if isinstance(e, OSError):
+                    raise self.error(e, request) from e
+                raise
+        if h2_stream is None:
+            return super().send(request, stream, timeout, verify, cert, proxies)
+        header_dict = HTTPHeaderDict()
+        for name, value in headers:
+            header_dict.add(name, value)
+        raw = urllib3.response.HTTPResponse(
+            body=h2_stream, headers=header_dict, status=status, version=20, version_string='HTTP/2',
+            reason=http.client.responses.get(status, ''), preload_content=False, decode_content=False,
+            request_method=request.method, request_url=request.url)
+        response = self.build_response(request, raw)
+        if not stream:
+            try:
+                response.content
+            finally:
+                h2_stream.close()
+        return response
+
+    @staticmethod
+    def error(e: OSError, request: requests.PreparedRequest) -> requests.exceptions.RequestException:
+        """
+        转换为requests的异常
+        :param e:
+        :param request:
+        :return:
+        """
+        if isinstance(e, socket.timeout):
+            return requests.exceptions.Timeout(e, request=request)
+        if isinstance(e, ssl.SSLError):
+            return requests.exceptions.SSLError(e, request=request)
+        return requests.exceptions.ConnectionError(e, request=request)
@@ -0,0 +1,327 @@
+import asyncio
+import bisect
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from caul_proxy.config import Admin, logger
+
+# 默认延迟分桶(秒)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Registry:
+    """
+    指标注册表: 每个线程写自己的分片(无锁), 采集时合并
+    已结束线程的分片合并到retired后释放
+    """
+
+    def __init__(self):
+        self.metrics: List['Metric'] = []
+        self._local = threading.local()
+        self._shards: List[Tuple[threading.Thread, dict]] = []
+        self._retired: dict = {}
+        self._lock = threading.Lock()
+        if hasattr(os, 'register_at_fork'):
+            # worker进程从空的分片开始计数
+            os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        self._local = threading.local()
+        self._shards = []
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: 'Metric') -> 'Metric':
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def shard(self) -> dict:
+        try:
+            return self._local.shard
+        except AttributeError:
+            return self._new_shard()
+
+    def _new_shard(self) -> dict:
+        shard = self._local.shard = {}
+        with self._lock:
+            self._shards.append((threading.current_thread(), shard))
+            # 每个连接一个线程的引擎, 及时回收已结束线程的分片
+            if len(self._shards) > max(64, 2 * threading.active_count()):
+                self._retire()
+        return shard
+
+    def _retire(self):
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                merge(self._retired, shard)
+        self._shards = alive
+
+    def collect(self) -> dict:
+        """
+        合并所有分片: {(metric, labels): value}
+        :return:
+        """
+        with self._lock:
+            self._retire()
+            values = {}
+            merge(values, self._retired)
+            for _, shard in self._shards:
+                merge(values, shard.copy())
+        return values
+
+    def snapshot(self) -> Dict['Metric', Dict[tuple, object]]:
+        """
+        按指标分组的当前值, 含GaugeFunc
+        :return: {metric: {labels: value}}
+        """
+        grouped: Dict['Metric', Dict[tuple, object]] = {}
+        for (metric, labels), value in self.collect().items():
+            grouped.setdefault(metric, {})[labels] = value
+        for metric in list(self.metrics):
+            if isinstance(metric, GaugeFunc):
+                try:
+                    grouped[metric] = metric.values()
+                except Exception as e:
+                    logger.warning(f'Metric {metric.name}: {e}')
+        return grouped
+
+    def dump(self) -> list:
+        """
+        可JSON序列化的当前值, worker进程交给supervisor汇总
+        :return: [[name, labels, value]]
+        """
+        return [[metric.name, list(labels), value]
+                for metric, values in self.snapshot().items() for labels, value in values.items()]
+
+    def aggregate(self, dumps: Dict[str, list]) -> Dict['Metric', Dict[tuple, object]]:
+        """
+        汇总各worker的dump: counter/histogram求和, gauge加worker标签
+        :param dumps: {worker: dump()}
+        :return:
+        """
+        by_name = {metric.name: metric for metric in self.metrics}
+        grouped: Dict['Metric', Dict[tuple, object]] = {}
+        for worker, dump in dumps.items():
+            for name, labels, value in dump:
+                metric = by_name.get(name)
+                if metric is None:
+                    continue
+                labels = tuple(labels)
+                values = grouped.setdefault(metric, {})
+                if metric.type == 'gauge':
+                    values[labels + (worker,)] = value
+                else:
+                    merge(values, {labels: value})
+        return grouped
+
+    def expose(self, grouped: Dict['Metric', Dict[tuple, object]] = None, per_worker: bool = False) -> str:
+        """
+        Prometheus文本格式
+        :param grouped: 默认为当前进程的值
+        :param per_worker: gauge带worker标签(aggregate的结果)
+        :return:
+        """
+        if grouped is None:
+            grouped = self.snapshot()
+        lines = []
+        for metric in list(self.metrics):
+            lines.append(f'# HELP {metric.name} {metric.documentation}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            names = metric.labels + ('worker',) if per_worker and metric.type == 'gauge' else metric.labels
+            values = sorted(grouped.get(metric, {}).items(), key=lambda item: item[0])
+            lines.extend(metric.samples(values, names))
+        return '\n'.join(lines) + '\n'
+
+
+def merge(target: dict, source: dict):
+    for key, value in source.items():
+        if isinstance(value, list):
+            current = target.get(key)
+            target[key] = list(value) if current is None else [a + b for a, b in zip(current, value)]
+        else:
+            target[key] = target.get(key, 0) + value
+
+
+REGISTRY = Registry()
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 registry: Registry = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.registry = registry
+        registry.register(self)
+
+    def samples(self, values: List[Tuple[tuple, object]], names: Tuple[str, ...] = None) -> Iterable[str]:
+        names = self.labels if names is None else names
+        for labels, value in values:
+            yield f'{self.name}{format_labels(names, labels)} {format_value(value)}'
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels: str, value: float = 1):
+        shard = self.registry.shard()
+        key = (self, labels)
+        shard[key] = shard.get(key, 0) + value
+
+
+class Gauge(Counter):
+    """可增减的值, 如活动连接数"""
+    type = 'gauge'
+
+    def dec(self, *labels: str, value: float = 1):
+        self.inc(*labels, value=-value)
+
+
+class GaugeFunc(Metric):
+    """
+    采集时计算的值: func返回数值, 或{标签值元组: 数值}
+    """
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, func: Callable[[], Union[float, Dict[tuple, float]]],
+                 labels: Tuple[str, ...] = (), registry: Registry = REGISTRY):
+        self.func = func
+        super().__init__(name, documentation, labels, registry)
+
+    def values(self) -> Dict[tuple, float]:
+        result = self.func()
+        if not isinstance(result, dict):
+            result = {(): result}
+        return result
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS, registry: Registry = REGISTRY):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labels, registry)
+
+    def observe(self, value: float, *labels: str):
+        shard = self.registry.shard()
+        key = (self, labels)
+        data = shard.get(key)
+        if data is None:
+            # 各分桶计数(最后一个为+Inf) + 总和
+            data = shard[key] = [0] * (len(self.buckets) + 2)
+        data[bisect.bisect_left(self.buckets, value)] += 1
+        data[-1] += value
+
+    def samples(self, values: List[Tuple[tuple, object]], names: Tuple[str, ...] = None) -> Iterable[str]:
+        names = self.labels if names is None else names
+        for labels, data in values:
+            count = 0
+            for bound, n in zip(self.buckets + (float('inf'),), data):
+                count += n
+                le = '+Inf' if bound == float('inf') else format_value(bound)
+                yield f'{self.name}_bucket{format_labels(names + ("le",), labels + (le,))} {count}'
+            yield f'{self.name}_sum{format_labels(names, labels)} {format_value(data[-1])}'
+            yield f'{self.name}_count{format_labels(names, labels)} {count}'
+
+
+def flatten(stats: dict, prefix: str = '') -> Dict[tuple, float]:
+    """
+    stats()的结果转为GaugeFunc的值: {('memory_items',): 1}
+    :param stats:
+    :param prefix:
+    :return:
+    """
+    values = {}
+    for key, value in stats.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f'{prefix}{key}_'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[(f'{prefix}{key}',)] = value
+    return values
+
+
+def format_labels(names: Tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{escape(str(value))}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value) -> str:
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+# 各引擎共用的指标
+REQUESTS = Counter('caul_requests_total', 'Requests by engine, method and status',
+                   ('engine', 'method', 'status'))
+UPSTREAM_TTFB = Histogram('caul_upstream_ttfb_seconds', 'Time until upstream response headers', ('engine',))
+REQUEST_DURATION = Histogram('caul_request_duration_seconds', 'Total request latency', ('engine',))
+BYTES = Counter('caul_bytes_total', 'Body/tunnel bytes, up: client to upstream, down: upstream to client',
+                ('engine', 'direction'))
+ACTIVE_CONNECTIONS = Gauge('caul_active_connections', 'Client connections being handled', ('engine',))
+ACTIVE_TUNNELS = Gauge('caul_active_tunnels', 'Open CONNECT/SOCKS5 tunnels', ('engine',))
+REWRITE_HITS = Counter('caul_rewrite_rule_hits_total', 'Rewrite rule matches', ('kind', 'rule'))
+THREADS = GaugeFunc('caul_threads', 'Live threads', threading.active_count)
+# asyncio引擎的事件循环
+LOOPS: List[asyncio.AbstractEventLoop] = []
+TASKS = GaugeFunc('caul_asyncio_tasks', 'Pending asyncio tasks',
+                  lambda: sum(len(asyncio.all_tasks(loop)) for loop in LOOPS if not loop.is_closed()))
+
+
+def watch_loop(loop: asyncio.AbstractEventLoop):
+    """
+    统计事件循环的task数
+    :param loop:
+    :return:
+    """
+    LOOPS.append(loop)
+
+
+class AdminHandler(BaseHTTPRequestHandler):
+    """管理端口: GET /metrics"""
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(code=404)
+            return
+        body = self.server.expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args):
+        pass
+
+
+def serve(conf: Admin, expose: Callable[[], str] = None) -> Optional[ThreadingHTTPServer]:
+    """
+    在后台线程启动管理端口, port为0时不启动
+    :param conf:
+    :param expose: 生成指标文本, 默认为当前进程的REGISTRY
+    :return:
+    """
+    if not conf.port:
+        return None
+    server = ThreadingHTTPServer((conf.host, conf.port), AdminHandler)
+    server.daemon_threads = True
+    server.expose = expose or REGISTRY.expose
+    threading.Thread(target=server.serve_forever, name='AdminServer', daemon=True).start()
+    logger.info(f'Metrics: http://{conf.host}:{conf.port}/metrics')
+    return server
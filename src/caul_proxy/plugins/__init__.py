@@ -3,5 +3,7 @@ from typing import Dict, Type, List
 from caul_proxy.plugins.rewriter import URIRewriter, DomainRewriter
 
 NS_RW_URI: Dict[str, Type[URIRewriter]] = {}
+# plugin_dir中的钩子插件类
+NS_PLUGINS: Dict[str, type] = {}
 CACHE_RW_DOMAIN: List[DomainRewriter] = []
 CACHE_RW_URI: List[URIRewriter] = []
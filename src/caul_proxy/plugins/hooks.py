@@ -0,0 +1,277 @@
+import threading
+import time
+from typing import Dict, List, Optional, Tuple, Callable, Any, Iterable
+
+import urllib3.util
+from requests.structures import CaseInsensitiveDict
+
+from caul_proxy import metrics, util
+from caul_proxy.config import Plugins, logger
+from caul_proxy.plugins import rewriter
+
+HOOK_SECONDS = metrics.Histogram('caul_plugin_seconds', 'Plugin hook latency', ('plugin', 'hook'),
+                                 buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1))
+OVER_BUDGET = metrics.Counter('caul_plugin_over_budget_total', 'Plugin hook calls over the time budget',
+                              ('plugin', 'hook'))
+ERRORS = metrics.Counter('caul_plugin_errors_total', 'Plugin hook calls that raised', ('plugin', 'hook'))
+# 同一插件超预算的日志间隔(秒)
+LOG_INTERVAL = 10
+HOOKS = ('pre_route', 'post_response', 'body_filter')
+
+Headers = List[Tuple[str, str]]
+
+
+class Context:
+    """
+    一次请求的钩子上下文
+    url: 改写前的绝对URL, pre_route可修改; target: 改写后转发的URL
+    headers: 请求头, pre_route可修改; data: 插件保存请求内的状态
+    """
+    __slots__ = ('engine', 'client', 'method', 'url', 'headers', 'target', 'status', 'data')
+
+    def __init__(self, engine: str, client: str, method: str, url: str, headers: Iterable[Tuple[str, str]]):
+        self.engine = engine
+        self.client = client
+        self.method = method
+        self.url = url
+        self.headers = CaseInsensitiveDict(list(headers))
+        self.target: Optional[str] = None
+        self.status: Optional[int] = None
+        self.data: Dict[str, Any] = {}
+
+
+class Plugin:
+    """
+    钩子插件: 放在plugin_dir下, 子类只需重写用到的钩子, 未重写的钩子不会被调用
+    初始化参数为配置plugins.options中的同名项
+    """
+    # 默认为类名
+    name: Optional[str] = None
+
+    def __init__(self, **options):
+        self.options = options
+
+    def pre_route(self, ctx: Context) -> Optional[int]:
+        """
+        改写/转发前调用, 可修改ctx.url和ctx.headers
+        :param ctx:
+        :return: 返回状态码时不再转发, 直接以该状态码响应
+        """
+
+    def post_response(self, ctx: Context, status: int, headers: Headers):
+        """
+        发送响应头前调用, 可修改headers
+        :param ctx:
+        :param status:
+        :param headers: 发送给客户端的响应头(name, value)列表
+        :return:
+        """
+
+    def body_filter(self, ctx: Context, data: bytes, end: bool) -> bytes:
+        """
+        过滤响应体(原样转发时为编码后的字节), 结束时以end=True再调用一次
+        :param ctx:
+        :param data:
+        :param end:
+        :return: 发送给客户端的数据
+        """
+        return data
+
+
+class Guard:
+    """
+    插件调用计时: 超出预算时记录日志, 连续超预算bypass_after次后跳过该插件bypass_seconds秒
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.budget = 0.0
+        self.bypass_after = 0
+        self.bypass_seconds = 0.0
+        # 各钩子连续超预算的次数
+        self.overruns: Dict[str, int] = {}
+        self.bypassed_until = 0.0
+        self.bypasses = 0
+        self.last_log = 0.0
+        self._lock = threading.Lock()
+
+    def configure(self, conf: Plugins):
+        self.budget = conf.budgets.get(self.name, conf.budget_ms) / 1000
+        self.bypass_after = conf.bypass_after
+        self.bypass_seconds = conf.bypass_seconds
+
+    def active(self) -> bool:
+        return not self.bypassed_until or time.monotonic() >= self.bypassed_until
+
+    def call(self, hook: str, func: Callable, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        except Exception as e:
+            ERRORS.inc(self.name, hook)
+            if self.should_log():
+                logger.error(f'Plugin {self.name}.{hook}: {util.err_msg(e)}')
+            raise
+        finally:
+            self.observe(hook, time.perf_counter() - start)
+
+    def observe(self, hook: str, elapsed: float):
+        HOOK_SECONDS.observe(elapsed, self.name, hook)
+        if not self.budget or elapsed <= self.budget:
+            if self.overruns.get(hook):
+                self.overruns[hook] = 0
+            return
+        OVER_BUDGET.inc(self.name, hook)
+        with self._lock:
+            overruns = self.overruns[hook] = self.overruns.get(hook, 0) + 1
+            bypass = self.bypass_after and overruns >= self.bypass_after
+            if bypass:
+                self.overruns[hook] = 0
+                self.bypasses += 1
+                self.bypassed_until = time.monotonic() + self.bypass_seconds
+        if bypass:
+            logger.warning(f'Plugin {self.name}.{hook}: {elapsed * 1000:.2f}ms > {self.budget * 1000:.2f}ms, '
+                           f'Bypass For {self.bypass_seconds}s')
+        elif self.should_log():
+            logger.warning(f'Plugin {self.name}.{hook}: {elapsed * 1000:.2f}ms > {self.budget * 1000:.2f}ms')
+
+    def should_log(self) -> bool:
+        now = time.monotonic()
+        if now - self.last_log < LOG_INTERVAL:
+            return False
+        self.last_log = now
+        return True
+
+
+# 插件名称 -> Guard, 重新加载时保留计数
+GUARDS: Dict[str, Guard] = {}
+CONF = Plugins()
+_guards_lock = threading.Lock()
+
+
+def guard(name: str) -> Guard:
+    with _guards_lock:
+        g = GUARDS.get(name)
+        if g is None:
+            g = GUARDS[name] = Guard(name)
+            g.configure(CONF)
+        return g
+
+
+def configure(conf: Plugins):
+    """
+    更新所有插件的预算
+    :param conf:
+    :return:
+    """
+    global CONF
+    with _guards_lock:
+        CONF = conf
+        for g in GUARDS.values():
+            g.configure(conf)
+
+
+metrics.GaugeFunc('caul_plugin_bypassed', 'Plugins currently bypassed for exceeding their budget',
+                  lambda: {(name,): 0 if g.active() else 1 for name, g in list(GUARDS.items())}, ('plugin',))
+
+
+class BodyFilter:
+    """一个响应的body_filter链"""
+
+    def __init__(self, ctx: Context, filters: List[Tuple[Plugin, Guard]]):
+        self.ctx = ctx
+        self.filters = filters
+
+    def filter(self, data: bytes, end: bool = False) -> bytes:
+        for plugin, g in self.filters:
+            data = g.call('body_filter', plugin.body_filter, self.ctx, data, end)
+        return data
+
+    def flush(self) -> bytes:
+        return self.filter(b'', True)
+
+
+class Hooks:
+    """
+    插件钩子, 随改写规则快照(runner.Rules)整体替换
+    pre_route/post_response出错时记录日志并跳过该插件; body_filter出错时中断响应
+    """
+
+    def __init__(self, plugins: List[Plugin] = None, conf: Plugins = None):
+        self.plugins = list(plugins or [])
+        self.conf = conf or Plugins()
+        self.hooks: Dict[str, List[Tuple[Plugin, Guard]]] = {
+            hook: [(p, guard(p.name)) for p in self.plugins if overrides(p, hook)] for hook in HOOKS}
+
+    def __bool__(self):
+        return bool(self.plugins)
+
+    def pre_route(self, ctx: Context) -> Optional[int]:
+        """
+        :param ctx:
+        :return: 插件返回的状态码
+        """
+        for plugin, g in self.hooks['pre_route']:
+            if not g.active():
+                continue
+            try:
+                status = g.call('pre_route', plugin.pre_route, ctx)
+            except Exception:
+                continue
+            if status:
+                return status
+        return None
+
+    def post_response(self, ctx: Context, status: int, headers: Headers):
+        ctx.status = status
+        for plugin, g in self.hooks['post_response']:
+            if not g.active():
+                continue
+            try:
+                g.call('post_response', plugin.post_response, ctx, status, headers)
+            except Exception:
+                continue
+
+    def body_filter(self, ctx: Context, method: str, status: int) -> Optional[BodyFilter]:
+        """
+        本次响应的body_filter链, 没有响应体或没有启用的插件时返回None
+        :param ctx:
+        :param method:
+        :param status:
+        :return:
+        """
+        if method == 'HEAD' or status < 200 or status in (204, 304):
+            return None
+        filters = [(plugin, g) for plugin, g in self.hooks['body_filter'] if g.active()]
+        return BodyFilter(ctx, filters) if filters else None
+
+
+def overrides(plugin: Plugin, hook: str) -> bool:
+    return getattr(type(plugin), hook) is not getattr(Plugin, hook)
+
+
+class TimedRewriter(rewriter.URIRewriter):
+    """
+    计时plugin_dir中的rewriter, 跳过时视为不匹配
+    只在改写缓存未命中时调用
+    """
+
+    def __init__(self, inner: rewriter.URIRewriter, g: Guard):
+        self.inner = inner
+        self.guard = g
+        self.by_url = inner.by_url
+        self.pattern, self.replace, self.rex, self.segments = inner.pattern, inner.replace, None, None
+
+    def target(self, url: urllib3.util.Url) -> str:
+        return self.inner.target(url)
+
+    def target_key(self) -> str:
+        return self.inner.target_key()
+
+    def match(self, url: urllib3.util.Url) -> bool:
+        if not self.guard.active():
+            return False
+        return self.guard.call('match', self.inner.match, url)
+
+    def rewrite(self, url: urllib3.util.Url) -> str:
+        return self.guard.call('rewrite', self.inner.rewrite, url)
@@ -1,47 +1,184 @@
 import re
 from abc import abstractmethod
+from typing import List, Union, Optional, Tuple, Dict
 
 import urllib3
 
+from caul_proxy import balancer
+
+# 模板片段: 字符串原样输出, int为分组序号
+Segment = Union[str, int]
+
+
+def parse_template(template: str, rex: re.Pattern) -> List[Segment]:
+    """
+    预解析替换模板: $name为命名分组, $i为第i+1个分组
+    :param template:
+    :param rex:
+    :return:
+    """
+    names = sorted(rex.groupindex.keys(), key=len, reverse=True)
+    segments: List[Segment] = []
+    literal = []
+    i = 0
+    while i < len(template):
+        char = template[i]
+        group, size = None, 0
+        if char == '$':
+            rest = template[i + 1:]
+            name = next((n for n in names if rest.startswith(n)), None)
+            if name:
+                group, size = rex.groupindex[name], len(name)
+            else:
+                digits = re.match(r'\d+', rest)
+                # 取不超过分组数的最长序号
+                while digits and digits.group():
+                    if int(digits.group()) < rex.groups:
+                        group, size = int(digits.group()) + 1, len(digits.group())
+                        break
+                    digits = re.match(r'\d+', digits.group()[:-1])
+        if group is None:
+            literal.append(char)
+            i += 1
+            continue
+        if literal:
+            segments.append(''.join(literal))
+            literal = []
+        segments.append(group)
+        i += 1 + size
+    if literal:
+        segments.append(''.join(literal))
+    return segments
+
+
+def render(segments: List[Segment], res: re.Match) -> str:
+    return ''.join(s if isinstance(s, str) else (res.group(s) or '') for s in segments)
+
+
+# 内联flag, 如(?i), 影响字面量匹配
+INLINE_FLAGS = re.compile(r'\(\?[aiLmsux]')
+
+
+def literal_prefix(pattern: str) -> str:
+    """
+    正则开头必须匹配的字面量, 无法确定时返回空
+    :param pattern:
+    :return:
+    """
+    if '|' in pattern or INLINE_FLAGS.search(pattern):
+        return ''
+    p = pattern[1:] if pattern.startswith('^') else pattern
+    out = []
+    i = 0
+    while i < len(p):
+        if p[i] == '\\' and i + 1 < len(p) and not p[i + 1].isalnum():
+            char, step = p[i + 1], 2
+        elif p[i].isalnum() or p[i] in '/-_:=&,%@~!# ':
+            char, step = p[i], 1
+        else:
+            break
+        quantifier = p[i + step:i + step + 1]
+        if quantifier in ('?', '*', '{'):
+            break
+        out.append(char)
+        if quantifier == '+':
+            break
+        i += step
+    return ''.join(out)
+
+
+def literal_suffix(pattern: str) -> str:
+    """
+    以$结尾的正则末尾必须匹配的字面量, 无法确定时返回空
+    :param pattern:
+    :return:
+    """
+    if '|' in pattern or INLINE_FLAGS.search(pattern) or not pattern.endswith('$') or pattern.endswith('\\$'):
+        return ''
+    p = pattern[:-1]
+    out = []
+    j = len(p) - 1
+    while j >= 0:
+        escaped = j >= 1 and p[j - 1] == '\\' and not (j >= 2 and p[j - 2] == '\\')
+        if escaped and not p[j].isalnum():
+            out.append(p[j])
+            j -= 2
+        elif not escaped and (p[j].isalnum() or p[j] == '-'):
+            out.append(p[j])
+            j -= 1
+        else:
+            break
+    return ''.join(reversed(out))
+
 
 class Rewriter:
 
     def __init__(self, pattern: str = None, replace: str = None):
         self.pattern = pattern
         self.replace = replace
+        self.rex = None
+        self.segments: Optional[List[Segment]] = None
         if self.pattern:
             self.rex = re.compile(self.pattern)
+            if self.replace:
+                self.segments = parse_template(self.replace, self.rex)
+
+    def target(self, url: urllib3.util.Url) -> str:
+        """
+        用于匹配的字符串
+        """
+        return url.url
+
+    def target_key(self) -> str:
+        """
+        target的类型, 相同类型的规则共用一次target计算
+        """
+        return 'url'
 
     def match(self, url: urllib3.util.Url) -> bool:
-        return self.rex.match(url.url) is not None
+        return self.rex.match(self.target(url)) is not None
+
+    def affix(self) -> Tuple[str, str]:
+        """
+        规则索引: ('prefix'|'suffix', 字面量), 字面量为空时不建索引
+        """
+        return 'prefix', literal_prefix(self.pattern) if self.pattern else ''
 
     @abstractmethod
     def rewrite(self, url: urllib3.util.Url) -> str:
         ...
 
+    def rewrite_match(self, url: urllib3.util.Url, res: re.Match) -> str:
+        """
+        使用已有的匹配结果改写, 默认重新匹配
+        """
+        return self.rewrite(url)
+
 
 class DomainRewriter(Rewriter):
 
-    def __init__(self, pattern: str = None, replace: str = None, port: int = None):
+    def __init__(self, pattern: str = None, replace: str = None, port: int = None,
+                 pool: balancer.Balancer = None):
         self.port = port
+        # 多后端规则: 每个请求由pool选择后端
+        self.pool = pool
         super().__init__(pattern=pattern, replace=replace)
 
-    def match(self, url: urllib3.util.Url) -> bool:
-        return self.rex.match(url.host) is not None
+    def target(self, url: urllib3.util.Url) -> str:
+        return url.host
+
+    def target_key(self) -> str:
+        return 'host'
+
+    def affix(self) -> Tuple[str, str]:
+        return 'suffix', literal_suffix(self.pattern) if self.pattern else ''
 
-    @abstractmethod
     def rewrite(self, url: urllib3.util.Url) -> str:
-        host = self.replace or url.host
+        return self.rewrite_match(url, self.rex.search(url.host))
+
+    def rewrite_match(self, url: urllib3.util.Url, res: re.Match) -> str:
+        host = render(self.segments, res) if self.segments else url.host
         port = self.port or url.port or (80 if url.scheme.lower() == 'http' else 443)
-        res = self.rex.search(url.host)
-        # named group
-        g_name = res.groupdict()
-        for n, v in g_name.items():
-            host = host.replace(f'${n}', v)
-        # index group
-        g_len = len(res.groups())
-        for i in range(g_len):
-            host = host.replace(f'${i}', res.group(i + 1))
         return f'{url.scheme}://{host}:{port}'
 
 
@@ -51,8 +188,11 @@ class URIRewriter(Rewriter):
         self.by_url = by_url
         super().__init__(pattern=pattern, replace=replace)
 
-    def match(self, url: urllib3.util.Url) -> bool:
-        return self.rex.match(url.url if self.by_url else url.request_uri) is not None
+    def target(self, url: urllib3.util.Url) -> str:
+        return url.url if self.by_url else url.request_uri
+
+    def target_key(self) -> str:
+        return 'url' if self.by_url else 'uri'
 
     @abstractmethod
     def rewrite(self, url: urllib3.util.Url) -> str:
@@ -63,16 +203,68 @@ class RegexRewriter(URIRewriter):
     """正则替换"""
 
     def rewrite(self, url: urllib3.util.Url) -> str:
-        res = self.rex.search(url.url if self.by_url else url.request_uri)
-        g_len = len(res.groups())
-        if not g_len:
+        return self.rewrite_match(url, self.rex.search(self.target(url)))
+
+    def rewrite_match(self, url: urllib3.util.Url, res: re.Match) -> str:
+        if not res.re.groups:
             return url.request_uri
-        path = self.replace or url.request_uri
-        # named group
-        g_name = res.groupdict()
-        for n, v in g_name.items():
-            path = path.replace(f'${n}', v)
-        # index group
-        for i in range(g_len):
-            path = path.replace(f'${i}', res.group(i + 1))
-        return path
+        if not self.segments:
+            return url.request_uri
+        return render(self.segments, res)
+
+
+class RuleIndex:
+    """
+    规则索引: 按正则的字面量前缀/后缀分桶, 只对候选规则执行正则, 保持配置顺序
+    """
+
+    def __init__(self, rules: List[Rewriter]):
+        self.rules = rules
+        # 无法建索引的规则序号
+        self.unindexed: List[int] = []
+        # (target, prefix/suffix, 字面量长度) -> (代表规则, {字面量: [规则序号]})
+        self.buckets: Dict[Tuple[str, str, int], Tuple[Rewriter, Dict[str, List[int]]]] = {}
+        for order, rule in enumerate(rules):
+            kind, literal = rule.affix() if self.is_regex(rule) else ('', '')
+            if not literal:
+                self.unindexed.append(order)
+                continue
+            _, bucket = self.buckets.setdefault((rule.target_key(), kind, len(literal)), (rule, {}))
+            bucket.setdefault(literal, []).append(order)
+
+    @staticmethod
+    def is_regex(rule: Rewriter) -> bool:
+        """规则是否只按正则匹配(未重写match)"""
+        return rule.rex is not None and type(rule).match is Rewriter.match
+
+    def candidates(self, url: urllib3.util.Url) -> List[int]:
+        orders = list(self.unindexed)
+        texts = {}
+        for (target, kind, size), (rule, bucket) in self.buckets.items():
+            text = texts.get(target)
+            if text is None:
+                text = texts[target] = rule.target(url) or ''
+            if len(text) < size:
+                continue
+            hit = bucket.get(text[:size] if kind == 'prefix' else text[-size:])
+            if hit:
+                orders.extend(hit)
+        if len(orders) > 1:
+            orders.sort()
+        return orders
+
+    def find(self, url: urllib3.util.Url) -> Tuple[Optional[Rewriter], Optional[re.Match]]:
+        """
+        查找第一个匹配的规则
+        :param url:
+        :return: (规则, 匹配结果)
+        """
+        for order in self.candidates(url):
+            rule = self.rules[order]
+            if self.is_regex(rule):
+                res = rule.rex.match(rule.target(url) or '')
+                if res is not None:
+                    return rule, res
+            elif rule.match(url):
+                return rule, None
+        return None, None
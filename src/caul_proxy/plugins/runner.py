@@ -1,78 +1,342 @@
-from typing import List
+import glob
+import importlib.util
+import os
+import sys
+from typing import List, Tuple, Optional, Dict
 
 import urllib3.util
 
-from caul_proxy.config import Config, Domain, Uri
-from caul_proxy.plugins import NS_RW_URI, CACHE_RW_URI, CACHE_RW_DOMAIN, rewriter
+from caul_proxy import util, metrics, balancer
+from caul_proxy.config import Config, Domain, Uri, Plugins, logger
+from caul_proxy.plugins import NS_RW_URI, NS_PLUGINS, CACHE_RW_URI, CACHE_RW_DOMAIN, rewriter, hooks
 
+# plugin_dir中模块的包名前缀
+PLUGIN_PACKAGE = 'caul_plugins'
 
-def rewrite_domain(url_parts: urllib3.util.Url) -> str:
+
+class Rules:
+    """
+    改写规则快照: 规则索引, 改写缓存和插件钩子, 创建后不再修改
+    重新加载时整体替换, 处理中的请求继续使用开始时的快照
+    """
+
+    def __init__(self, domains: List[rewriter.DomainRewriter] = None, uris: List[rewriter.URIRewriter] = None,
+                 cache_size: int = 10240, plugins: hooks.Hooks = None):
+        self.domains = list(domains or [])
+        self.uris = list(uris or [])
+        self.cache_size = cache_size
+        self.hooks = plugins or hooks.Hooks()
+        # 插件rewriter, 被跳过时不缓存改写结果
+        self.timed = [rule for rule in self.uris if isinstance(rule, hooks.TimedRewriter)]
+        # 编译后的规则索引
+        self.index_domain = rewriter.RuleIndex(self.domains)
+        self.index_uri = rewriter.RuleIndex(self.uris)
+        # (scheme, host, port) -> (改写后的 scheme://host:port, 命中的规则)
+        self.cache_domain = util.LRUCache(cache_size)
+        # url -> (改写后的uri, 命中的规则)
+        self.cache_uri = util.LRUCache(cache_size)
+
+    def rewrite_domain(self, url_parts: urllib3.util.Url) -> str:
+        """
+        重写domain
+        :param url_parts:
+        :return:
+        """
+        return self.select_domain(url_parts)[0]
+
+    def select_domain(self, url_parts: urllib3.util.Url) -> Tuple[str, Optional[balancer.Backend]]:
+        """
+        重写domain, 多后端规则每次选择一个后端
+        :param url_parts:
+        :return: (改写后的 scheme://host:port, 选择的后端)
+        """
+        key = (url_parts.scheme, url_parts.host, url_parts.port)
+        cached = self.cache_domain.get(key)
+        if cached is None:
+            rw_domain, res = self.index_domain.find(url_parts)
+            pool = rw_domain.pool if rw_domain is not None else None
+            if rw_domain is None:
+                port = url_parts.port or (80 if url_parts.scheme.lower() == 'http' else 443)
+                base = f'{url_parts.scheme}://{url_parts.host}:{port}'
+            elif pool is not None:
+                base = ''
+            elif res is None:
+                base = rw_domain.rewrite(url_parts)
+            else:
+                base = rw_domain.rewrite_match(url_parts, res)
+            cached = (base, rule_label(rw_domain), pool)
+            self.cache_domain.set(key, cached)
+        base, rule, pool = cached
+        rule and metrics.REWRITE_HITS.inc('domain', rule)
+        if pool is None:
+            return base, None
+        backend = pool.pick()
+        return backend.base(url_parts), backend
+
+    def rewrite_uri(self, url_parts: urllib3.util.Url) -> str:
+        """
+        重写uri
+        :param url_parts:
+        :return:
+        """
+        key = url_parts.url
+        cached = self.cache_uri.get(key)
+        if cached is not None:
+            uri, rule = cached
+            rule and metrics.REWRITE_HITS.inc('uri', rule)
+            return uri
+        rw_uri, res = self.index_uri.find(url_parts)
+        if rw_uri is None:
+            uri = url_parts.request_uri
+        elif res is None:
+            uri = rw_uri.rewrite(url_parts)
+        else:
+            uri = rw_uri.rewrite_match(url_parts, res)
+        rule = rule_label(rw_uri)
+        rule and metrics.REWRITE_HITS.inc('uri', rule)
+        if all(timed.guard.active() for timed in self.timed):
+            self.cache_uri.set(key, (uri, rule))
+        return uri
+
+    def route(self, url_parts: urllib3.util.Url) -> Tuple[str, str, Optional[balancer.Backend]]:
+        """
+        改写uri和domain
+        :param url_parts:
+        :return: (转发的url, 响应缓存的key, 选择的后端); 多后端规则的key使用请求的域名, 不因后端不同而分散
+        """
+        uri = self.rewrite_uri(url_parts)
+        if uri.startswith('http://') or uri.startswith('https://'):
+            return uri, uri, None
+        base, backend = self.select_domain(url_parts)
+        url = base + uri
+        if backend is None:
+            return url, url, None
+        port = url_parts.port or (80 if url_parts.scheme.lower() == 'http' else 443)
+        return url, f'{url_parts.scheme}://{url_parts.host}:{port}{uri}', backend
+
+    def cache_stats(self) -> dict:
+        return {'domain': self.cache_domain.stats(), 'uri': self.cache_uri.stats()}
+
+    def backend_stats(self) -> Dict[Tuple[str, str, str], float]:
+        """
+        多后端规则的后端状态: {(rule, backend, stat): value}
+        :return:
+        """
+        values = {}
+        for rule in self.domains:
+            if rule.pool is not None:
+                values.update({(rule.pattern, *key): value for key, value in rule.pool.stats().items()})
+        return values
+
+
+def rule_label(rule: rewriter.Rewriter) -> str:
+    """指标中的规则名称"""
+    if rule is None:
+        return ''
+    return rule.pattern or type(getattr(rule, 'inner', rule)).__name__
+
+
+RULES = Rules()
+
+metrics.GaugeFunc('caul_rewrite_cache', 'Rewrite result cache size and hit counts',
+                  lambda: metrics.flatten(RULES.cache_stats()), ('stat',))
+metrics.GaugeFunc('caul_backend', 'Pooled backends: outstanding requests, latency EWMA, ejected, healthy',
+                  lambda: RULES.backend_stats(), ('rule', 'backend', 'stat'))
+
+
+def snapshot() -> Rules:
+    """
+    当前的改写规则, 一个请求内应只取一次
+    :return:
     """
-    重写domain
-    :param url_parts:
+    return RULES
+
+
+def swap(rules: Rules):
+    """
+    替换改写规则
+    :param rules:
     :return:
     """
-    for rw_domain in CACHE_RW_DOMAIN:
-        if rw_domain.match(url_parts):
-            return rw_domain.rewrite(url_parts)
-    return f'{url_parts.scheme}://{url_parts.host}:{url_parts.port}'
+    global RULES
+    hooks.configure(rules.hooks.conf)
+    RULES = rules
+    CACHE_RW_DOMAIN[:] = rules.domains
+    CACHE_RW_URI[:] = rules.uris
+
+
+def rewrite_domain(url_parts: urllib3.util.Url) -> str:
+    return RULES.rewrite_domain(url_parts)
 
 
 def rewrite_uri(url_parts: urllib3.util.Url) -> str:
+    return RULES.rewrite_uri(url_parts)
+
+
+def select_domain(url_parts: urllib3.util.Url) -> Tuple[str, Optional[balancer.Backend]]:
+    return RULES.select_domain(url_parts)
+
+
+def cache_stats() -> dict:
     """
-    重写uri
-    :param url_parts:
+    改写缓存命中统计
     :return:
     """
-    for rw_uri in CACHE_RW_URI:
-        if rw_uri.match(url_parts):
-            return rw_uri.rewrite(url_parts)
-    return url_parts.request_uri
+    return RULES.cache_stats()
 
 
 def load_plugins(settings: Config):
     # load class
     load_cls(settings.plugin_dir)
-    # init domain rewriter
-    init_domain_rewriter(settings.domains)
-    # init uri rewriter
-    init_uri_rewriter(settings.uris)
+    # init rewriter
+    swap(build(settings))
+
+
+def build(settings: Config) -> Rules:
+    """
+    根据配置编译改写规则, 不影响当前使用的规则
+    :param settings:
+    :return:
+    """
+    return Rules(domains=new_domain_rewriters(settings.domains), uris=new_uri_rewriters(settings.uris),
+                 cache_size=settings.rewrite_cache, plugins=new_hooks(settings.plugins))
 
 
 def load_cls(plugin_dir: str):
     """
-    加载rewriter类
+    加载rewriter类和plugin_dir中的插件
     :param plugin_dir:
     :return:
     """
     # rewriter
     NS_RW_URI.update(
         RegexRewriter=rewriter.RegexRewriter,
-        YhopRewriter=rewriter.YhopRewriter,
     )
-    # todo load from plugin_dir/rewriter
+    if not plugin_dir:
+        return
+    if not os.path.isdir(plugin_dir):
+        raise FileNotFoundError(f'Plugin Dir Not Found: {plugin_dir}')
+    for path in sorted(glob.glob(os.path.join(plugin_dir, '*.py'))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name.startswith('_'):
+            continue
+        module = import_plugin(path, f'{PLUGIN_PACKAGE}.{name}')
+        for obj in list(vars(module).values()):
+            # 只注册本模块定义的类, 不重复注册import进来的
+            if not isinstance(obj, type) or obj.__module__ != module.__name__:
+                continue
+            if issubclass(obj, rewriter.URIRewriter):
+                NS_RW_URI[obj.__name__] = obj
+            elif issubclass(obj, hooks.Plugin):
+                NS_PLUGINS[obj.name or obj.__name__] = obj
+        logger.info(f'Load Plugin {path}')
 
 
-def init_domain_rewriter(rw_list: List[Domain]):
+def import_plugin(path: str, module_name: str):
     """
-    初始化DomainRewriter对象
+    按文件路径导入插件模块
+    :param path:
+    :param module_name:
+    :return:
+    """
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        sys.modules.pop(module_name, None)
+        raise
+    return module
+
+
+def is_plugin(cls: type) -> bool:
+    """
+    是否plugin_dir中的类
+    :param cls:
+    :return:
+    """
+    return cls.__module__.startswith(f'{PLUGIN_PACKAGE}.')
+
+
+def new_hooks(conf: Plugins) -> hooks.Hooks:
+    """
+    创建钩子插件对象
+    :param conf:
+    :return:
+    """
+    plugins = []
+    for name, cls in NS_PLUGINS.items():
+        if name in conf.disabled:
+            continue
+        plugin = cls(**conf.options.get(name, {}))
+        plugin.name = name
+        plugins.append(plugin)
+    return hooks.Hooks(plugins, conf)
+
+
+def new_domain_rewriters(rw_list: List[Domain]) -> List[rewriter.DomainRewriter]:
+    """
+    创建DomainRewriter对象
     :param rw_list:
     :return:
     """
-    CACHE_RW_DOMAIN.clear()
+    rewriters = []
     for rw in rw_list:
-        CACHE_RW_DOMAIN.append(rewriter.DomainRewriter(pattern=rw.pattern, replace=rw.replace, port=rw.port))
+        pool = None
+        if rw.backends:
+            pool = balancer.Balancer(rw.pattern, rw.backends, strategy=rw.balancer, port=rw.port,
+                                     decay_seconds=rw.decay_seconds, outlier=rw.outlier,
+                                     health_check=rw.health_check)
+        elif not rw.replace:
+            raise ValueError(f'Domain Needs replace Or backends: {rw.pattern}')
+        rewriters.append(rewriter.DomainRewriter(pattern=rw.pattern, replace=rw.replace, port=rw.port, pool=pool))
+    return rewriters
 
 
-def init_uri_rewriter(rw_list: List[Uri]):
+def new_uri_rewriters(rw_list: List[Uri]) -> List[rewriter.URIRewriter]:
     """
-    初始化URIRewriter对象
+    创建URIRewriter对象
     :param rw_list:
     :return:
     """
-    CACHE_RW_URI.clear()
+    rewriters = []
     for rw in rw_list:
         rwr_cls = NS_RW_URI.get(rw.rewriter, None)
         if not rwr_cls:
             raise ModuleNotFoundError(f'Could Not Find Rewriter: {rw.rewriter}')
-        CACHE_RW_URI.append(rwr_cls(pattern=rw.pattern, replace=rw.replace, by_url=rw.full))
+        rw_uri = rwr_cls(pattern=rw.pattern, replace=rw.replace, by_url=rw.full)
+        # 插件rewriter计时, 超出预算时可跳过
+        if is_plugin(rwr_cls):
+            rw_uri = hooks.TimedRewriter(rw_uri, hooks.guard(rwr_cls.__name__))
+        rewriters.append(rw_uri)
+    return rewriters
+
+
+def init_domain_rewriter(rw_list: List[Domain]):
+    """
+    初始化DomainRewriter对象
+    :param rw_list:
+    :return:
+    """
+    swap(Rules(domains=new_domain_rewriters(rw_list), uris=RULES.uris, cache_size=RULES.cache_size,
+               plugins=RULES.hooks))
+
+
+def init_uri_rewriter(rw_list: List[Uri]):
+    """
+    初始化URIRewriter对象
+    :param rw_list:
+    :return:
+    """
+    swap(Rules(domains=RULES.domains, uris=new_uri_rewriters(rw_list), cache_size=RULES.cache_size,
+               plugins=RULES.hooks))
+
+
+def init_cache(maxsize: int):
+    """
+    设置改写缓存大小
+    :param maxsize:
+    :return:
+    """
+    swap(Rules(domains=RULES.domains, uris=RULES.uris, cache_size=maxsize, plugins=RULES.hooks))
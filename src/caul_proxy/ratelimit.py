@@ -0,0 +1,209 @@
+import math
+import threading
+import time
+from typing import Dict, List, Optional
+
+from caul_proxy import acl, metrics
+from caul_proxy.config import Config, Limit, RateLimit, logger
+
+# 状态表分片数, 按key的hash选择分片, 各分片独立加锁
+SHARDS = 64
+USER_PREFIX = 'user:'
+RESPONSE_429 = b'HTTP/1.1 429 Too Many Requests\r\nRetry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
+
+REJECTED = metrics.Counter('caul_rate_limited_total', 'Requests/connections rejected by per-client rate limits',
+                           ('engine', 'kind', 'reason'))
+
+
+class Limited(Exception):
+    """超出限制: reason为rate(请求速率)或connections(并发连接), retry_after为建议的重试间隔(秒)"""
+
+    def __init__(self, reason: str, retry_after: int = 1):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Bucket:
+    """一个客户端的令牌桶和并发连接数, 由所属分片的锁保护"""
+    __slots__ = ('shard', 'tokens', 'stamp', 'connections')
+
+    def __init__(self, shard: 'Shard', tokens: float, now: float):
+        self.shard = shard
+        self.tokens = tokens
+        self.stamp = now
+        self.connections = 0
+
+
+class Shard:
+    __slots__ = ('lock', 'buckets', 'swept')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets: Dict[str, Bucket] = {}
+        self.swept = time.monotonic()
+
+    def sweep(self, now: float, idle: float):
+        """
+        回收空闲的客户端: 没有连接且超过idle秒未访问(令牌已补满)
+        :param now:
+        :param idle:
+        :return:
+        """
+        self.swept = now
+        idle_keys = [key for key, b in self.buckets.items() if not b.connections and now - b.stamp > idle]
+        for key in idle_keys:
+            del self.buckets[key]
+
+
+class Rule:
+    """一类key(客户端IP/用户名)的限制"""
+    __slots__ = ('rate', 'burst', 'max_connections', 'idle')
+
+    def __init__(self, conf: Limit, idle_timeout: float):
+        self.rate = max(conf.rate or 0, 0)
+        self.burst = max(conf.burst or self.rate, 1)
+        self.max_connections = max(conf.max_connections or 0, 0)
+        # 回收时令牌应已补满, 否则回收会提前放行突发请求
+        self.idle = max(idle_timeout or 0, self.burst / self.rate if self.rate else 0)
+
+    def __bool__(self):
+        return bool(self.rate or self.max_connections)
+
+
+class Policy:
+    """
+    限流参数, 重新加载时整体替换, 已有客户端的状态保留
+    """
+
+    def __init__(self, conf: RateLimit = None):
+        conf = conf or RateLimit()
+        self.client = Rule(conf.client, conf.idle_timeout)
+        self.user = Rule(conf.user, conf.idle_timeout)
+        self.exempt = acl.AddressList(conf.exempt)
+        self.idle = max(self.client.idle, self.user.idle, 1)
+
+    def __bool__(self):
+        return bool(self.client or self.user)
+
+
+class Limiter:
+    """
+    按客户端IP/SOCKS5用户名的令牌桶限流和并发连接限制, 各引擎共享
+    状态表按key分片, 访问分片时顺带回收空闲的客户端
+    每个worker进程独立计数
+    """
+
+    def __init__(self, shards: int = SHARDS):
+        self.policy = Policy()
+        self.shards: List[Shard] = [Shard() for _ in range(shards)]
+
+    def acquire(self, engine: str, key: str, user: bool = False, rate: bool = True,
+                connection: bool = True) -> Optional[Bucket]:
+        """
+        消耗一个令牌并占用一个连接
+        :param engine:
+        :param key: 客户端IP或用户名
+        :param user: key是否为SOCKS5用户名
+        :param rate: 是否检查请求速率
+        :param connection: 是否占用并发连接, 占用时需要release返回值
+        :return: 占用的连接, 没有占用时返回None
+        :raise Limited: 超出限制
+        """
+        policy = self.policy
+        rule = policy.user if user else policy.client
+        if not rule or (not user and not policy.exempt.empty and policy.exempt.match(key)):
+            return None
+        if user:
+            key = USER_PREFIX + key
+        rate = rate and rule.rate
+        connection = connection and rule.max_connections
+        if not rate and not connection:
+            return None
+        shard = self.shards[hash(key) % len(self.shards)]
+        now = time.monotonic()
+        with shard.lock:
+            if now - shard.swept > policy.idle:
+                shard.sweep(now, policy.idle)
+            bucket = shard.buckets.get(key)
+            if bucket is None:
+                bucket = shard.buckets[key] = Bucket(shard, rule.burst, now)
+            elif rule.rate:
+                bucket.tokens = min(rule.burst, bucket.tokens + (now - bucket.stamp) * rule.rate)
+            bucket.stamp = now
+            if connection and bucket.connections >= rule.max_connections:
+                reason, retry_after = 'connections', 1
+            elif rate and bucket.tokens < 1:
+                reason, retry_after = 'rate', math.ceil((1 - bucket.tokens) / rule.rate)
+            else:
+                if rate:
+                    bucket.tokens -= 1
+                if not connection:
+                    return None
+                bucket.connections += 1
+                return bucket
+        REJECTED.inc(engine, 'user' if user else 'client', reason)
+        raise Limited(reason, retry_after)
+
+    @staticmethod
+    def release(bucket: Optional[Bucket]):
+        """
+        释放acquire占用的连接
+        :param bucket:
+        :return:
+        """
+        if bucket is None:
+            return
+        with bucket.shard.lock:
+            bucket.connections -= 1
+            bucket.stamp = time.monotonic()
+
+    def stats(self) -> dict:
+        clients = users = connections = 0
+        for shard in self.shards:
+            with shard.lock:
+                for key, bucket in shard.buckets.items():
+                    if key.startswith(USER_PREFIX):
+                        users += 1
+                    else:
+                        clients += 1
+                    connections += bucket.connections
+        return {'clients': clients, 'users': users, 'connections': connections}
+
+
+LIMITER = Limiter()
+
+metrics.GaugeFunc('caul_rate_limit', 'Clients/users tracked by the rate limiter and their connections',
+                  lambda: metrics.flatten(LIMITER.stats()), ('stat',))
+
+
+def load(settings: Config):
+    """
+    根据配置设置限流参数
+    :param settings:
+    :return:
+    """
+    swap(build(settings))
+    logger.debug(f'Rate Limit loaded: enabled={bool(LIMITER.policy)}')
+
+
+def build(settings: Config) -> Policy:
+    """
+    编译限流参数, 不影响当前使用的参数
+    :param settings:
+    :return:
+    """
+    return Policy(settings.rate_limit)
+
+
+def swap(policy: Policy):
+    LIMITER.policy = policy
+
+
+def acquire(engine: str, key: str, user: bool = False, rate: bool = True, connection: bool = True
+            ) -> Optional[Bucket]:
+    return LIMITER.acquire(engine, key, user, rate, connection)
+
+
+def release(bucket: Optional[Bucket]):
+    LIMITER.release(bucket)
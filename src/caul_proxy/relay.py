@@ -0,0 +1,182 @@
+import errno
+import os
+import select
+import selectors
+import socket
+import ssl
+import time
+from typing import Tuple, Optional
+
+from caul_proxy import shaping
+from caul_proxy.config import settings
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+BUFFER_SIZE = 65536
+# Linux: socket -> pipe -> socket, 数据不经过用户态
+SPLICE = hasattr(os, 'splice')
+
+
+class _Pipe:
+    """splice使用的管道, 每个方向一个"""
+    __slots__ = ('r', 'w')
+
+    def __init__(self, size: int):
+        self.r, self.w = os.pipe()
+        try:
+            fcntl.fcntl(self.w, fcntl.F_SETPIPE_SZ, size)
+        except (AttributeError, OSError):
+            pass
+
+    def close(self):
+        os.close(self.r)
+        os.close(self.w)
+
+
+def relay(client: socket.socket, remote: socket.socket, timeout: float = None,
+          buffer_size: int = None, mode: str = None, tunnel: shaping.Tunnel = None) -> Tuple[int, int]:
+    """
+    双向转发两个socket的数据, 一端关闭写后半关闭另一端, 两个方向都结束后返回
+    :param client:
+    :param remote:
+    :param timeout: 空闲超时(秒)
+    :param buffer_size:
+    :param mode: auto/splice/copy, 默认取settings.relay.mode
+    :param tunnel: 带宽整形, 令牌不足的方向暂停读取, 到期后恢复
+    :return: (上行字节数, 下行字节数)
+    """
+    buffer_size = buffer_size or settings.relay.buffer_size
+    mode = mode or settings.relay.mode
+    pipes = None
+    if mode != 'copy' and SPLICE and not isinstance(client, ssl.SSLSocket) \
+            and not isinstance(remote, ssl.SSLSocket):
+        pipes = {client: _Pipe(buffer_size), remote: _Pipe(buffer_size)}
+    # copy模式: 每个方向一个固定缓冲区, recv_into避免每次分配bytes
+    buffers = {}
+    peers = {client: remote, remote: client}
+    counts = {client: 0, remote: 0}
+    flows = {client: tunnel.up, remote: tunnel.down} if tunnel else {}
+    # 整形暂停读取的方向 {socket: 恢复时间}
+    paused = {}
+    try:
+        with selectors.DefaultSelector() as selector:
+            selector.register(client, selectors.EVENT_READ)
+            selector.register(remote, selectors.EVENT_READ)
+            while selector.get_map() or paused:
+                wait = timeout
+                if paused:
+                    wait = resume(selector, paused, timeout)
+                events = selector.select(wait)
+                if not events:
+                    if paused:
+                        continue
+                    # 空闲超时
+                    break
+                for key, _ in events:
+                    src = key.fileobj
+                    dst = peers[src]
+                    limit = buffer_size
+                    flow = flows.get(src)
+                    if flow is not None:
+                        limit, delay = flow.allowance(buffer_size)
+                        if delay:
+                            selector.unregister(src)
+                            paused[src] = time.monotonic() + delay
+                            continue
+                    try:
+                        if pipes and src in pipes:
+                            size = _splice(src, dst, pipes[src], limit, timeout)
+                            if size is None:
+                                # 不支持splice(如TLS socket), 该方向退回copy
+                                pipes.pop(src).close()
+                                continue
+                        else:
+                            if src not in buffers:
+                                buffers[src] = memoryview(bytearray(buffer_size))
+                            size = _copy(src, dst, buffers[src][:limit])
+                    except (BlockingIOError, InterruptedError):
+                        continue
+                    except OSError:
+                        return counts[client], counts[remote]
+                    if not size:
+                        # 读端关闭: 停止读取, 并关闭对端的写
+                        selector.unregister(src)
+                        shutdown(dst, socket.SHUT_WR)
+                        continue
+                    counts[src] += size
+                    flow is not None and flow.consume(size)
+    finally:
+        for pipe in (pipes or {}).values():
+            pipe.close()
+    return counts[client], counts[remote]
+
+
+def resume(selector: selectors.BaseSelector, paused: dict, timeout: float = None) -> Optional[float]:
+    """
+    恢复读取已到期的方向
+    :param selector:
+    :param paused: {socket: 恢复时间}
+    :param timeout: 空闲超时(秒)
+    :return: 本次select的等待时间
+    """
+    now = time.monotonic()
+    for sock, due in list(paused.items()):
+        if due <= now:
+            del paused[sock]
+            selector.register(sock, selectors.EVENT_READ)
+    if not paused:
+        return timeout
+    wait = min(paused.values()) - now
+    return wait if timeout is None else min(wait, timeout)
+
+
+def _copy(src: socket.socket, dst: socket.socket, buffer: memoryview) -> int:
+    try:
+        size = src.recv_into(buffer)
+    except (ConnectionResetError, ConnectionAbortedError):
+        return 0
+    if size:
+        dst.sendall(buffer[:size])
+    return size
+
+
+def _splice(src: socket.socket, dst: socket.socket, pipe: _Pipe, buffer_size: int,
+            timeout: float = None) -> Optional[int]:
+    """
+    src -> pipe -> dst
+    :return: 转发字节数, 0表示读端关闭, None表示不支持splice
+    """
+    try:
+        size = os.splice(src.fileno(), pipe.w, buffer_size, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+    except (ConnectionResetError, ConnectionAbortedError):
+        return 0
+    except OSError as e:
+        if e.errno == errno.EINVAL:
+            return None
+        raise
+    # 管道必须写空, 否则下次读取会和残留数据交错
+    left = size
+    while left:
+        try:
+            left -= os.splice(pipe.r, dst.fileno(), left, flags=os.SPLICE_F_MOVE)
+        except BlockingIOError:
+            # 设置了超时的socket是非阻塞的, 等待可写
+            if not _wait_writable(dst, timeout):
+                raise socket.timeout('Relay Write Timeout')
+    return size
+
+
+def _wait_writable(sock: socket.socket, timeout: float = None) -> bool:
+    poller = select.poll()
+    poller.register(sock, select.POLLOUT)
+    return bool(poller.poll(None if timeout is None else timeout * 1000))
+
+
+def shutdown(sock: socket.socket, how: int):
+    try:
+        sock.shutdown(how)
+    except OSError:
+        pass
@@ -0,0 +1,98 @@
+import os
+import signal
+import threading
+from typing import Optional, Tuple
+
+from caul_proxy import acl, ratelimit, util
+from caul_proxy.config import Config, settings, logger
+from caul_proxy.plugins import runner
+
+
+class Reloader:
+    """
+    配置热加载: 配置文件变化或收到SIGHUP时重新加载
+    新的ACL/限流参数和改写规则编译完成后整体替换, 失败时继续使用当前配置
+    连接池/DNS/响应缓存等启动时创建的组件不重新加载
+    """
+
+    def __init__(self, path: str, interval: float = 2):
+        self.path = path
+        self.interval = interval
+        self.signature = file_signature(path)
+        self.requested = threading.Event()
+        self._lock = threading.Lock()
+        self.reloads = 0
+        self.failures = 0
+
+    def reload(self) -> bool:
+        """
+        重新加载配置文件
+        :return: 是否成功
+        """
+        with self._lock:
+            try:
+                conf = Config.read_yaml(self.path)
+                if conf is None:
+                    raise ValueError('Empty Config')
+                # 先编译, 全部成功后再替换
+                access = acl.build(conf)
+                policy = ratelimit.build(conf)
+                rules = runner.build(conf)
+            except Exception as e:
+                self.failures += 1
+                logger.error(f'Reload {self.path} Failed, Keep Current Config: {util.err_msg(e)}')
+                return False
+            settings.update(conf, conf.__fields__.keys())
+            acl.swap(access)
+            ratelimit.swap(policy)
+            runner.swap(rules)
+            settings.init_logger()
+            self.reloads += 1
+            logger.info(f'Reload {self.path}: allows={len(conf.allows)} denys={len(conf.denys)} '
+                        f'domains={len(conf.domains)} uris={len(conf.uris)}')
+            return True
+
+    def watch(self):
+        """
+        检查文件变化, interval为0时只等待SIGHUP
+        :return:
+        """
+        while True:
+            requested = self.requested.wait(self.interval or None)
+            self.requested.clear()
+            signature = file_signature(self.path)
+            # 编辑器保存时文件可能短暂不存在
+            if signature is None:
+                continue
+            if requested or signature != self.signature:
+                self.signature = signature
+                self.reload()
+
+    def stats(self) -> dict:
+        return {'reloads': self.reloads, 'failures': self.failures}
+
+
+def file_signature(path: str) -> Optional[Tuple[int, int, int]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+
+RELOADER: Optional[Reloader] = None
+
+
+def start(path: str, interval: float = 2) -> Reloader:
+    """
+    启动配置热加载线程, 需要在主线程调用(注册SIGHUP)
+    :param path:
+    :param interval:
+    :return:
+    """
+    global RELOADER
+    RELOADER = Reloader(path, interval)
+    if hasattr(signal, 'SIGHUP') and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGHUP, lambda signum, frame: RELOADER.requested.set())
+    threading.Thread(target=RELOADER.watch, name='ConfigReloader', daemon=True).start()
+    return RELOADER
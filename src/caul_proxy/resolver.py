@@ -0,0 +1,345 @@
+import asyncio
+import errno
+import ipaddress
+import selectors
+import socket
+import threading
+import time
+from typing import List, Tuple, Callable, Optional, Dict
+
+from caul_proxy import util, metrics
+from caul_proxy.config import Dns
+
+# (family, sockaddr)
+Address = Tuple[int, tuple]
+
+
+class Latency:
+    """单个host的耗时统计(毫秒)"""
+    __slots__ = ('count', 'total', 'max', 'errors')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.errors = 0
+
+    def add(self, elapsed: float, ok: bool = True):
+        ms = elapsed * 1000
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+        if not ok:
+            self.errors += 1
+
+    def dict(self) -> dict:
+        return {'count': self.count, 'avg_ms': self.total / self.count if self.count else 0.0,
+                'max_ms': self.max, 'errors': self.errors}
+
+
+class _Failure:
+    """缓存的解析失败: 只保存错误码和信息, 每次抛出新的异常, 避免共享异常对象的traceback在线程间累积"""
+    __slots__ = ('errno', 'strerror')
+
+    def __init__(self, e: OSError):
+        self.errno = e.errno
+        self.strerror = e.strerror or util.err_msg(e)
+
+    def error(self) -> socket.gaierror:
+        return socket.gaierror(self.errno, self.strerror)
+
+
+class _Flight:
+    """同一域名的并发解析只执行一次"""
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result: Optional[List[Address]] = None
+        self.error: Optional[_Failure] = None
+
+
+class Resolver:
+    """
+    DNS缓存: TTL + LRU, 失败结果短时缓存, 并发解析合并
+    getaddrinfo可替换, 便于在无网络环境下测试
+    """
+
+    def __init__(self, conf: Dns = None, getaddrinfo: Callable = socket.getaddrinfo):
+        self.getaddrinfo = getaddrinfo
+        self._flights: Dict[str, _Flight] = {}
+        self._lock = threading.Lock()
+        self.cache = util.LRUCache()
+        self.latency = util.LRUCache()
+        self.configure(conf or Dns())
+
+    def configure(self, conf: Dns):
+        self.ttl = conf.ttl
+        self.negative_ttl = conf.negative_ttl
+        self.connect_timeout = conf.connect_timeout
+        self.happy_eyeballs_delay = conf.happy_eyeballs_delay
+        self.cache.maxsize = conf.cache_size
+        self.latency.maxsize = conf.cache_size
+        self.cache.clear()
+
+    def resolve(self, host: str, port: int) -> List[Address]:
+        """
+        解析域名, 返回按RFC 8305交替排列的IPv6/IPv4地址
+        :param host:
+        :param port:
+        :return:
+        """
+        host = host.strip('[]')
+        literal = ip_literal(host, port)
+        if literal:
+            return literal
+        now = time.monotonic()
+        entry = self.cache.get(host)
+        if entry is not None and entry[0] > now:
+            if isinstance(entry[1], _Failure):
+                raise entry[1].error()
+            return with_port(entry[1], port)
+        with self._lock:
+            flight = self._flights.get(host)
+            leader = flight is None
+            if leader:
+                flight = self._flights[host] = _Flight()
+        if leader:
+            self._lookup(host, flight)
+        else:
+            flight.event.wait()
+        if flight.error is not None:
+            raise flight.error.error()
+        return with_port(flight.result, port)
+
+    def _lookup(self, host: str, flight: _Flight):
+        start = time.monotonic()
+        try:
+            infos = self.getaddrinfo(host, 0, type=socket.SOCK_STREAM)
+            flight.result = interleave([(info[0], info[4]) for info in infos])
+            if not flight.result:
+                raise socket.gaierror(socket.EAI_NONAME, f'No Address: {host}')
+            self.cache.set(host, (time.monotonic() + self.ttl, flight.result))
+        except OSError as e:
+            flight.error = _Failure(e)
+            self.cache.set(host, (time.monotonic() + self.negative_ttl, flight.error))
+        except ValueError as e:
+            # 域名无法IDNA编码(标签为空或超过63字节)等, 与解析失败相同处理
+            flight.error = _Failure(socket.gaierror(socket.EAI_NONAME, f'Invalid Host: {util.err_msg(e)}'))
+            self.cache.set(host, (time.monotonic() + self.negative_ttl, flight.error))
+        finally:
+            self.stat(host, 'resolve').add(time.monotonic() - start, flight.error is None)
+            with self._lock:
+                self._flights.pop(host, None)
+            flight.event.set()
+
+    async def resolve_async(self, host: str, port: int) -> List[Address]:
+        """
+        异步解析: 命中缓存时不进入线程池
+        """
+        host = host.strip('[]')
+        literal = ip_literal(host, port)
+        if literal:
+            return literal
+        entry = self.cache.get(host)
+        if entry is not None and entry[0] > time.monotonic() and not isinstance(entry[1], _Failure):
+            return with_port(entry[1], port)
+        return await util.run_in_threadpool(self.resolve, host, port)
+
+    def create_connection(self, address: Tuple[str, int], timeout: float = None) -> socket.socket:
+        """
+        Happy Eyeballs连接: 按顺序发起连接, 每隔delay未成功则并发尝试下一个地址
+        :param address: (host, port)
+        :param timeout: 连接超时, 默认connect_timeout; 返回的socket设置该超时
+        :return:
+        """
+        host, port = address
+        timeout = timeout or self.connect_timeout
+        addresses = self.resolve(host, port)
+        start = time.monotonic()
+        try:
+            sock = happy_eyeballs(addresses, timeout, self.happy_eyeballs_delay)
+        except OSError:
+            self.stat(host, 'connect').add(time.monotonic() - start, False)
+            raise
+        self.stat(host, 'connect').add(time.monotonic() - start)
+        sock.settimeout(timeout)
+        return sock
+
+    async def create_connection_async(self, host: str, port: int, timeout: float = None) -> socket.socket:
+        """
+        异步Happy Eyeballs连接, 返回已连接的非阻塞socket
+        """
+        timeout = timeout or self.connect_timeout
+        addresses = await self.resolve_async(host, port)
+        start = time.monotonic()
+        try:
+            sock = await asyncio.wait_for(happy_eyeballs_async(addresses, self.happy_eyeballs_delay), timeout)
+        except (OSError, asyncio.TimeoutError):
+            self.stat(host, 'connect').add(time.monotonic() - start, False)
+            raise
+        self.stat(host, 'connect').add(time.monotonic() - start)
+        return sock
+
+    def stat(self, host: str, kind: str) -> Latency:
+        stats = self.latency.get(host)
+        if stats is None:
+            stats = {'resolve': Latency(), 'connect': Latency()}
+            self.latency.set(host, stats)
+        return stats[kind]
+
+    def stats(self) -> dict:
+        """
+        每个host的解析/连接耗时
+        :return:
+        """
+        items = self.latency.items()
+        return {
+            'cache': self.cache.stats(),
+            'hosts': {host: {kind: s.dict() for kind, s in stats.items()} for host, stats in items},
+        }
+
+
+def ip_literal(host: str, port: int) -> Optional[List[Address]]:
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return None
+    if address.version == 6:
+        return [(socket.AF_INET6, (host, port, 0, 0))]
+    return [(socket.AF_INET, (host, port))]
+
+
+def with_port(addresses: List[Address], port: int) -> List[Address]:
+    return [(family, (sockaddr[0], port) + tuple(sockaddr[2:])) for family, sockaddr in addresses]
+
+
+def interleave(addresses: List[Address]) -> List[Address]:
+    """
+    去重后按IPv6/IPv4交替排列, 首个地址的协议族优先
+    :param addresses:
+    :return:
+    """
+    seen, unique = set(), []
+    for family, sockaddr in addresses:
+        if (family, sockaddr[0]) not in seen:
+            seen.add((family, sockaddr[0]))
+            unique.append((family, sockaddr))
+    if not unique:
+        return unique
+    first = unique[0][0]
+    primary = [a for a in unique if a[0] == first]
+    secondary = [a for a in unique if a[0] != first]
+    result = []
+    for i in range(max(len(primary), len(secondary))):
+        result.extend(primary[i:i + 1])
+        result.extend(secondary[i:i + 1])
+    return result
+
+
+def happy_eyeballs(addresses: List[Address], timeout: float, delay: float) -> socket.socket:
+    """
+    RFC 8305: 依次发起非阻塞连接, 第一个成功的返回, 其余关闭
+    :param addresses:
+    :param timeout:
+    :param delay:
+    :return:
+    """
+    pending = list(addresses)
+    errors: List[OSError] = []
+    deadline = time.monotonic() + timeout
+    with selectors.DefaultSelector() as selector:
+        try:
+            next_attempt = 0.0
+            while pending or selector.get_map():
+                now = time.monotonic()
+                if now >= deadline:
+                    raise socket.timeout('Connect Timeout')
+                # 发起下一个连接: 首次、到达间隔或当前没有进行中的连接
+                if pending and (now >= next_attempt or not selector.get_map()):
+                    family, sockaddr = pending.pop(0)
+                    sock = socket.socket(family, socket.SOCK_STREAM)
+                    sock.setblocking(False)
+                    err = sock.connect_ex(sockaddr)
+                    if err == 0:
+                        return _connected(sock)
+                    if err not in _IN_PROGRESS:
+                        sock.close()
+                        errors.append(OSError(err, f'Connect {sockaddr[0]}:{sockaddr[1]} Failed'))
+                        continue
+                    selector.register(sock, selectors.EVENT_WRITE)
+                    next_attempt = now + delay
+                wait = deadline - now
+                if pending:
+                    wait = min(wait, max(next_attempt - now, 0))
+                for key, _ in selector.select(wait):
+                    sock = key.fileobj
+                    selector.unregister(sock)
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err == 0:
+                        return _connected(sock)
+                    sock.close()
+                    errors.append(OSError(err, 'Connect Failed'))
+            raise errors[-1] if errors else OSError('No Address')
+        finally:
+            for key in list(selector.get_map().values()):
+                key.fileobj.close()
+
+
+async def happy_eyeballs_async(addresses: List[Address], delay: float) -> socket.socket:
+    """
+    happy_eyeballs的asyncio版本
+    :param addresses:
+    :param delay:
+    :return:
+    """
+    loop = asyncio.get_running_loop()
+    tasks: List[asyncio.Future] = []
+    winner = None
+
+    async def attempt(family: int, sockaddr: tuple) -> socket.socket:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await loop.sock_connect(sock, sockaddr)
+        except BaseException:
+            sock.close()
+            raise
+        return _connected(sock, blocking=False)
+
+    try:
+        pending = list(addresses)
+        while pending or any(not t.done() for t in tasks):
+            if pending:
+                tasks.append(asyncio.ensure_future(attempt(*pending.pop(0))))
+            running = [t for t in tasks if not t.done()]
+            if not running:
+                continue
+            done, _ = await asyncio.wait(running, timeout=delay if pending else None,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    winner = task.result()
+                    return winner
+        errors = [t.exception() for t in tasks if not t.cancelled() and t.exception() is not None]
+        raise errors[-1] if errors else OSError('No Address')
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled() and task.exception() is None and task.result() is not winner:
+                task.result().close()
+
+
+def _connected(sock: socket.socket, blocking: bool = True) -> socket.socket:
+    sock.setblocking(blocking)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+_IN_PROGRESS = {errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN}
+
+dns = Resolver()
+
+metrics.GaugeFunc('caul_dns_cache', 'DNS cache size and hit counts', lambda: metrics.flatten(dns.cache.stats()),
+                  ('stat',))
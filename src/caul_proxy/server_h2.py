@@ -0,0 +1,498 @@
+# -*- coding: utf-8 -*-
+# desc: 面向客户端的HTTP/2代理(h2c或TLS), 单线程asyncio处理所有连接和流
+import asyncio
+import socket
+import ssl
+import time
+import typing
+
+import urllib3.util
+
+from caul_proxy import acl, metrics, workers, access_log, balancer, ratelimit, shaping, util, http2
+from caul_proxy.config import settings, logger, H2Server
+from caul_proxy.plugins import runner
+from caul_proxy.resolver import dns
+from caul_proxy.server_socks5_async import raise_nofile
+from caul_proxy.server_uvicorn import ProxyApp
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.errors
+    import h2.events
+    import h2.exceptions
+    import h2.settings
+except ImportError:
+    h2 = None
+
+ENGINE = 'h2'
+READ_SIZE = 65536
+# HTTP/2中不允许的连接相关header
+CONNECTION_HEADERS = frozenset({'connection', 'keep-alive', 'proxy-connection', 'transfer-encoding', 'upgrade'})
+
+STREAMS = metrics.Counter('caul_h2_streams_total', 'Client HTTP/2 streams by kind (request/connect) and result',
+                          ('kind', 'result'))
+STREAM_DURATION = metrics.Histogram('caul_h2_stream_seconds', 'Client HTTP/2 stream lifetime', ('kind',))
+STREAM_BYTES = metrics.Counter('caul_h2_stream_bytes_total', 'Client HTTP/2 stream DATA bytes, up: from client',
+                               ('kind', 'direction'))
+
+
+class Stream:
+    """
+    一个客户端流: 请求体按上游读取的进度归还窗口, 响应按客户端的窗口发送
+    """
+
+    def __init__(self, proto: 'H2Protocol', stream_id: int, headers: typing.List[typing.Tuple[bytes, bytes]],
+                 ended: bool):
+        self.proto = proto
+        self.stream_id = stream_id
+        self.headers = headers
+        self.pseudo = {k.decode('latin-1'): v.decode('latin-1') for k, v in headers if k.startswith(b':')}
+        self.kind = 'connect' if self.pseudo.get(':method') == 'CONNECT' else 'request'
+        # 请求体: (数据, 流量控制长度), None表示结束
+        self.body: asyncio.Queue = asyncio.Queue()
+        self.has_body = not ended
+        ended and self.body.put_nowait(None)
+        self.window = asyncio.Event()
+        self.started = False
+        self.ended = False
+        self.reset = False
+        self.up = 0
+        self.down = 0
+        self.start = time.monotonic()
+        self.task: typing.Optional[asyncio.Task] = None
+
+    def on_data(self, data: bytes, flow: int):
+        self.up += len(data)
+        self.body.put_nowait((data, flow))
+
+    def on_reset(self):
+        """客户端重置流或连接断开: 取消转发, 不再读取上游"""
+        self.reset = True
+        self.body.put_nowait(None)
+        self.window.set()
+        if self.task is not None and not self.task.done():
+            self.task.cancel()
+
+    async def read(self) -> typing.Optional[bytes]:
+        """
+        读取客户端发送的数据并归还窗口
+        :return: 结束时返回None
+        """
+        item = await self.body.get()
+        if item is None:
+            self.body.put_nowait(None)
+            return None
+        data, flow = item
+        self.proto.ack(self.stream_id, flow)
+        return data
+
+    def respond(self, status: int, headers: typing.Iterable[typing.Tuple[str, str]] = (), end: bool = False):
+        if self.reset:
+            raise ConnectionError('HTTP/2 Stream Reset')
+        items = [(':status', str(status))]
+        items.extend((k.lower(), v) for k, v in headers if k.lower() not in CONNECTION_HEADERS)
+        self.started = True
+        self.ended = end
+        self.proto.send(lambda conn: conn.send_headers(self.stream_id, items, end_stream=end))
+
+    async def write(self, data: bytes, end: bool = False):
+        """
+        按客户端的流量控制窗口发送数据
+        :param data:
+        :param end: 是否结束流
+        :return:
+        """
+        proto, conn = self.proto, self.proto.conn
+        view = memoryview(data)
+        while view:
+            if self.reset or proto.closed:
+                raise ConnectionError('HTTP/2 Stream Reset')
+            size = min(len(view), conn.local_flow_control_window(self.stream_id), conn.max_outbound_frame_size)
+            if size <= 0:
+                self.window.clear()
+                await self.window.wait()
+                continue
+            proto.send(lambda c: c.send_data(self.stream_id, view[:size].tobytes()))
+            self.down += size
+            view = view[size:]
+            await proto.drain()
+        if end:
+            self.end()
+
+    def end(self):
+        if not self.ended and not self.reset:
+            self.ended = True
+            self.proto.send(lambda conn: conn.end_stream(self.stream_id))
+
+    def cancel(self, code: int = None):
+        """重置未结束的流"""
+        if not self.ended and not self.reset:
+            self.reset = True
+            code = h2.errors.ErrorCodes.INTERNAL_ERROR if code is None else code
+            self.proto.send(lambda conn: conn.reset_stream(self.stream_id, code))
+
+    async def run(self):
+        result = 'complete'
+        try:
+            if self.kind == 'connect':
+                await self.connect()
+            else:
+                await self.request()
+        except (ConnectionError, h2.exceptions.StreamClosedError):
+            result = 'reset'
+        except asyncio.CancelledError:
+            result = 'reset'
+            raise
+        except Exception as e:
+            result = 'error'
+            logger.exception(f'HTTP/2 Stream {self.pseudo.get(":authority")}: {e}')
+        finally:
+            if self.reset and result == 'complete':
+                result = 'reset'
+            self.cancel()
+            STREAMS.inc(self.kind, result)
+            STREAM_DURATION.observe(time.monotonic() - self.start, self.kind)
+            STREAM_BYTES.inc(self.kind, 'up', value=self.up)
+            STREAM_BYTES.inc(self.kind, 'down', value=self.down)
+            self.proto.closed_stream(self)
+
+    async def request(self):
+        """绝对URL的代理请求: 转换为ASGI请求, 与uvicorn引擎相同的ACL/插件/改写/转发流程"""
+        pseudo = self.pseudo
+        path, _, query = pseudo.get(':path', '/').partition('?')
+        authority = pseudo.get(':authority', '')
+        scheme = pseudo.get(':scheme', 'http')
+        headers = [(k.lower(), v) for k, v in self.headers if not k.startswith(b':')]
+        if authority and not any(k == b'host' for k, _ in headers):
+            headers.insert(0, (b'host', authority.encode('latin-1')))
+        # 请求体长度未知时按chunked转发(逐跳header, 不会发给上游)
+        if self.has_body and not any(k == b'content-length' for k, _ in headers):
+            headers.append((b'transfer-encoding', b'chunked'))
+        scope = {
+            'type': 'http', 'http_version': '2', 'method': pseudo.get(':method', 'GET'), 'scheme': scheme,
+            'path': path, 'raw_path': f'{scheme}://{authority}{path}'.encode('latin-1'),
+            'query_string': query.encode('latin-1'), 'headers': headers,
+            'client': self.proto.client_address, 'server': self.proto.server_address,
+        }
+        await app(scope, self.receive, self.send)
+
+    async def receive(self) -> dict:
+        data = await self.read()
+        if self.reset:
+            return {'type': 'http.disconnect'}
+        if data is None:
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        return {'type': 'http.request', 'body': data, 'more_body': True}
+
+    async def send(self, message: dict):
+        if message['type'] == 'http.response.start':
+            if self.started:
+                # 已发送响应头后出错(如上游中断): 重置流, 客户端可知响应不完整
+                self.cancel()
+                raise ConnectionError('HTTP/2 Response Aborted')
+            self.respond(message['status'], ((k.decode('latin-1'), v.decode('latin-1'))
+                                             for k, v in message.get('headers', ())))
+        elif message['type'] == 'http.response.body':
+            await self.write(message.get('body', b''), end=not message.get('more_body', False))
+
+    async def connect(self):
+        """CONNECT: 流的DATA与上游TCP连接双向转发"""
+        proto = self.proto
+        client = proto.client_address[0]
+        authority = self.pseudo.get(':authority', '')
+        status, target, tunnel, slot, opened = 0, authority, None, None, False
+        try:
+            # allows and denys
+            if not acl.admit(client):
+                status = 403
+                self.respond(status, end=True)
+                return
+            # 每个客户端的请求速率及并发隧道数
+            try:
+                slot = ratelimit.acquire(ENGINE, client)
+            except ratelimit.Limited as e:
+                status = 429
+                self.respond(status, [('retry-after', str(e.retry_after))], end=True)
+                return
+            # rewrite
+            try:
+                base, backend = runner.select_domain(urllib3.util.parse_url(f'https://{authority}'))
+                url_parts = urllib3.util.parse_url(base)
+                target = f'{url_parts.host}:{url_parts.port}'
+            except BaseException as e:
+                logger.error(f'CONNECT {authority} HTTP/2: {util.err_msg(e)}')
+                status = 400
+                self.respond(status, end=True)
+                return
+            # connect: 多后端规则只统计建立连接的结果
+            lease = balancer.Lease(backend) if backend is not None else None
+            try:
+                sock = await dns.create_connection_async(url_parts.host, url_parts.port)
+                reader, writer = await asyncio.open_connection(sock=sock, limit=READ_SIZE)
+                lease and lease.response(200)
+            except (OSError, asyncio.TimeoutError) as e:
+                logger.error(f'CONNECT {target} HTTP/2\n{util.err_msg(e)}')
+                status = 504 if isinstance(e, (asyncio.TimeoutError, socket.timeout)) else 502
+                self.respond(status, end=True)
+                return
+            finally:
+                lease and lease.release()
+            # relay
+            status, opened = 200, True
+            metrics.ACTIVE_TUNNELS.inc(ENGINE)
+            tunnel = shaping.shaper.open(client)
+            try:
+                self.respond(200)
+                await self.relay(reader, writer, tunnel)
+            finally:
+                writer.close()
+        finally:
+            ratelimit.release(slot)
+            tunnel and tunnel.close()
+            if opened:
+                metrics.ACTIVE_TUNNELS.dec(ENGINE)
+                metrics.BYTES.inc(ENGINE, 'up', value=self.up)
+                metrics.BYTES.inc(ENGINE, 'down', value=self.down)
+            metrics.REQUESTS.inc(ENGINE, 'CONNECT', str(status))
+            access_log.log(ENGINE, client, 'CONNECT', target, 'HTTP/2', status, time.monotonic() - self.start,
+                           self.up, self.down, failed=status != 200)
+
+    async def relay(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter,
+                    tunnel: typing.Optional[shaping.Tunnel]):
+        """
+        双向转发, 任一方向出错时结束; 客户端的数据写入上游后才归还窗口
+        :param reader:
+        :param writer:
+        :param tunnel: 带宽整形
+        :return:
+        """
+
+        async def upload():
+            while True:
+                data = await self.read()
+                if data is None:
+                    if self.reset:
+                        return
+                    if writer.can_write_eof():
+                        writer.write_eof()
+                    return
+                writer.write(data)
+                await writer.drain()
+                if tunnel is not None:
+                    tunnel.up.consume(len(data))
+                    delay = tunnel.up.delay()
+                    delay and await asyncio.sleep(delay)
+
+        async def download():
+            while True:
+                if tunnel is not None:
+                    limit, delay = tunnel.down.allowance(READ_SIZE)
+                    if delay:
+                        await asyncio.sleep(delay)
+                        continue
+                else:
+                    limit = READ_SIZE
+                data = await reader.read(limit)
+                if not data:
+                    self.end()
+                    return
+                tunnel is not None and tunnel.down.consume(len(data))
+                await self.write(data)
+
+        tasks = [asyncio.ensure_future(upload()), asyncio.ensure_future(download())]
+        try:
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+class H2Protocol(asyncio.Protocol):
+    """
+    一个客户端HTTP/2连接: 每个流一个Task
+    接收窗口只在数据转发给上游后归还, 慢上游只限制对应的流
+    """
+    transport: typing.Optional[asyncio.Transport] = None
+
+    def __init__(self, timeout: int, conf: H2Server):
+        self.timeout = timeout
+        self.conf = conf
+        self.conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False, header_encoding=None))
+        self.streams: typing.Dict[int, Stream] = {}
+        self.client_address = ('', 0)
+        self.server_address = None
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.closed = False
+        self.idle_handle: typing.Optional[asyncio.TimerHandle] = None
+        self.idle_mark = None
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        self.client_address = transport.get_extra_info('peername')[:2]
+        self.server_address = transport.get_extra_info('sockname')[:2]
+        connections[0] += 1
+        conf = self.conf
+        self.conn.local_settings = h2.settings.Settings(client=False, initial_values={
+            h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: conf.max_streams,
+            h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: conf.window_size,
+        })
+        self.conn.initiate_connection()
+        if conf.connection_window > 65535:
+            self.conn.increment_flow_control_window(conf.connection_window - 65535)
+        self.flush()
+        self.idle_handle = asyncio.get_running_loop().call_later(self.timeout, self.check_idle)
+
+    def data_received(self, data: bytes):
+        try:
+            events = self.conn.receive_data(data)
+        except h2.exceptions.ProtocolError as e:
+            logger.debug(f'HTTP/2 {self.client_address[0]}: {e}')
+            self.flush()
+            self.transport.close()
+            return
+        for event in events:
+            self.dispatch(event)
+        self.flush()
+
+    def dispatch(self, event):
+        stream = self.streams.get(getattr(event, 'stream_id', None) or 0)
+        if isinstance(event, h2.events.RequestReceived):
+            stream = self.streams[event.stream_id] = Stream(self, event.stream_id, event.headers,
+                                                            event.stream_ended is not None)
+            stream.task = asyncio.ensure_future(stream.run())
+        elif isinstance(event, h2.events.DataReceived):
+            if stream is not None:
+                stream.on_data(event.data, event.flow_controlled_length)
+            else:
+                self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, h2.events.StreamEnded):
+            if stream is not None:
+                stream.body.put_nowait(None)
+        elif isinstance(event, h2.events.StreamReset):
+            if stream is not None:
+                stream.on_reset()
+        elif isinstance(event, h2.events.WindowUpdated):
+            targets = self.streams.values() if not event.stream_id else (stream,) if stream else ()
+            for s in targets:
+                s.window.set()
+        elif isinstance(event, h2.events.RemoteSettingsChanged):
+            for s in self.streams.values():
+                s.window.set()
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            self.transport.close()
+
+    def send(self, action: typing.Callable):
+        """修改h2状态并写出"""
+        if self.closed:
+            raise ConnectionError('HTTP/2 Connection Closed')
+        action(self.conn)
+        self.flush()
+
+    def ack(self, stream_id: int, size: int):
+        if self.closed or not size:
+            return
+        # 流已结束时h2只归还连接的窗口
+        self.conn.acknowledge_received_data(size, stream_id)
+        self.flush()
+
+    def flush(self):
+        data = self.conn.data_to_send()
+        if data and not self.transport.is_closing():
+            self.transport.write(data)
+
+    async def drain(self):
+        if not self.writable.is_set():
+            await self.writable.wait()
+        if self.closed:
+            raise ConnectionError('HTTP/2 Connection Closed')
+
+    def pause_writing(self):
+        self.writable.clear()
+
+    def resume_writing(self):
+        self.writable.set()
+
+    def closed_stream(self, stream: Stream):
+        self.streams.pop(stream.stream_id, None)
+
+    def check_idle(self):
+        """没有流且在一个周期内没有新的流时关闭连接"""
+        if self.transport.is_closing():
+            return
+        mark = self.conn.highest_inbound_stream_id
+        if not self.streams and mark == self.idle_mark:
+            self.send(lambda conn: conn.close_connection())
+            self.transport.close()
+            return
+        self.idle_mark = mark
+        self.idle_handle = asyncio.get_running_loop().call_later(self.timeout, self.check_idle)
+
+    def connection_lost(self, exc: typing.Optional[Exception]):
+        self.closed = True
+        connections[0] -= 1
+        self.idle_handle and self.idle_handle.cancel()
+        self.writable.set()
+        for stream in list(self.streams.values()):
+            stream.on_reset()
+
+
+# 当前的客户端连接数
+connections = [0]
+app = ProxyApp(engine=ENGINE)
+
+metrics.GaugeFunc('caul_h2_server', 'Client HTTP/2 connections', lambda: {('connections',): connections[0]},
+                  ('stat',))
+
+
+def tls_context(conf: H2Server) -> typing.Optional[ssl.SSLContext]:
+    """
+    配置证书时使用TLS, 只协商h2
+    :param conf:
+    :return:
+    """
+    if not conf.certfile:
+        return None
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(conf.certfile, conf.keyfile or None)
+    context.set_alpn_protocols(['h2'])
+    return context
+
+
+async def serve(ip: str, port: int, timeout: int):
+    loop = asyncio.get_running_loop()
+    metrics.watch_loop(loop)
+    conf = settings.h2_server
+    server = await loop.create_server(lambda: H2Protocol(timeout, conf), host=ip, port=port, ssl=tls_context(conf),
+                                      reuse_address=True, reuse_port=workers.REUSE_PORT or None, backlog=1024)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await app.close_session()
+
+
+def start_server(ip: str = '0.0.0.0', port: int = 1080, timeout: int = 60):
+    if h2 is None:
+        logger.error('HTTP/2 Engine Requires h2: pip install h2')
+        return
+    raise_nofile()
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    app.timeout = timeout
+    http2.pool.configure(settings.pool)
+    print("**********************************************************")
+    print("******************* CaulProxy 1.0.0 **********************")
+    print(f"*******************  IP:{ip} PORT:{port} ***********")
+    print("**********************************************************")
+    asyncio.run(serve(ip, port, timeout))
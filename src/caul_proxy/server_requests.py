@@ -1,109 +1,683 @@
-import re
+import contextlib
+import http
+import os
+import socket
+import tempfile
+import time
 import typing
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import requests
 import urllib3.util
 
-from caul_proxy import util
+from caul_proxy import util, upstream, acl, relay, cache, metrics, workers, access_log, compression, balancer, \
+    coalesce, ratelimit, shaping
 from caul_proxy.config import settings, logger
-from caul_proxy.plugins import runner
+from caul_proxy.plugins import runner, hooks
+from caul_proxy.resolver import dns
+
+BLOCK_SIZE = 65536
+MAX_LINE = 65537
+# 不直接转发的请求体相关header
+BODY_HEADERS = frozenset({'content-length', 'transfer-encoding', 'expect'})
+ENGINE = 'requests'
+
+
+class BadRequest(ValueError):
+    """客户端请求格式错误(如chunked分块长度), 返回400"""
 
 
 class ProxyHandler(BaseHTTPRequestHandler):
+    # 客户端连接keep-alive及pipelining
+    protocol_version = 'HTTP/1.1'
+    status: typing.Optional[int] = None
+    started = 0.0
+    # 访问日志: 转发的目标, X-Cache, 请求体/响应体字节数
+    target: typing.Optional[str] = None
+    cache_status = ''
+    up = 0
+    down = 0
+    # 插件钩子: 没有插件时ctx为None
+    plugins: typing.Optional[hooks.Hooks] = None
+    ctx: typing.Optional[hooks.Context] = None
+
+    def handle(self):
+        # 每个客户端的并发连接数, 超出时直接返回429
+        try:
+            slot = ratelimit.acquire(ENGINE, self.client_address[0], rate=False)
+        except ratelimit.Limited:
+            try:
+                self.wfile.write(ratelimit.RESPONSE_429)
+            except OSError:
+                pass
+            return
+        metrics.ACTIVE_CONNECTIONS.inc(ENGINE)
+        try:
+            super().handle()
+        finally:
+            metrics.ACTIVE_CONNECTIONS.dec(ENGINE)
+            ratelimit.release(slot)
+
+    def handle_one_request(self):
+        self.status, self.target, self.cache_status, self.up, self.down = None, None, '', 0, 0
+        self.plugins, self.ctx = None, None
+        failed = False
+        try:
+            super().handle_one_request()
+        except BaseException:
+            # 转发失败(如连接上游失败)时未发送响应
+            failed = True
+            raise
+        finally:
+            if self.status is not None or (failed and self.command):
+                duration = time.monotonic() - self.started
+                status = 'error' if self.status is None else str(self.status)
+                metrics.REQUESTS.inc(ENGINE, self.command or '-', status)
+                # CONNECT的耗时为隧道时长, 不计入请求延迟
+                if self.command != 'CONNECT':
+                    metrics.REQUEST_DURATION.observe(duration, ENGINE)
+                access_log.log(ENGINE, self.client_address[0], self.command or '-', self.target or self.path,
+                               self.request_version, self.status or 0, duration, self.up, self.down,
+                               self.cache_status)
+
+    def parse_request(self) -> bool:
+        self.started = time.monotonic()
+        return super().parse_request()
+
+    def send_response_only(self, code: int, message: str = None):
+        self.status = code
+        super().send_response_only(code, message)
+
+    def log_request(self, code='-', size='-'):
+        """由access_log在请求结束后记录, 不在请求线程同步写stderr"""
 
     def do_HEAD(self):
         """处理HEAD请求"""
-        self.do_request(lambda url: requests.head(url=url, headers=self.req_headers(),
-                                                  timeout=self.timeout))
+        self.do_request(lambda url: upstream.sessions.request('HEAD', url=url, headers=self.req_headers(),
+                                                              allow_redirects=False, timeout=self.timeout))
 
     def do_GET(self):
         """处理GET请求"""
-        self.do_request(lambda url: requests.get(url=url, headers=self.req_headers(),
-                                                 timeout=self.timeout))
+        self.do_request(lambda url: upstream.sessions.request('GET', url=url, headers=self.req_headers(),
+                                                              timeout=self.timeout),
+                        cacheable=cache.responses.enabled)
 
     def do_POST(self):
         """处理POST请求"""
-        self.do_request(lambda url: requests.post(url=url, headers=self.req_headers(),
-                                                  data=self.req_data(), timeout=self.timeout))
+        self.do_request(lambda url: self.send_with_body('POST', url))
+
+    def do_PUT(self):
+        """处理PUT请求"""
+        self.do_request(lambda url: self.send_with_body('PUT', url))
+
+    def do_CONNECT(self):
+        """处理CONNECT请求(隧道)"""
+        self.close_connection = True
+        # allows and denys
+        if not self.is_admitted():
+            self.send_error(code=403)
+            return
+        if not self.within_limit():
+            return
+        # rewrite
+        try:
+            url_parts = urllib3.util.parse_url(f'https://{self.path}')
+            base, backend = runner.select_domain(url_parts)
+            target = urllib3.util.parse_url(base)
+        except BaseException as e:
+            logger.error(f'{self.command} {self.path} {self.protocol_version}: {util.err_msg(e)}')
+            self.send_error(code=400)
+            return
+        # connect: 多后端规则只统计建立连接的结果
+        lease = balancer.Lease(backend) if backend is not None else None
+        try:
+            remote = dns.create_connection((target.host, target.port))
+            remote.settimeout(self.timeout)
+            lease and lease.response(200)
+        except (OSError, UnicodeError, ValueError) as e:
+            logger.error(f'{self.command} {target.host}:{target.port} {self.protocol_version}\n'
+                         f'{util.err_msg(e)}')
+            # 域名无法编码等为客户端错误, 其余为连接上游失败
+            self.send_error(code=502 if isinstance(e, OSError) else 400)
+            return
+        finally:
+            lease and lease.release()
+        # relay
+        with remote:
+            self.send_response(200, 'Connection Established')
+            self.end_headers()
+            sent = self.forward_buffered(remote)
+            metrics.ACTIVE_TUNNELS.inc(ENGINE)
+            tunnel = shaping.shaper.open(self.client_address[0])
+            try:
+                up, down = relay.relay(self.connection, remote, timeout=self.timeout, tunnel=tunnel)
+            finally:
+                metrics.ACTIVE_TUNNELS.dec(ENGINE)
+                tunnel and tunnel.close()
+            metrics.BYTES.inc(ENGINE, 'up', value=sent + up)
+            metrics.BYTES.inc(ENGINE, 'down', value=down)
+            self.target, self.up, self.down = f'{target.host}:{target.port}', sent + up, down
 
-    def do_request(self, func: typing.Callable):
+    def forward_buffered(self, remote: socket.socket) -> int:
+        """
+        转发rfile中已缓冲的数据(客户端紧跟CONNECT发送的数据)
+        :param remote:
+        :return:
+        """
+        self.connection.setblocking(False)
+        try:
+            data = self.rfile.read1(relay.BUFFER_SIZE)
+        except OSError:
+            data = b''
+        finally:
+            self.connection.settimeout(self.timeout)
+        if data:
+            remote.sendall(data)
+        return len(data)
+
+    def do_request(self, func: typing.Callable, cacheable: bool = False):
+        try:
+            has_body = self.has_body()
+        except BadRequest as e:
+            # 请求体无法分帧, 返回400后关闭连接
+            logger.warning(f'{self.command} {self.path} {self.protocol_version}: {util.err_msg(e)}')
+            self.close_connection = True
+            self.send_error(code=400)
+            return
+        # GET/HEAD不读取请求体, 剩余数据会被当作下一个请求, 不再复用连接
+        if self.command in ('GET', 'HEAD') and has_body:
+            self.close_connection = True
         # allows and denys
-        if self.is_deny() or not self.is_allow():
+        if not self.is_admitted():
             self.send_error(code=403)
             return
+        if not self.within_limit():
+            return
+        rules = runner.snapshot()
+        # plugins
+        if rules.hooks and not self.pre_route(rules.hooks):
+            return
         # rewrite
         try:
             url_parts = urllib3.util.parse_url(self.path)
-            uri = runner.rewrite_uri(url_parts)
-            url = runner.rewrite_domain(url_parts) + uri
-            if uri.startswith('http://') or uri.startswith('https://'):
-                url = uri
+            url, key, backend = rules.route(url_parts)
         except BaseException as e:
             logger.error(f'{self.command} {self.path} {self.protocol_version}: {util.err_msg(e)}\n'
                          f'{util.err_msg(e)}')
             raise
         # forward
+        self.target = url
+        if self.ctx is not None:
+            self.ctx.target = url
+        lease, flight, leader, failed = None, None, False, False
         try:
-            with func(url) as response:
-                logger.info(f'{self.command} {url} {self.protocol_version} {response.status_code}')
-                # code
-                self.send_response(response.status_code)
-                # headers
-                self.resp_headers(response)
-                # body
-                self.resp_data(response)
+            entry = cache.responses.lookup(key, self.headers) if cacheable else None
+            unconditional = func
+            if entry is not None:
+                if self.from_cache(entry, url):
+                    return
+                func = self.revalidate(entry, func)
+            # 合并相同的并发GET
+            if self.command == 'GET' and coalesce.flights.enabled and not has_body:
+                flight, leader = coalesce.flights.join(coalesce.flights.key(
+                    self.command, key, self.headers, entry.validators() if entry is not None else None))
+            lease = balancer.Lease(backend) if backend is not None and (flight is None or leader) else None
+            evicted = False
+            with self.fetch(func, url, flight if leader else None, lease, None if leader else flight) as result:
+                if entry is not None and result.status == 304 and entry.validators():
+                    fresh = cache.responses.refresh(entry, result.headers)
+                    if self.send_cached(fresh, 'REVALIDATED', 'revalidated'):
+                        return
+                    evicted = True
+                else:
+                    self.send_upstream(result, key, cacheable)
+            if evicted:
+                # 磁盘层文件在lookup之后被淘汰: 不带条件重新请求
+                with self.fetch(unconditional, url) as result:
+                    self.send_upstream(result, key, cacheable)
+            if not cacheable and self.command not in ('GET', 'HEAD') and result.status < 400:
+                cache.responses.invalidate(key)
+        except BadRequest as e:
+            # 请求体已无法分帧, 返回400后关闭连接
+            failed = True
+            logger.warning(f'{self.command} {url} {self.protocol_version}: {util.err_msg(e)}')
+            self.close_connection = True
+            self.status is None and self.send_error(code=400)
+        except requests.exceptions.RequestException as e:
+            failed = True
+            logger.error(f'{self.command} {url} {self.protocol_version}\n'
+                         f'{util.err_msg(e)}')
+            # 已开始响应时只能断开连接; 否则返回502/504, 客户端连接继续keep-alive
+            if self.status is not None:
+                raise
+            self.send_gateway_error(504 if isinstance(e, requests.exceptions.Timeout) else 502)
         except BaseException as e:
+            failed = True
             logger.error(f'{self.command} {url} {self.protocol_version}\n'
                          f'{util.err_msg(e)}')
             raise
+        finally:
+            lease and lease.release()
+            leader and coalesce.flights.leave(flight, failed)
+
+    def send_upstream(self, result: coalesce.Result, key: str, cacheable: bool):
+        """
+        转发上游的响应
+        :param result:
+        :param key: 缓存key
+        :param cacheable: 是否写入缓存
+        :return:
+        """
+        # 缓存上游的响应体(未经代理压缩), 共享的响应由leader缓存
+        recorder = cache.responses.record(key, self.headers, result.status, result.reason, result.headers,
+                                          result.decoded) if cacheable and not result.shared else None
+        # code: 使用上游的Server/Date
+        self.send_response_only(result.status, result.reason)
+        # headers
+        headers, body_filter = self.post_response(result.status, result.items)
+        headers, encoder = compression.prepare(settings.compression, self.command, result.status,
+                                               self.headers.get('Accept-Encoding'), headers)
+        chunked = self.is_chunked(result.status, headers)
+        self.cache_status = 'MISS' if cacheable else ''
+        self.resp_headers(headers, {'X-Cache': 'MISS'} if cacheable else None, chunked)
+        # body
+        self.resp_data(result.chunks, recorder, chunked, encoder, body_filter)
+
+    @contextlib.contextmanager
+    def fetch(self, func: typing.Callable, url: str, publish: coalesce.Flight = None,
+              lease: balancer.Lease = None, follow: coalesce.Flight = None) -> typing.Iterator[coalesce.Result]:
+        """
+        请求上游
+        :param func:
+        :param url:
+        :param publish: 合并请求的leader, 响应写入共享缓冲
+        :param lease: 多后端规则选择的后端
+        :param follow: 合并请求的跟随者, 共享leader的响应, leader出错时自己请求
+        :return:
+        """
+        if follow is not None and follow.wait(self.timeout):
+            yield follow.follow(lambda: self.fetch(func, url), self.timeout)
+            return
+        decode = settings.compression.mode == 'decode'
+        start = time.monotonic()
+        with func(url) as response:
+            metrics.UPSTREAM_TTFB.observe(time.monotonic() - start, ENGINE)
+            lease and lease.response(response.status_code)
+            # iter_content凑满chunk_size才返回, 解压时使用小块
+            result = coalesce.Result(response.status_code, response.reason, response.headers,
+                                     upstream.body_headers(response, decode), decode and upstream.is_decoded(response),
+                                     upstream.iter_body(response, decode, 4096 if decode else BLOCK_SIZE))
+            yield publish.publish(result) if publish is not None else result
+
+    def pre_route(self, plugins: hooks.Hooks) -> bool:
+        """
+        插件pre_route: 可修改请求的URL和header, 或直接返回状态码
+        :param plugins:
+        :return: 是否继续转发
+        """
+        self.plugins = plugins
+        self.ctx = hooks.Context(ENGINE, self.client_address[0], self.command, self.path, self.headers.items())
+        status = plugins.pre_route(self.ctx)
+        if status:
+            self.send_error(code=status)
+            return False
+        self.path = self.ctx.url
+        for header in set(self.headers.keys()):
+            del self.headers[header]
+        for header, value in self.ctx.headers.items():
+            self.headers[header] = value
+        return True
+
+    def post_response(self, status: int, headers: typing.List[typing.Tuple[str, str]]
+                      ) -> typing.Tuple[typing.List[typing.Tuple[str, str]], typing.Optional[hooks.BodyFilter]]:
+        """
+        插件post_response, 有body_filter时响应体长度未知
+        :param status:
+        :param headers:
+        :return: 响应头, body_filter链
+        """
+        if self.ctx is None:
+            return headers, None
+        self.plugins.post_response(self.ctx, status, headers)
+        body_filter = self.plugins.body_filter(self.ctx, self.command, status)
+        if body_filter is not None:
+            headers = [(k, v) for k, v in headers if k.lower() != 'content-length']
+        return headers, body_filter
+
+    def from_cache(self, entry: cache.Entry, url: str) -> bool:
+        """
+        新鲜的缓存直接返回; 过期但在stale-while-revalidate内时返回旧响应并后台重新验证
+        :param entry:
+        :param url: 本次转发的url(多后端规则时与缓存的url不同)
+        :return: 是否已响应
+        """
+        if cache.must_revalidate(self.headers):
+            return False
+        if entry.fresh():
+            return self.send_cached(entry, 'HIT', 'hits')
+        if entry.stale_usable() and self.send_cached(entry, 'STALE', 'stale_hits'):
+            cache.responses.revalidate_async(entry, self.req_headers(), timeout=self.timeout, url=url)
+            return True
+        return False
+
+    def revalidate(self, entry: cache.Entry, func: typing.Callable) -> typing.Callable:
+        """
+        过期缓存: 带上ETag/Last-Modified发送条件请求
+        :param entry:
+        :param func:
+        :return:
+        """
+        validators = entry.validators()
+        if not validators:
+            return func
+        headers = {k: v for k, v in self.req_headers().items() if k.lower() not in cache.CONDITIONAL_HEADERS}
+        headers.update(validators)
+        return lambda url: upstream.sessions.request('GET', url=url, headers=headers, timeout=self.timeout)
+
+    def send_cached(self, entry: cache.Entry, status: str, kind: str = None) -> bool:
+        """
+        发送缓存的响应, 磁盘层使用sendfile
+        :param entry:
+        :param status: X-Cache
+        :param kind: 统计类型
+        :return: 磁盘文件已被淘汰时返回False
+        """
+        file = cache.responses.open(entry) if entry.path else None
+        if entry.path and file is None:
+            return False
+        self.target, self.cache_status = entry.url, status
+        kind and cache.responses.hit(entry, kind)
+        extra = {'Age': str(int(entry.age())), 'X-Cache': status}
+        if cache.not_modified(entry, self.headers):
+            self.send_response_only(304)
+            self.resp_headers({'ETag': entry.headers['ETag'], 'Date': self.date_time_string()}, extra)
+            file and file.close()
+            return True
+        self.send_response_only(entry.status, entry.reason)
+        headers, body_filter = self.post_response(entry.status, list(entry.headers.items()))
+        headers, encoder = compression.prepare(settings.compression, self.command, entry.status,
+                                               self.headers.get('Accept-Encoding'), headers)
+        if encoder is not None or body_filter is not None:
+            # 缓存的是上游的响应体, 经插件过滤/压缩后发送
+            chunked = self.is_chunked(entry.status, headers)
+            self.resp_headers(headers, extra, chunked)
+            try:
+                with file or contextlib.nullcontext():
+                    chunks = iter(lambda: file.read(BLOCK_SIZE), b'') if file else (entry.body,)
+                    self.write_body(chunks, chunked, encoder, body_filter)
+            finally:
+                metrics.BYTES.inc(ENGINE, 'down', value=self.down)
+            return True
+        self.resp_headers(headers, extra)
+        metrics.BYTES.inc(ENGINE, 'down', value=entry.size)
+        self.down = entry.size
+        if file is None:
+            self.wfile.write(entry.body)
+            return True
+        with file:
+            self.connection.sendfile(file)
+        return True
+
+    @contextlib.contextmanager
+    def send_with_body(self, method: str, url: str):
+        """
+        转发带请求体的请求, 请求体以Content-Length发送
+        :param method:
+        :param url:
+        :return:
+        """
+        data = self.req_data()
+        try:
+            headers = self.req_headers()
+            if data is not None:
+                size = len(data) if isinstance(data, bytes) else os.fstat(data.fileno()).st_size
+                headers['Content-Length'] = str(size)
+                metrics.BYTES.inc(ENGINE, 'up', value=size)
+                self.up = size
+            with upstream.sessions.request(method, url=url, headers=headers, data=data,
+                                           timeout=self.timeout) as response:
+                yield response
+        finally:
+            if data is not None and not isinstance(data, bytes):
+                data.close()
+
+    def send_gateway_error(self, code: int):
+        """
+        上游出错的响应, 与send_error不同, 不关闭客户端连接
+        :param code: 502/504
+        :return:
+        """
+        body = f'{code} {http.HTTPStatus(code).phrase}\n'.encode('ascii')
+        self.send_response_only(code)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+            self.down += len(body)
 
     def req_headers(self) -> dict:
         headers = {}
+        skip = util.hop_headers(self.headers.get('Connection'))
         for header, value in self.headers.items():
+            # 请求体已由代理读取, 长度重新计算
+            if header.lower() in BODY_HEADERS or header.lower() in skip:
+                continue
             headers.update({header: value})
+        # 原样转发响应体时, 不使用requests默认的Accept-Encoding(客户端可能不支持)
+        if 'Accept-Encoding' not in self.headers and settings.compression.mode != 'decode':
+            headers['Accept-Encoding'] = None
         return headers
 
-    def req_data(self) -> typing.AnyStr:
-        return self.rfile.read()
-
-    def resp_headers(self, response: requests.Response):
-        # cross domain
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST')
-        # for header, value in response.headers.items():
-        for header in ['Content-Type', 'Content-Length']:  # 'Transfer-Encoding', 'Connection', 'Content-Encoding'
-            value = response.headers.get(header, None)
-            if value:
-                self.send_header(header, value)
-        self.end_headers()
+    def has_body(self) -> bool:
+        return self.content_length() > 0 or 'Transfer-Encoding' in self.headers
+
+    def content_length(self) -> int:
+        """
+        解析Content-Length
+        :return: 未设置时为0
+        """
+        value = (self.headers.get('Content-Length') or '0').strip()
+        if not (value.isascii() and value.isdigit()):
+            raise BadRequest(f'Invalid Content-Length: {value[:32]!r}')
+        return int(value)
+
+    def req_data(self) -> typing.Union[bytes, typing.BinaryIO, None]:
+        """
+        读取请求体(Content-Length或chunked), 超过spool_size时写入临时文件
+        :return: bytes/临时文件/None
+        """
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            chunks = self.read_chunked()
+        else:
+            length = self.content_length()
+            if length <= 0:
+                return None
+            chunks = self.read_length(length)
+        return spool(chunks, settings.body.spool_size, settings.body.spool_dir)
 
-    def resp_data(self, response: requests.Response):
-        for content in response.iter_content(chunk_size=4096):
-            self.wfile.write(content)
+    def read_length(self, length: int) -> typing.Iterator[bytes]:
+        while length > 0:
+            data = self.rfile.read(min(length, BLOCK_SIZE))
+            if not data:
+                raise ConnectionError('Incomplete Request Body')
+            length -= len(data)
+            yield data
 
-    def is_allow(self) -> bool:
-        host, port = self.client_address
-        if not settings.allows:
+    def read_chunked(self) -> typing.Iterator[bytes]:
+        while True:
+            line = self.rfile.readline(MAX_LINE)
+            if not line:
+                raise ConnectionError('Incomplete Chunked Body')
+            field = line.split(b';', 1)[0].strip()
+            try:
+                size = int(field, 16)
+            except ValueError:
+                size = -1
+            if size < 0:
+                raise BadRequest(f'Invalid Chunk Size: {field[:32]!r}')
+            if not size:
+                break
+            yield from self.read_length(size)
+            self.rfile.readline(MAX_LINE)
+        # trailer
+        while self.rfile.readline(MAX_LINE) not in (b'\r\n', b'\n', b''):
+            pass
+
+    def is_chunked(self, status: int, headers: typing.List[typing.Tuple[str, str]]) -> bool:
+        """
+        响应体分帧: 有Content-Length时原样转发; 否则HTTP/1.1客户端使用chunked, HTTP/1.0客户端发送完后关闭连接
+        :param status:
+        :param headers:
+        :return: 是否使用chunked
+        """
+        if self.command == 'HEAD' or status < 200 or status in (204, 304):
+            return False
+        if any(k.lower() == 'content-length' for k, _ in headers):
+            return False
+        if self.request_version != 'HTTP/1.0':
             return True
-        for allow in settings.allows:
-            if re.match(pattern=allow, string=host):
-                return True
+        self.close_connection = True
         return False
 
-    def is_deny(self) -> bool:
-        host, port = self.client_address
-        if not settings.denys:
+    def resp_headers(self, headers: typing.Union[typing.Mapping[str, str], typing.Iterable[typing.Tuple[str, str]]],
+                     extra: dict = None, chunked: bool = False):
+        """
+        转发端到端header, 去掉逐跳header
+        :param headers: 上游响应头, dict或(name, value)列表
+        :param extra: 代理添加的header
+        :param chunked: 响应体使用chunked编码
+        :return:
+        """
+        items = headers.items() if isinstance(headers, typing.Mapping) else headers
+        connection = next((v for k, v in items if k.lower() == 'connection'), None)
+        skip = util.hop_headers(connection)
+        # cross domain: 使用配置的CORS header, 不重复转发上游的
+        cors = settings.cors.headers()
+        if cors:
+            skip = skip.union(name.lower() for name, _ in cors)
+        for header, value in items:
+            if header.lower() not in skip:
+                self.send_header(header, value)
+        for header, value in cors:
+            self.send_header(header, value)
+        for header, value in (extra or {}).items():
+            self.send_header(header, value)
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        elif self.request_version == 'HTTP/1.0':
+            self.send_header('Connection', 'keep-alive')
+        self.end_headers()
+
+    def resp_data(self, chunks: typing.Iterable[bytes], recorder: cache.Recorder = None, chunked: bool = False,
+                  encoder: compression.Compressor = None, body_filter: hooks.BodyFilter = None):
+        """
+        转发响应体
+        :param chunks: 上游的响应体
+        :param recorder: 缓存上游的响应体
+        :param chunked: 使用chunked编码
+        :param encoder: 代理压缩
+        :param body_filter: 插件过滤
+        :return:
+        """
+        try:
+            self.write_body(recorder.tee(chunks) if recorder else chunks, chunked, encoder, body_filter)
+        except BaseException:
+            recorder and recorder.abort()
+            raise
+        finally:
+            metrics.BYTES.inc(ENGINE, 'down', value=self.down)
+        recorder and recorder.commit()
+
+    def write_body(self, chunks: typing.Iterable[bytes], chunked: bool = False,
+                   encoder: compression.Compressor = None, body_filter: hooks.BodyFilter = None):
+        """
+        写出响应体, 累计到self.down
+        :param chunks:
+        :param chunked: 使用chunked编码
+        :param encoder: 代理压缩
+        :param body_filter: 插件过滤, 在压缩之前
+        :return:
+        """
+        for content in chunks:
+            if body_filter:
+                content = body_filter.filter(content)
+            if encoder and content:
+                content = encoder.compress(content)
+            if content:
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(content), content) if chunked else content)
+                self.down += len(content)
+        content = body_filter.flush() if body_filter else b''
+        if encoder:
+            content = encoder.compress(content) + encoder.flush()
+        if content:
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(content), content) if chunked else content)
+            self.down += len(content)
+        chunked and self.wfile.write(b'0\r\n\r\n')
+
+    def is_admitted(self) -> bool:
+        host, port = self.client_address[:2]
+        return acl.admit(host)
+
+    def within_limit(self) -> bool:
+        """
+        每个客户端的请求速率, 超出时返回429并关闭连接
+        :return:
+        """
+        try:
+            ratelimit.acquire(ENGINE, self.client_address[0], connection=False)
+            return True
+        except ratelimit.Limited as e:
+            self.close_connection = True
+            self.send_response(429)
+            self.send_header('Retry-After', str(e.retry_after))
+            self.send_header('Content-Length', '0')
+            self.send_header('Connection', 'close')
+            self.end_headers()
             return False
-        for deny in settings.denys:
-            if re.match(pattern=deny, string=host):
-                return False
-        return True
+
+
+def spool(chunks: typing.Iterable[bytes], spool_size: int, spool_dir: str = None
+          ) -> typing.Union[bytes, typing.BinaryIO]:
+    """
+    缓存请求体: 不超过spool_size时返回bytes, 否则写入临时文件
+    :param chunks:
+    :param spool_size:
+    :param spool_dir:
+    :return:
+    """
+    buffer = bytearray()
+    for data in chunks:
+        buffer += data
+        if len(buffer) > spool_size:
+            break
+    else:
+        return bytes(buffer)
+    file = tempfile.TemporaryFile(dir=spool_dir or None)
+    try:
+        file.write(buffer)
+        del buffer
+        for data in chunks:
+            file.write(data)
+        file.flush()
+        file.seek(0)
+    except BaseException:
+        file.close()
+        raise
+    return file
 
 
 def start_server(ip: str = '0.0.0.0', port: int = 1080, timeout: int = 60):
     ProxyHandler.timeout = timeout
-    http_server = ThreadingHTTPServer((ip, port), ProxyHandler)
+    upstream.sessions.configure(settings.pool)
+    cache.responses.configure(settings.cache)
+    coalesce.flights.configure(settings.coalesce)
+    http_server = ThreadingHTTPServer((ip, port), ProxyHandler, bind_and_activate=False)
+    workers.bind(http_server)
     print("**********************************************************")
     print("******************* CaulProxy 1.0.0 **********************")
     print(f"*******************  IP:{ip} PORT:{port} ***********")
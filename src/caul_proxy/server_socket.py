@@ -1,36 +1,184 @@
+import queue
 import socket
 import threading
+import time
+import typing
 import urllib.parse
 
-from caul_proxy.config import logger
+from caul_proxy import acl, metrics, workers, config, access_log, ratelimit, shaping
+from caul_proxy.config import settings, logger
+from caul_proxy.resolver import dns
 
+ENGINE = 'socket'
+RESPONSE_503 = b'HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n'
 
-def create_proxy_server(ip: str = '0.0.0.0', port: int = 1080) -> socket.socket:
+QUEUE_WAIT = metrics.Histogram('caul_queue_wait_seconds', 'Time accepted connections wait for a worker thread',
+                               ('engine',))
+REJECTED = metrics.Counter('caul_rejected_total', 'Connections answered with 503 due to overload',
+                           ('engine', 'reason'))
+
+
+class BoundedExecutor:
+    """
+    有界线程池: 线程按需创建, 最多threads个; 等待队列满时submit返回False, 由调用方施加背压
+    """
+
+    def __init__(self, conf: config.Executor, handler: typing.Callable[..., None]):
+        self.threads = max(1, conf.threads)
+        self.queue = queue.Queue(max(1, conf.queue_size))
+        self.handler = handler
+        self.started = 0
+        self.busy = 0
+        # 等待任务且未被submit占用的线程数; 线程全忙时排队, 尚无线程处理的任务数
+        self.idle = 0
+        self.unclaimed = 0
+        self._lock = threading.Lock()
+
+    def submit(self, *args, block: bool = False) -> bool:
+        """
+        提交任务
+        :param args: handler的参数, 之后追加排队时间(秒)
+        :param block: 队列满时是否等待
+        :return: 队列满时返回False
+        """
+        try:
+            self.queue.put((time.monotonic(), args), block=block)
+        except queue.Full:
+            return False
+        with self._lock:
+            # 每个任务占用一个空闲线程, 没有空闲线程时创建新线程(新线程由该任务占用)
+            if self.idle:
+                self.idle -= 1
+            elif self.started < self.threads:
+                self.started += 1
+                threading.Thread(target=self._run, name=f'SocketWorker-{self.started}', daemon=True).start()
+            else:
+                self.unclaimed += 1
+        return True
+
+    def _run(self):
+        while True:
+            enqueued, args = self.queue.get()
+            with self._lock:
+                self.busy += 1
+            try:
+                self.handler(*args, time.monotonic() - enqueued)
+            except Exception as e:
+                logger.exception(f'Executor: {e}')
+            finally:
+                with self._lock:
+                    self.busy -= 1
+                    # 有排队的任务时直接处理, 否则成为空闲线程
+                    if self.unclaimed:
+                        self.unclaimed -= 1
+                    else:
+                        self.idle += 1
+
+    def stats(self) -> dict:
+        return {'threads': self.started, 'max_threads': self.threads, 'busy': self.busy, 'idle': self.idle,
+                'queued': self.queue.qsize(), 'queue_size': self.queue.maxsize,
+                'utilization': self.busy / self.threads}
+
+
+executor: typing.Optional[BoundedExecutor] = None
+metrics.GaugeFunc('caul_executor', 'Socket engine worker threads and accept queue',
+                  lambda: metrics.flatten(executor.stats()) if executor else {}, ('stat',))
+
+
+def create_proxy_server(ip: str = '0.0.0.0', port: int = 1080, backlog: int = 10) -> socket.socket:
     proxy_server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     proxy_server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    workers.reuse_port(proxy_server_socket)
     proxy_server_socket.bind((ip, port))
-    proxy_server_socket.listen(10)
+    proxy_server_socket.listen(backlog)
     return proxy_server_socket
 
 
-def handle_http_get(client_socket: socket.socket, timeout: int = 60):
+def serve_client(client_socket: socket.socket, client_address: tuple, timeout: int, waited: float):
+    """
+    线程池中处理连接, 排队过久时直接返回503(客户端很可能已放弃)
+    :param client_socket:
+    :param client_address:
+    :param timeout:
+    :param waited: 排队时间(秒)
+    :return:
+    """
+    QUEUE_WAIT.observe(waited, ENGINE)
+    queue_timeout = settings.executor.queue_timeout
+    if queue_timeout and waited > queue_timeout:
+        reject(client_socket, 'timeout')
+        return
+    handle_http_get(client_socket, timeout, client_address)
+
+
+def reject(client_socket: socket.socket, reason: str):
+    """
+    过载时快速返回503
+    :param client_socket:
+    :param reason: full: 队列已满; timeout: 排队超时
+    :return:
+    """
+    REJECTED.inc(ENGINE, reason)
+    metrics.REQUESTS.inc(ENGINE, '-', '503')
+    try:
+        client_socket.settimeout(1)
+        client_socket.sendall(RESPONSE_503)
+    except OSError:
+        pass
+    finally:
+        client_socket.close()
+
+
+def handle_http_get(client_socket: socket.socket, timeout: int = 60, client_address: tuple = None):
     """
     处理客户端请求
     :param client_socket:
     :param timeout:
+    :param client_address:
     :return:
     """
-    target_socket = None
+    target_socket, slot, tunnel = None, None, None
+    start = time.monotonic()
+    method, target, protocol, status, size = '-', '-', '-', 'error', 0
+    metrics.ACTIVE_CONNECTIONS.inc(ENGINE)
     try:
+        # 线程池有界, 不能让空闲客户端一直占用线程
+        client_socket.settimeout(timeout)
+        # allows and denys
+        if client_address and not acl.admit(client_address[0]):
+            status = 403
+            client_socket.sendall(b'HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+            return
+        # 每个客户端的请求速率及并发连接数
+        if client_address:
+            try:
+                slot = ratelimit.acquire(ENGINE, client_address[0])
+            except ratelimit.Limited as e:
+                status = 429
+                client_socket.sendall(b'HTTP/1.1 429 Too Many Requests\r\nRetry-After: %d\r\nContent-Length: 0\r\n'
+                                      b'Connection: close\r\n\r\n' % e.retry_after)
+                return
         request_header = parse_http_header(client_socket)
+        request_line = request_header.split(b'\r\n', 1)[0].decode('latin-1').split(' ')
+        method, target, protocol = (request_line + ['-'] * 3)[:3]
+        method = method or '-'
         target_socket = send_target_server(request_header)
         target_socket.settimeout(timeout)
-        forward_response(client_socket, target_socket)
+        tunnel = shaping.shaper.open(client_address[0]) if client_address else None
+        status, size = forward_response(client_socket, target_socket, start, tunnel.down if tunnel else None)
     except:
         logger.exception("Proxy Error")
     finally:
         client_socket.close()
         target_socket and target_socket.close()
+        ratelimit.release(slot)
+        tunnel and tunnel.close()
+        metrics.ACTIVE_CONNECTIONS.dec(ENGINE)
+        metrics.REQUESTS.inc(ENGINE, method, str(status))
+        metrics.REQUEST_DURATION.observe(time.monotonic() - start, ENGINE)
+        client_address and access_log.log(ENGINE, client_address[0], method, target, protocol,
+                                          status if isinstance(status, int) else 0, time.monotonic() - start,
+                                          down=size)
 
 
 header_end = b'\r\n\r\n'
@@ -49,19 +197,32 @@ def parse_http_header(client_socket: socket.socket) -> bytes:
             break
         request_header += data
         if header_end in request_header:
-            return request_header.split(header_end)[0]
+            # 保留协议头结束符及已读到的请求体, 否则上游一直等待协议头结束
+            return close_connection(request_header)
     return request_header
 
 
+def close_connection(request: bytes) -> bytes:
+    """
+    上游响应后关闭连接: 转发以上游关闭连接作为响应结束
+    :param request: 协议头(含结束符)及已读到的请求体
+    :return:
+    """
+    head, body = request.split(header_end, 1)
+    lines = [line for line in head.split(b'\r\n')
+             if line.split(b':', 1)[0].strip().lower() not in (b'connection', b'proxy-connection', b'keep-alive')]
+    lines.append(b'Connection: close')
+    return b'\r\n'.join(lines) + header_end + body
+
+
 def send_target_server(request_header: bytes) -> socket.socket:
     """
     发送目标服务器
     :param request_header:
     :return:
     """
-    target_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    target_socket.connect(parse_target_address(request_header))
-    target_socket.send(request_header)
+    target_socket = dns.create_connection(parse_target_address(request_header))
+    target_socket.sendall(request_header)
     return target_socket
 
 
@@ -72,9 +233,9 @@ def parse_target_address(request_header: bytes) -> (str, int):
     :return:
     """
     # 解析请求报文
-    header_lines = request_header.decode('utf8').split("\r\n")
+    request_line = request_header.split(b'\r\n', 1)[0].decode('latin-1')
     # 获取请求方法、URL和协议版本
-    _, url, *args = header_lines[0].split()
+    _, url, *args = request_line.split()
     # 解析URL
     url_parts = urllib.parse.urlparse(url)
     port = url_parts.port
@@ -83,25 +244,57 @@ def parse_target_address(request_header: bytes) -> (str, int):
     return url_parts.hostname, port
 
 
-def forward_response(client_socket: socket.socket, target_socket: socket.socket):
+def forward_response(client_socket: socket.socket, target_socket: socket.socket, start: float = None,
+                     flow: shaping.Flow = None) -> typing.Tuple[int, int]:
     """
     获取响应结果
     :param client_socket:
     :param target_socket:
-    :return:
+    :param start: 请求开始时间, 用于统计首字节时间
+    :param flow: 下行带宽整形, 令牌不足时等到可以读取QUANTUM字节
+    :return: 响应状态码(无法解析时为0), 响应字节数
     """
+    status, size = 0, 0
     while True:
-        data = target_socket.recv(4096)
+        limit = 4096
+        if flow is not None:
+            limit, delay = flow.allowance(limit)
+            if delay:
+                time.sleep(delay)
+                continue
+        data = target_socket.recv(limit)
         if not data:
             break
+        flow is not None and flow.consume(len(data))
+        if not size:
+            start and metrics.UPSTREAM_TTFB.observe(time.monotonic() - start, ENGINE)
+            status = parse_status(data)
+        size += len(data)
         client_socket.send(data)
         # if data.endswith(b'\r\n\r\n'):
         #     break
+    metrics.BYTES.inc(ENGINE, 'down', value=size)
+    return status, size
+
+
+def parse_status(data: bytes) -> int:
+    """
+    从响应首行解析状态码: HTTP/1.1 200 OK
+    :param data:
+    :return:
+    """
+    parts = data.split(b'\r\n', 1)[0].split(b' ', 2)
+    if len(parts) < 2 or not parts[0].startswith(b'HTTP/') or not parts[1].isdigit():
+        return 0
+    return int(parts[1])
 
 
 def start_server(ip: str = '0.0.0.0', port: int = 1080, timeout: int = 60):
+    global executor
+    conf = settings.executor
     # 创建代理服务器套接字(只支持GET请求)
-    server_socket = create_proxy_server(ip=ip, port=port)
+    server_socket = create_proxy_server(ip=ip, port=port, backlog=conf.backlog)
+    executor = BoundedExecutor(conf, serve_client)
     print("**********************************************************")
     print("******************* CaulProxy 1.0.0 **********************")
     print(f"*******************  IP:{ip} PORT:{port} ***********")
@@ -109,6 +302,7 @@ def start_server(ip: str = '0.0.0.0', port: int = 1080, timeout: int = 60):
     while True:
         # 等待客户端连接
         client_socket, client_address = server_socket.accept()
-        # 创建线程处理客户端请求
-        client_thread = threading.Thread(target=handle_http_get, args=(client_socket, timeout))
-        client_thread.start()
+        # 交给线程池处理, 队列满时返回503或暂停accept
+        pause = settings.executor.overload == 'pause'
+        if not executor.submit(client_socket, client_address, timeout, block=pause):
+            reject(client_socket, 'full')
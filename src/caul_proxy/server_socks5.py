@@ -1,12 +1,18 @@
 # -*- coding: utf-8 -*-
 
+import hmac
 import socket
 import struct
+import time
+import typing
 from socketserver import StreamRequestHandler as Tcp, ThreadingTCPServer
 
-import select
+from caul_proxy import relay, acl, metrics, workers, access_log, ratelimit, shaping
+from caul_proxy.config import settings, logger
+from caul_proxy.resolver import dns
 
 SOCKS_VERSION = 5  # socks版本
+ENGINE = 'socks5'
 
 """
 +++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -40,13 +46,118 @@ SOCKS_VERSION = 5  # socks版本
 """
 
 
+# 认证方式
+METHOD_NONE = 0x00
+METHOD_USERPASS = 0x02
+METHOD_NO_ACCEPTABLE = 0xFF
+# 用户名/密码认证子协议版本
+AUTH_VERSION = 1
+# 命令
+CMD_CONNECT = 1
+# 地址类型
+ATYP_IPV4 = 1
+ATYP_DOMAIN = 3
+ATYP_IPV6 = 4
+# 回应码
+REP_SUCCEEDED = 0x00
+REP_FAILURE = 0x01
+REP_NOT_ALLOWED = 0x02
+REP_HOST_UNREACHABLE = 0x04
+REP_CONNECTION_REFUSED = 0x05
+REP_COMMAND_NOT_SUPPORTED = 0x07
+REP_ADDRESS_NOT_SUPPORTED = 0x08
+
+
+def select_method(methods: typing.Iterable[int]) -> int:
+    """
+    选择认证方式: 配置了用户时只接受用户名/密码认证
+    :param methods:
+    :return:
+    """
+    expect = METHOD_USERPASS if settings.socks5.users else METHOD_NONE
+    return expect if expect in methods else METHOD_NO_ACCEPTABLE
+
+
+def check_auth(username: bytes, password: bytes) -> bool:
+    """
+    校验用户名和密码
+    :param username:
+    :param password:
+    :return:
+    """
+    expect = settings.socks5.users.get(username.decode('utf-8', 'replace'))
+    return expect is not None and hmac.compare_digest(expect.encode('utf-8'), password)
+
+
+def pack_reply(rep: int, bind_address: tuple = None) -> bytes:
+    """
+    生成回复包, bind_address为空时返回0.0.0.0:0
+    :param rep:
+    :param bind_address:
+    :return:
+    """
+    if not bind_address:
+        return struct.pack("!BBBB4sH", SOCKS_VERSION, rep, 0, ATYP_IPV4, bytes(4), 0)
+    host, port = bind_address[:2]
+    if ':' in host:
+        return struct.pack("!BBBB16sH", SOCKS_VERSION, rep, 0, ATYP_IPV6,
+                           socket.inet_pton(socket.AF_INET6, host), port)
+    return struct.pack("!BBBB4sH", SOCKS_VERSION, rep, 0, ATYP_IPV4, socket.inet_aton(host), port)
+
+
+def unpack_address(address_type: int, data: bytes) -> typing.Optional[str]:
+    """
+    解析DST.ADDR
+    :param address_type:
+    :param data: 地址数据(域名不含长度字节)
+    :return: 域名无法解码时返回None
+    """
+    if address_type == ATYP_IPV4:
+        return socket.inet_ntop(socket.AF_INET, data)
+    if address_type == ATYP_IPV6:
+        return socket.inet_ntop(socket.AF_INET6, data)
+    try:
+        address = data.decode('idna')
+        # 解析时会重新编码, 标签过长等在这里一并检查
+        address.encode('idna')
+    except UnicodeError:
+        return None
+    return address
+
+
 class ProxyHandler(Tcp):
-    # 用户认证 用户名/密码
-    username = 'caul'
-    password = 'caulproxy'
+
+    # 认证后的用户名, 限流占用的连接
+    user: typing.Optional[str] = None
+    slot: typing.Optional[ratelimit.Bucket] = None
+    user_slot: typing.Optional[ratelimit.Bucket] = None
+
+    def setup(self):
+        metrics.ACTIVE_CONNECTIONS.inc(ENGINE)
+        super().setup()
+
+    def finish(self):
+        metrics.ACTIVE_CONNECTIONS.dec(ENGINE)
+        ratelimit.release(self.slot)
+        ratelimit.release(self.user_slot)
+        super().finish()
 
     def handle(self):
-        print("客户端：", self.client_address, " 请求连接！")
+        started = time.monotonic()
+        logger.debug(f'SOCKS5 {self.client_address} Connected')
+        # allows and denys
+        if not acl.admit(self.client_address[0]):
+            metrics.REQUESTS.inc(ENGINE, 'CONNECT', str(REP_NOT_ALLOWED))
+            access_log.log(ENGINE, self.client_address[0], 'CONNECT', '-', 'SOCKS5', REP_NOT_ALLOWED,
+                           time.monotonic() - started, failed=True)
+            self.server.close_request(self.request)
+            return
+        # 每个客户端的连接速率及并发连接数, 超出时在协商阶段拒绝
+        try:
+            self.slot = ratelimit.acquire(ENGINE, self.client_address[0])
+            limited = False
+        except ratelimit.Limited:
+            limited = True
         """
         一、客户端认证请求
             +----+----------+----------+
@@ -56,19 +167,15 @@ class ProxyHandler(Tcp):
             +----+----------+----------+
         """
         # 从客户端读取并解包两个字节的数据
-        header = self.connection.recv(2)
+        header = self.recv(2)
         VER, NMETHODS = struct.unpack("!BB", header)
         # 设置socks5协议，METHODS字段的数目大于0
         assert VER == SOCKS_VERSION, f'SOCKS版本错误: {VER}'
 
         # 接受支持的方法
         # 无需认证：0x00    用户名密码认证：0x02
-        # assert NMETHODS > 0
         methods = self.is_available(NMETHODS)
-        # 检查是否支持该方式，不支持则断开连接
-        if 0 not in set(methods):
-            self.server.close_request(self.request)
-            return
+        method = METHOD_NO_ACCEPTABLE if limited else select_method(methods)
 
         """
         二、服务端回应认证
@@ -79,11 +186,25 @@ class ProxyHandler(Tcp):
             +----+--------+
         """
         # 发送协商响应数据包
-        self.connection.sendall(struct.pack("!BB", SOCKS_VERSION, 0))
+        self.connection.sendall(struct.pack("!BB", SOCKS_VERSION, method))
+        # 检查是否支持该方式，不支持则断开连接
+        if method == METHOD_NO_ACCEPTABLE:
+            if limited:
+                metrics.REQUESTS.inc(ENGINE, 'CONNECT', str(REP_NOT_ALLOWED))
+                access_log.log(ENGINE, self.client_address[0], 'CONNECT', '-', 'SOCKS5', REP_NOT_ALLOWED,
+                               time.monotonic() - started, failed=True)
+            self.server.close_request(self.request)
+            return
 
         # 校验用户名和密码
-        # if not self.VerifyAuth():
-        #    return
+        if method == METHOD_USERPASS and not self.verify_auth():
+            return
+        # 每个用户的连接速率及并发连接数, 超出时拒绝连接请求
+        if self.user is not None:
+            try:
+                self.user_slot = ratelimit.acquire(ENGINE, self.user, user=True)
+            except ratelimit.Limited:
+                limited = True
 
         """
         三、客户端连接请求(连接目的网络)
@@ -93,15 +214,23 @@ class ProxyHandler(Tcp):
             | 1  |  1  |   1   |  1   | Variable |    2     |
             +----+-----+-------+------+----------+----------+
         """
-        version, cmd, _, address_type = struct.unpack("!BBBB", self.connection.recv(4))
+        version, cmd, _, address_type = struct.unpack("!BBBB", self.recv(4))
         assert version == SOCKS_VERSION, f'socks版本错误: {version}'
-        if address_type == 1:  # IPv4
-            # 转换IPV4地址字符串（xxx.xxx.xxx.xxx）成为32位打包的二进制格式（长度为4个字节的二进制字符串）
-            address = socket.inet_ntoa(self.connection.recv(4))
-        elif address_type == 3:  # Domain
-            domain_length = ord(self.connection.recv(1)[0])
-            address = self.connection.recv(domain_length)
-        port = struct.unpack('!H', self.connection.recv(2))[0]
+        if address_type == ATYP_IPV4:
+            address = unpack_address(address_type, self.recv(4))
+        elif address_type == ATYP_IPV6:
+            address = unpack_address(address_type, self.recv(16))
+        elif address_type == ATYP_DOMAIN:
+            address = unpack_address(address_type, self.recv(self.recv(1)[0]))
+        else:
+            address = None
+        # 不支持的地址类型或无法解码的域名
+        if address is None:
+            metrics.REQUESTS.inc(ENGINE, 'CONNECT', str(REP_ADDRESS_NOT_SUPPORTED))
+            self.connection.sendall(self.reply_faild(address_type, REP_ADDRESS_NOT_SUPPORTED))
+            self.server.close_request(self.request)
+            return
+        port = struct.unpack('!H', self.recv(2))[0]
 
         """
         四、服务端回应连接
@@ -112,48 +241,60 @@ class ProxyHandler(Tcp):
             +----+-----+-------+------+----------+----------+
         """
         # 响应，只支持CONNECT请求
-        try:
-            if cmd == 1:  # CONNECT
-                remote = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                remote.connect((address, port))
-                bind_address = remote.getsockname()
-                print('已建立连接：', address, port)
-            else:
-                self.server.close_request(self.request)
-            addr = struct.unpack("!I", socket.inet_aton(bind_address[0]))[0]
-            port = bind_address[1]
-            reply = struct.pack("!BBBBIH", SOCKS_VERSION, 0, 0, address_type, addr, port)
-        except Exception as err:
-            print(err)
-            # 响应拒绝连接的错误
-            reply = self.reply_faild(address_type, 5)
+        remote = None
+        if limited:
+            reply = self.reply_faild(address_type, REP_NOT_ALLOWED)
+        elif cmd != CMD_CONNECT:
+            reply = self.reply_faild(address_type, REP_COMMAND_NOT_SUPPORTED)
+        else:
+            try:
+                remote = dns.create_connection((address, port))
+                remote.settimeout(self.timeout)
+                reply = pack_reply(REP_SUCCEEDED, remote.getsockname())
+            except Exception as err:
+                logger.warning(f'SOCKS5 {self.client_address} -> {address}:{port} {err}')
+                # 响应拒绝连接的错误
+                reply = self.reply_faild(address_type, REP_CONNECTION_REFUSED)
+        metrics.REQUESTS.inc(ENGINE, 'CONNECT', str(reply[1]))
         self.connection.sendall(reply)  # 发送回复包
 
         # 建立连接成功，开始交换数据
-        if reply[1] == 0 and cmd == 1:
-            self.exchange_data(self.connection, remote)
+        up, down = 0, 0
+        if remote is not None:
+            with remote:
+                up, down = self.exchange_data(self.connection, remote)
+        access_log.log(ENGINE, self.client_address[0], 'CONNECT', f'{address}:{port}', 'SOCKS5', reply[1],
+                       time.monotonic() - started, up, down, failed=reply[1] != REP_SUCCEEDED)
         self.server.close_request(self.request)
 
+    def recv(self, n: int) -> bytes:
+        """
+        读取n个字节
+        """
+        data = b''
+        while len(data) < n:
+            chunk = self.connection.recv(n - len(data))
+            if not chunk:
+                raise ConnectionError('SOCKS握手数据不完整')
+            data += chunk
+        return data
+
     def is_available(self, n):
         """
-        检查是否支持该验证方式
+        读取客户端支持的验证方式
         """
-        methods = []
-        for i in range(n):
-            methods.append(ord(self.connection.recv(1)))
-        return methods
+        return list(self.recv(n))
 
     def verify_auth(self):
         """
         校验用户名和密码
         """
-        version = ord(self.connection.recv(1))
-        assert version == 1
-        username_len = ord(self.connection.recv(1))
-        username = self.connection.recv(username_len).decode('utf-8')
-        password_len = ord(self.connection.recv(1))
-        password = self.connection.recv(password_len).decode('utf-8')
-        if username == self.username and password == self.password:
+        version = self.recv(1)[0]
+        assert version == AUTH_VERSION
+        username = self.recv(self.recv(1)[0])
+        password = self.recv(self.recv(1)[0])
+        if check_auth(username, password):
+            self.user = username.decode('utf-8', 'replace')
             # 验证成功, status = 0
             response = struct.pack("!BB", version, 0)
             self.connection.sendall(response)
@@ -168,28 +309,30 @@ class ProxyHandler(Tcp):
         """
         生成连接失败的回复包
         """
-        return struct.pack("!BBBBIH", SOCKS_VERSION, error_number, 0, address_type, 0, 0)
+        return pack_reply(error_number)
 
-    def exchange_data(self, client, remote):
+    def exchange_data(self, client, remote) -> typing.Tuple[int, int]:
         """
         交换数据
+        :return: 上行/下行字节数
         """
-        while True:
-            # 等待数据
-            rs, ws, es = select.select([client, remote], [], [])
-            if client in rs:
-                data = client.recv(4096)
-                if remote.send(data) <= 0:
-                    break
-            if remote in rs:
-                data = remote.recv(4096)
-                if client.send(data) <= 0:
-                    break
+        metrics.ACTIVE_TUNNELS.inc(ENGINE)
+        tunnel = shaping.shaper.open(self.client_address[0])
+        try:
+            up, down = relay.relay(client, remote, timeout=self.timeout, tunnel=tunnel)
+        finally:
+            metrics.ACTIVE_TUNNELS.dec(ENGINE)
+            tunnel and tunnel.close()
+        metrics.BYTES.inc(ENGINE, 'up', value=up)
+        metrics.BYTES.inc(ENGINE, 'down', value=down)
+        return up, down
 
 
-def start_server(ip: str = '0.0.0.0', port: int = 1080):
+def start_server(ip: str = '0.0.0.0', port: int = 1080, timeout: int = 60):
+    ProxyHandler.timeout = timeout
     # 服务器上创建一个TCP多线程服务
-    server = ThreadingTCPServer((ip, port), ProxyHandler)
+    server = ThreadingTCPServer((ip, port), ProxyHandler, bind_and_activate=False)
+    workers.bind(server)
     print("**********************************************************")
     print("******************* CaulProxy 1.0.0 **********************")
     print(f"*******************  IP:{ip} PORT:{port} ***********")
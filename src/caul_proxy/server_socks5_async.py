@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+# desc: 基于asyncio的socks5服务, 单线程处理所有连接
+import asyncio
+import socket
+import struct
+import time
+import typing
+
+from caul_proxy import acl, metrics, workers, access_log, ratelimit, shaping
+from caul_proxy.config import settings, logger
+from caul_proxy.resolver import dns
+from caul_proxy.server_socks5 import SOCKS_VERSION, AUTH_VERSION, CMD_CONNECT, \
+    ATYP_IPV4, ATYP_IPV6, ATYP_DOMAIN, METHOD_NO_ACCEPTABLE, METHOD_USERPASS, \
+    REP_SUCCEEDED, REP_NOT_ALLOWED, REP_HOST_UNREACHABLE, REP_CONNECTION_REFUSED, \
+    REP_COMMAND_NOT_SUPPORTED, REP_ADDRESS_NOT_SUPPORTED, \
+    select_method, check_auth, pack_reply, unpack_address
+
+# 握手数据上限: 2 + 255 + 3 + 255 * 2 + 4 + 1 + 255 + 2
+MAX_HANDSHAKE = 1024
+ENGINE = 'socks5_async'
+ADDRESS_SIZE = {ATYP_IPV4: 4, ATYP_IPV6: 16}
+
+
+class _Relay(asyncio.Protocol):
+    """
+    转发一端: 对端写缓冲超过高水位时暂停本端读取
+    带宽整形: 令牌不足时暂停读取, 由定时器恢复
+    """
+    transport: typing.Optional[asyncio.Transport] = None
+
+    def __init__(self):
+        self.peer: typing.Optional[_Relay] = None
+        self.bytes = 0
+        self.eof = False
+        self.flow: typing.Optional[shaping.Flow] = None
+        # 整形的恢复定时器, 对端写缓冲是否已满
+        self.paced: typing.Optional[asyncio.TimerHandle] = None
+        self.blocked = False
+
+    def data_received(self, data: bytes):
+        self.bytes += len(data)
+        self.peer.transport.write(data)
+        if self.flow is not None:
+            self.flow.consume(len(data))
+            delay = self.flow.delay()
+            if delay:
+                self.pace(delay)
+
+    def pace(self, delay: float):
+        self.transport.pause_reading()
+        self.paced = asyncio.get_running_loop().call_later(delay, self.resume_paced)
+
+    def resume_paced(self):
+        self.paced = None
+        delay = self.flow.delay()
+        if delay:
+            self.pace(delay)
+        elif not self.blocked and not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def eof_received(self) -> bool:
+        # 半关闭: 关闭对端的写, 两个方向都结束后关闭连接
+        self.eof = True
+        if self.peer is None or self.peer.eof:
+            return False
+        if self.peer.transport.can_write_eof():
+            self.peer.transport.write_eof()
+        return True
+
+    def pause_writing(self):
+        if self.peer is not None:
+            self.peer.blocked = True
+            self.peer.transport.pause_reading()
+
+    def resume_writing(self):
+        if self.peer is not None:
+            self.peer.blocked = False
+            if self.peer.paced is None:
+                self.peer.transport.resume_reading()
+
+    def connection_lost(self, exc: typing.Optional[Exception]):
+        self.paced and self.paced.cancel()
+        if self.peer is not None and not self.peer.transport.is_closing():
+            self.peer.transport.close()
+
+
+class RemoteProtocol(_Relay):
+    """目标服务器端"""
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=settings.relay.buffer_size)
+        # 与客户端关联后再开始读取
+        transport.pause_reading()
+
+
+class Socks5Protocol(_Relay):
+    """
+    客户端: 从缓冲区解析握手, 建立连接后转为直接转发
+    """
+
+    def __init__(self, timeout: int = 60):
+        super().__init__()
+        self.timeout = timeout
+        self.buffer = bytearray()
+        self.state: typing.Optional[typing.Callable[[], bool]] = self.on_greeting
+        self.client_address = None
+        self.user = None
+        # 限流占用的连接, 超出限制时在协商/连接请求阶段拒绝
+        self.slot: typing.Optional[ratelimit.Bucket] = None
+        self.user_slot: typing.Optional[ratelimit.Bucket] = None
+        self.limited = False
+        self.tunnel: typing.Optional[shaping.Tunnel] = None
+        self.target = None
+        # 连接目标的任务, 客户端断开时取消
+        self.connecting: typing.Optional[asyncio.Task] = None
+        # 访问日志: 开始时间, 应答码
+        self.started = 0.0
+        self.rep: typing.Optional[int] = None
+        self.idle_handle: typing.Optional[asyncio.TimerHandle] = None
+        self.idle_mark = 0
+
+    def connection_made(self, transport: asyncio.Transport):
+        self.transport = transport
+        self.client_address = transport.get_extra_info('peername')
+        self.started = time.monotonic()
+        metrics.ACTIVE_CONNECTIONS.inc(ENGINE)
+        transport.set_write_buffer_limits(high=settings.relay.buffer_size)
+        self.idle_handle = asyncio.get_running_loop().call_later(self.timeout, self.check_idle)
+        # allows and denys
+        host = self.client_address[0]
+        if not acl.admit(host):
+            self.rep = REP_NOT_ALLOWED
+            metrics.REQUESTS.inc(ENGINE, 'CONNECT', str(REP_NOT_ALLOWED))
+            transport.close()
+            return
+        # 每个客户端的连接速率及并发连接数
+        try:
+            self.slot = ratelimit.acquire(ENGINE, host)
+        except ratelimit.Limited:
+            self.limited = True
+
+    def data_received(self, data: bytes):
+        if self.peer is not None:
+            super().data_received(data)
+            return
+        if self.state is None:
+            # 正在连接目标服务器
+            return
+        self.buffer += data
+        if len(self.buffer) > MAX_HANDSHAKE:
+            self.transport.close()
+            return
+        while self.state is not None and self.state():
+            pass
+
+    def on_greeting(self) -> bool:
+        """
+        一、客户端认证请求 VER | NMETHODS | METHODS
+        """
+        if len(self.buffer) < 2:
+            return False
+        version, n_methods = self.buffer[0], self.buffer[1]
+        if version != SOCKS_VERSION:
+            self.transport.close()
+            return False
+        if len(self.buffer) < 2 + n_methods:
+            return False
+        method = METHOD_NO_ACCEPTABLE if self.limited else select_method(self.buffer[2:2 + n_methods])
+        del self.buffer[:2 + n_methods]
+        # 二、服务端回应认证 VER | METHOD
+        self.transport.write(struct.pack("!BB", SOCKS_VERSION, method))
+        if method == METHOD_NO_ACCEPTABLE:
+            if self.limited:
+                self.rep = REP_NOT_ALLOWED
+                metrics.REQUESTS.inc(ENGINE, 'CONNECT', str(REP_NOT_ALLOWED))
+            self.close()
+            return False
+        self.state = self.on_auth if method == METHOD_USERPASS else self.on_request
+        return True
+
+    def on_auth(self) -> bool:
+        """
+        用户名/密码认证 VER | ULEN | UNAME | PLEN | PASSWD
+        """
+        if len(self.buffer) < 2:
+            return False
+        u_len = self.buffer[1]
+        if len(self.buffer) < 3 + u_len:
+            return False
+        p_len = self.buffer[2 + u_len]
+        if len(self.buffer) < 3 + u_len + p_len:
+            return False
+        username = bytes(self.buffer[2:2 + u_len])
+        password = bytes(self.buffer[3 + u_len:3 + u_len + p_len])
+        del self.buffer[:3 + u_len + p_len]
+        if not check_auth(username, password):
+            self.transport.write(struct.pack("!BB", AUTH_VERSION, 0xFF))
+            self.close()
+            return False
+        self.user = username.decode('utf-8', 'replace')
+        # 每个用户的连接速率及并发连接数, 超出时拒绝连接请求
+        try:
+            self.user_slot = ratelimit.acquire(ENGINE, self.user, user=True)
+        except ratelimit.Limited:
+            self.limited = True
+        self.transport.write(struct.pack("!BB", AUTH_VERSION, 0))
+        self.state = self.on_request
+        return True
+
+    def on_request(self) -> bool:
+        """
+        三、客户端连接请求 VER | CMD | RSV | ATYP | DST.ADDR | DST.PORT
+        """
+        if len(self.buffer) < 5:
+            return False
+        version, cmd, _, address_type = self.buffer[:4]
+        if version != SOCKS_VERSION:
+            self.transport.close()
+            return False
+        if address_type == ATYP_DOMAIN:
+            offset, size = 5, self.buffer[4]
+        elif address_type in ADDRESS_SIZE:
+            offset, size = 4, ADDRESS_SIZE[address_type]
+        else:
+            self.reply(REP_ADDRESS_NOT_SUPPORTED)
+            return False
+        if len(self.buffer) < offset + size + 2:
+            return False
+        address = unpack_address(address_type, bytes(self.buffer[offset:offset + size]))
+        port, = struct.unpack('!H', self.buffer[offset + size:offset + size + 2])
+        del self.buffer[:offset + size + 2]
+        if address is None:
+            self.reply(REP_ADDRESS_NOT_SUPPORTED)
+            return False
+        if self.limited:
+            self.target = (address, port)
+            self.reply(REP_NOT_ALLOWED)
+            return False
+        if cmd != CMD_CONNECT:
+            self.reply(REP_COMMAND_NOT_SUPPORTED)
+            return False
+        self.state = None
+        self.target = (address, port)
+        # 连接期间暂停读取客户端
+        self.transport.pause_reading()
+        self.connecting = asyncio.ensure_future(self.connect(address, port))
+        return False
+
+    async def connect(self, address: str, port: int):
+        """
+        四、服务端回应连接 VER | REP | RSV | ATYP | BND.ADDR | BND.PORT
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            sock = await dns.create_connection_async(address, port)
+            _, remote = await loop.create_connection(RemoteProtocol, sock=sock)
+        except (asyncio.TimeoutError, socket.gaierror) as e:
+            logger.warning(f'SOCKS5 {self.client_address} -> {address}:{port} {e.__class__.__name__}')
+            self.reply(REP_HOST_UNREACHABLE)
+            return
+        except OSError as e:
+            logger.warning(f'SOCKS5 {self.client_address} -> {address}:{port} {e}')
+            self.reply(REP_CONNECTION_REFUSED)
+            return
+        if self.transport.is_closing():
+            remote.transport.close()
+            return
+        remote.peer, self.peer = self, remote
+        self.tunnel = shaping.shaper.open(self.client_address[0])
+        if self.tunnel is not None:
+            self.flow, remote.flow = self.tunnel.up, self.tunnel.down
+        self.rep = REP_SUCCEEDED
+        metrics.REQUESTS.inc(ENGINE, 'CONNECT', str(REP_SUCCEEDED))
+        metrics.ACTIVE_TUNNELS.inc(ENGINE)
+        self.transport.write(pack_reply(REP_SUCCEEDED, remote.transport.get_extra_info('sockname')))
+        # 客户端提前发送的数据
+        if self.buffer:
+            self.data_received(bytes(self.buffer))
+            self.buffer.clear()
+        if self.paced is None:
+            self.transport.resume_reading()
+        remote.transport.resume_reading()
+
+    def reply(self, rep: int):
+        self.rep = rep
+        metrics.REQUESTS.inc(ENGINE, 'CONNECT', str(rep))
+        self.transport.write(pack_reply(rep))
+        self.close()
+
+    def close(self):
+        self.state = None
+        self.transport.close()
+
+    def check_idle(self):
+        """
+        超时检查: 握手未完成或隧道在一个周期内没有数据时关闭
+        按字节数判断, 避免每次收到数据都重置定时器
+        """
+        if self.transport.is_closing():
+            return
+        total = self.bytes + (self.peer.bytes if self.peer else 0)
+        if self.peer is None or total == self.idle_mark:
+            self.transport.close()
+            return
+        self.idle_mark = total
+        self.idle_handle = asyncio.get_running_loop().call_later(self.timeout, self.check_idle)
+
+    def connection_lost(self, exc: typing.Optional[Exception]):
+        self.idle_handle and self.idle_handle.cancel()
+        if self.connecting is not None and not self.connecting.done():
+            self.connecting.cancel()
+        metrics.ACTIVE_CONNECTIONS.dec(ENGINE)
+        ratelimit.release(self.slot)
+        ratelimit.release(self.user_slot)
+        self.tunnel and self.tunnel.close()
+        if self.peer is not None:
+            metrics.ACTIVE_TUNNELS.dec(ENGINE)
+            metrics.BYTES.inc(ENGINE, 'up', value=self.bytes)
+            metrics.BYTES.inc(ENGINE, 'down', value=self.peer.bytes)
+        if self.rep is not None:
+            target = f'{self.target[0]}:{self.target[1]}' if self.target else '-'
+            access_log.log(ENGINE, self.client_address[0], 'CONNECT', target, 'SOCKS5', self.rep,
+                           time.monotonic() - self.started, self.bytes, self.peer.bytes if self.peer else 0,
+                           failed=self.rep != REP_SUCCEEDED)
+        super().connection_lost(exc)
+
+
+def raise_nofile():
+    """提高文件描述符上限, 以支持大量空闲隧道"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+
+async def serve(ip: str, port: int, timeout: int):
+    loop = asyncio.get_running_loop()
+    metrics.watch_loop(loop)
+    server = await loop.create_server(lambda: Socks5Protocol(timeout), host=ip, port=port,
+                                      reuse_address=True, reuse_port=workers.REUSE_PORT or None, backlog=1024)
+    async with server:
+        await server.serve_forever()
+
+
+def start_server(ip: str = '0.0.0.0', port: int = 1080, timeout: int = 60):
+    raise_nofile()
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    print("**********************************************************")
+    print("******************* CaulProxy 1.0.0 **********************")
+    print(f"*******************  IP:{ip} PORT:{port} ***********")
+    print("**********************************************************")
+    asyncio.run(serve(ip, port, timeout))
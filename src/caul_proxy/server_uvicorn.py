@@ -1,29 +1,389 @@
+import asyncio
+import socket
+import time
+import typing
+
 import aiohttp
+import aiohttp.abc
+import urllib3.util
 import uvicorn
-from fastapi import FastAPI
-from fastapi import Request
-from starlette.responses import Response
-
-app = FastAPI(title="Yhop Proxy",
-              version="0.0.1",
-              openapi_url="/openapi.json", )
-
-
-@app.route("/", methods=['HEAD', 'OPTION', 'GET', 'POST'])
-async def proxy(request: Request):
-    url = request.url
-    method = request.method
-    headers = request.headers
-    data = await request.body()
-    # 发送转发请求到目标服务器
-    async with aiohttp.ClientSession(timeout=5) as session:
-        async with session.request(method=method, url=str(url), headers=headers, data=data) as response:
-            # 构造响应对象，并将目标服务器的响应返回给客户端
-            resp = Response(status_code=response.status,
-                            content=response.content,
-                            headers=response.headers)
-    return resp
+
+from caul_proxy import util, acl, metrics, workers, access_log, compression, balancer, ratelimit, http2
+from caul_proxy.config import settings, logger
+from caul_proxy.plugins import runner, hooks
+from caul_proxy.resolver import dns
+
+ENGINE = 'uvicorn'
+
+
+class CachedResolver(aiohttp.abc.AbstractResolver):
+    """aiohttp使用共享的DNS缓存"""
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET) -> typing.List[dict]:
+        try:
+            addresses = await dns.resolve_async(host, port)
+        except socket.gaierror as e:
+            raise OSError(e.errno, f'Could not resolve host {host}: {e}') from e
+        return [{'hostname': host, 'host': sockaddr[0], 'port': sockaddr[1], 'family': family,
+                 'proto': 0, 'flags': socket.AI_NUMERICHOST}
+                for family, sockaddr in addresses]
+
+    async def close(self):
+        pass
+
+
+class ProxyApp:
+    """
+    ASGI转发代理: 共享一个ClientSession, 请求体和响应体均流式转发
+    """
+
+    def __init__(self, timeout: int = 60, engine: str = ENGINE):
+        self.timeout = timeout
+        # 指标/日志中的引擎名, HTTP/2监听复用本类时不同
+        self.engine = engine
+        self.session: typing.Optional[aiohttp.ClientSession] = None
+
+    async def __call__(self, scope: dict, receive: typing.Callable, send: typing.Callable):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            start = time.monotonic()
+            # 访问日志: 转发的目标, 请求体/响应体字节数
+            scope['caul'] = {'target': None, 'up': 0, 'down': 0}
+            metrics.ACTIVE_CONNECTIONS.inc(self.engine)
+            try:
+                status = await self.proxy(scope, receive, send)
+            finally:
+                metrics.ACTIVE_CONNECTIONS.dec(self.engine)
+            duration = time.monotonic() - start
+            metrics.REQUESTS.inc(self.engine, scope['method'], str(status))
+            metrics.REQUEST_DURATION.observe(duration, self.engine)
+            stats = scope['caul']
+            access_log.log(self.engine, (scope.get('client') or ('', 0))[0], scope['method'],
+                           stats['target'] or self.target(scope), f'HTTP/{scope["http_version"]}', status, duration,
+                           stats['up'], stats['down'])
+
+    async def lifespan(self, receive: typing.Callable, send: typing.Callable):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                metrics.watch_loop(asyncio.get_running_loop())
+                self.open_session()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close_session()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def open_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=settings.pool.max_total,
+                                             limit_per_host=settings.pool.max_per_host,
+                                             keepalive_timeout=settings.pool.idle_timeout,
+                                             resolver=CachedResolver(), use_dns_cache=False,
+                                             happy_eyeballs_delay=settings.dns.happy_eyeballs_delay)
+            self.session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=None, connect=self.timeout,
+                                              sock_connect=settings.dns.connect_timeout, sock_read=self.timeout),
+                # 原样转发Content-Encoding, 代理不保存cookie
+                auto_decompress=False,
+                cookie_jar=aiohttp.DummyCookieJar(),
+            )
+        return self.session
+
+    async def close_session(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def proxy(self, scope: dict, receive: typing.Callable, send: typing.Callable) -> int:
+        # allows and denys
+        host = (scope.get('client') or ('', 0))[0]
+        if not acl.admit(host):
+            return await self.send_error(send, 403)
+        # 每个客户端的请求速率及并发请求数
+        try:
+            slot = ratelimit.acquire(self.engine, host)
+        except ratelimit.Limited as e:
+            return await self.send_error(send, 429, retry_after=e.retry_after)
+        try:
+            return await self.forward(scope, receive, send, host)
+        finally:
+            ratelimit.release(slot)
+
+    async def forward(self, scope: dict, receive: typing.Callable, send: typing.Callable, host: str) -> int:
+        method = scope['method']
+        target = self.target(scope)
+        rules = runner.snapshot()
+        # plugins
+        ctx = None
+        if rules.hooks:
+            ctx = hooks.Context(self.engine, host, method, target,
+                                ((k.decode('latin-1'), v.decode('latin-1')) for k, v in scope['headers']))
+            status = rules.hooks.pre_route(ctx)
+            if status:
+                return await self.send_error(send, status)
+            target = ctx.url
+            scope['headers'] = [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in ctx.headers.items()]
+        # rewrite
+        try:
+            url_parts = urllib3.util.parse_url(target)
+            url, _, backend = rules.route(url_parts)
+        except BaseException as e:
+            logger.error(f'{method} {target} HTTP/{scope["http_version"]}: {util.err_msg(e)}')
+            return await self.send_error(send, 400)
+        # forward
+        scope['caul']['target'] = url
+        if ctx is not None:
+            ctx.target = url
+        headers = self.req_headers(scope)
+        has_body = 'content-length' in headers or b'chunked' in scope_header(scope, b'transfer-encoding')
+        lease = balancer.Lease(backend) if backend is not None else None
+        start = time.monotonic()
+        try:
+            tls = True
+            data = self.req_data(receive, scope) if has_body else None
+            if http2.pool.enabled and url.lower().startswith('https://'):
+                opened = await self.open_h2(method, url, headers, data)
+                if opened is not None:
+                    stream, status, resp_headers = opened
+                    try:
+                        metrics.UPSTREAM_TTFB.observe(time.monotonic() - start, self.engine)
+                        lease and lease.response(status)
+                        return await self.relay(scope, send, ctx, rules, method, status, resp_headers,
+                                                iter_stream(stream))
+                    finally:
+                        stream.close()
+                # 上游使用HTTP/1.1时请求体尚未读取, 由aiohttp流式转发
+                tls = http2.pool.fallback_ssl()
+            async with self.open_session().request(method=method, url=url, headers=headers, data=data,
+                                                   allow_redirects=False, ssl=tls,
+                                                   # 客户端未发送时不添加, 否则原样转发的响应体客户端可能无法解压
+                                                   skip_auto_headers=('Accept-Encoding',)) as response:
+                metrics.UPSTREAM_TTFB.observe(time.monotonic() - start, self.engine)
+                lease and lease.response(response.status)
+                return await self.relay(scope, send, ctx, rules, method, response.status,
+                                        list(response.headers.items()), response.content.iter_any())
+        except (aiohttp.ClientError, asyncio.TimeoutError, socket.timeout) as e:
+            logger.error(f'{method} {url} HTTP/{scope["http_version"]}\n{util.err_msg(e)}')
+            return await self.send_error(send, 502 if isinstance(e, aiohttp.ClientError) else 504)
+        except OSError as e:
+            logger.error(f'{method} {url} HTTP/{scope["http_version"]}\n{util.err_msg(e)}')
+            return await self.send_error(send, 502)
+        finally:
+            lease and lease.release()
+
+    async def open_h2(self, method: str, url: str, headers: dict,
+                      data: typing.Optional[typing.AsyncIterator[bytes]]) -> typing.Optional[tuple]:
+        """
+        通过HTTP/2发送请求并等待响应头, 请求体边读边发; 被拒绝的流在请求体未读取时重试
+        :param method:
+        :param url:
+        :param headers:
+        :param data: 请求体
+        :return: (流, 状态码, 响应头); 上游不支持HTTP/2或多次被拒绝时返回None, 此时请求体未读取
+        """
+        body = StreamBody(data, asyncio.get_running_loop()) if data is not None else None
+        for _ in range(http2.REFUSED_RETRIES + 1):
+            stream = None
+            try:
+                stream = await open_stream(method, url, headers, body, self.timeout)
+                if stream is None:
+                    return None
+                status, resp_headers = await stream.response_async(self.timeout)
+                return stream, status, resp_headers
+            except BaseException as e:
+                stream is not None and stream.close()
+                if isinstance(e, http2.RefusedStream) and (body is None or not body.started):
+                    continue
+                raise
+        return None
+
+    async def relay(self, scope: dict, send: typing.Callable, ctx: typing.Optional[hooks.Context], rules,
+                    method: str, status: int, resp_headers: typing.List[typing.Tuple[str, str]],
+                    chunks: typing.AsyncIterator[bytes]) -> int:
+        """
+        转发上游响应(aiohttp或HTTP/2): 插件, 压缩, 流式发送响应体
+        :param scope:
+        :param send:
+        :param ctx: 插件上下文, 没有插件时为None
+        :param rules:
+        :param method:
+        :param status:
+        :param resp_headers:
+        :param chunks: 响应体
+        :return:
+        """
+        body_filter = None
+        if ctx is not None:
+            rules.hooks.post_response(ctx, status, resp_headers)
+            body_filter = rules.hooks.body_filter(ctx, method, status)
+            if body_filter is not None:
+                resp_headers = [(k, v) for k, v in resp_headers if k.lower() != 'content-length']
+        resp_headers, encoder = compression.prepare(
+            settings.compression, method, status,
+            scope_header(scope, b'accept-encoding').decode('latin-1'), resp_headers)
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': self.resp_headers(resp_headers),
+        })
+        size = 0
+        try:
+            async for content in chunks:
+                if body_filter:
+                    content = body_filter.filter(content)
+                if encoder and content:
+                    content = encoder.compress(content)
+                if not content:
+                    continue
+                size += len(content)
+                await send({'type': 'http.response.body', 'body': content, 'more_body': True})
+            content = body_filter.flush() if body_filter else b''
+            if encoder:
+                content = encoder.compress(content) + encoder.flush()
+            if content:
+                size += len(content)
+                await send({'type': 'http.response.body', 'body': content, 'more_body': True})
+        finally:
+            metrics.BYTES.inc(self.engine, 'down', value=size)
+            scope['caul']['down'] = size
+        await send({'type': 'http.response.body', 'body': b''})
+        return status
+
+    @staticmethod
+    def target(scope: dict) -> str:
+        """
+        还原请求的绝对URL
+        :param scope:
+        :return:
+        """
+        path = scope.get('raw_path') or scope['path'].encode('latin-1')
+        if not (path.startswith(b'http://') or path.startswith(b'https://')):
+            path = b'%s://%s%s' % (scope['scheme'].encode('latin-1'), scope_header(scope, b'host'), path)
+        if scope.get('query_string'):
+            path += b'?' + scope['query_string']
+        return path.decode('latin-1')
+
+    @staticmethod
+    def req_headers(scope: dict) -> dict:
+        headers = {}
+        skip = util.hop_headers(scope_header(scope, b'connection').decode('latin-1'))
+        for header, value in scope['headers']:
+            name = header.decode('latin-1')
+            if name in skip:
+                continue
+            headers[name] = value.decode('latin-1')
+        return headers
+
+    @staticmethod
+    def resp_headers(headers: typing.List[typing.Tuple[str, str]]) -> typing.List[typing.Tuple[bytes, bytes]]:
+        """
+        转发端到端header(保留重复的Set-Cookie), 添加配置的CORS header
+        :param headers: (name, value)列表
+        :return:
+        """
+        skip = util.hop_headers(util.header_value(headers, 'Connection'))
+        cors = settings.cors.headers()
+        if cors:
+            skip = skip.union(name.lower() for name, _ in cors)
+        result = [(k.encode('latin-1'), v.encode('latin-1')) for k, v in headers if k.lower() not in skip]
+        result.extend((k.encode('latin-1'), v.encode('latin-1')) for k, v in cors)
+        return result
+
+    async def req_data(self, receive: typing.Callable, scope: dict) -> typing.AsyncIterator[bytes]:
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                raise ConnectionError('Client Disconnected')
+            body = message.get('body', b'')
+            if body:
+                metrics.BYTES.inc(self.engine, 'up', value=len(body))
+                scope['caul']['up'] += len(body)
+                yield body
+            if not message.get('more_body', False):
+                return
+
+    @staticmethod
+    async def send_error(send: typing.Callable, code: int, retry_after: int = None) -> int:
+        headers = [(b'content-length', b'0')]
+        if retry_after is not None:
+            headers.append((b'retry-after', str(retry_after).encode('latin-1')))
+        await send({'type': 'http.response.start', 'status': code, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': b''})
+        return code
+
+
+class StreamBody:
+    """
+    线程池中的http2.pool.open逐块读取事件循环中的请求体
+    """
+
+    def __init__(self, chunks: typing.AsyncIterator[bytes], loop: asyncio.AbstractEventLoop):
+        self.chunks = chunks
+        self.loop = loop
+        # 已开始读取, 不能再重试或交给aiohttp
+        self.started = False
+
+    def __iter__(self) -> typing.Iterator[bytes]:
+        self.started = True
+        while True:
+            try:
+                yield asyncio.run_coroutine_threadsafe(self.chunks.__anext__(), self.loop).result()
+            except StopAsyncIteration:
+                return
+
+
+async def open_stream(method: str, url: str, headers: dict, data: typing.Optional[StreamBody],
+                      timeout: float) -> typing.Optional[http2.Stream]:
+    """
+    在线程池中发送HTTP/2请求, 请求被取消(客户端断开)时关闭之后得到的流
+    :param method:
+    :param url:
+    :param headers:
+    :param data:
+    :param timeout:
+    :return: 上游不支持HTTP/2时返回None
+    """
+    future = asyncio.get_running_loop().run_in_executor(None, http2.pool.open, method, url, headers, data, timeout)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        future.add_done_callback(
+            lambda f: not f.cancelled() and f.exception() is None and f.result() and f.result().close())
+        raise
+
+
+async def iter_stream(stream: http2.Stream) -> typing.AsyncIterator[bytes]:
+    while True:
+        data = await stream.read_async()
+        if not data:
+            return
+        yield data
+
+
+def scope_header(scope: dict, name: bytes) -> bytes:
+    for header, value in scope['headers']:
+        if header == name:
+            return value
+    return b''
+
+
+app = ProxyApp()
 
 
 def start_server(ip: str = '0.0.0.0', port: int = 1080, timeout: int = 60):
-    uvicorn.run(app, host=ip, port=port)
+    app.timeout = timeout
+    http2.pool.configure(settings.pool)
+    print("**********************************************************")
+    print("******************* CaulProxy 1.0.0 **********************")
+    print(f"*******************  IP:{ip} PORT:{port} ***********")
+    print("**********************************************************")
+    # loop=auto: 已安装uvloop时使用uvloop; 日志沿用config.init_logger
+    config = uvicorn.Config(app, host=ip, port=port, loop='auto', lifespan='on',
+                            log_config=None, access_log=False, server_header=False, date_header=False,
+                            timeout_keep_alive=timeout)
+    # worker进程: 自行创建SO_REUSEPORT的监听socket
+    sockets = [workers.listen(ip, port, config.backlog)] if workers.REUSE_PORT else None
+    uvicorn.Server(config).run(sockets=sockets)
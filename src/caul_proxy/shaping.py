@@ -0,0 +1,210 @@
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from caul_proxy import metrics
+from caul_proxy.config import Shaping
+
+# 令牌不足时等到至少可以读取该字节数, 避免频繁的小块读写
+QUANTUM = 16384
+DIRECTIONS = ('up', 'down')
+
+BYTES = metrics.Counter('caul_shaping_bytes_total', 'Bytes relayed under bandwidth shaping by flow class',
+                        ('direction', 'class'))
+DELAYS = metrics.Counter('caul_shaping_delays_total', 'Relay reads deferred by bandwidth shaping',
+                         ('direction', 'level'))
+
+
+class Bucket:
+    """
+    令牌桶(字节): 允许透支, 透支后按速率恢复
+    客户端/全局的桶被多个连接共享, 由自身的锁保护
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp', 'lock')
+
+    def __init__(self, rate: float, burst_seconds: float):
+        self.rate = rate
+        self.burst = max(rate * burst_seconds, QUANTUM)
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now: float):
+        if now > self.stamp:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def level(self, now: float) -> float:
+        with self.lock:
+            self._refill(now)
+            return self.tokens
+
+    def take(self, size: int, now: float):
+        with self.lock:
+            self._refill(now)
+            self.tokens -= size
+
+
+class Flow:
+    """
+    一个隧道一个方向的整形: 依次受连接/客户端/全局令牌桶限制
+    连续传输不超过interactive_bytes的交互流量只等待连接的限制, 客户端/全局的令牌照常扣除(透支由大流量偿还)
+    """
+    __slots__ = ('direction', 'buckets', 'interactive_bytes', 'interactive_idle', 'run', 'last', 'counts')
+
+    def __init__(self, direction: str, buckets: List[Tuple[str, Bucket]], conf: Shaping):
+        self.direction = direction
+        self.buckets = buckets
+        self.interactive_bytes = conf.interactive_bytes or 0
+        self.interactive_idle = conf.interactive_idle or 0
+        # 本次连续传输的字节数及最后一次传输的时间
+        self.run = 0
+        self.last = 0.0
+        # 按流量类别累计, 结束时计入指标
+        self.counts = {'interactive': 0, 'bulk': 0}
+
+    def interactive(self, now: float) -> bool:
+        if now - self.last > self.interactive_idle:
+            self.run = 0
+        return self.run < self.interactive_bytes
+
+    def allowance(self, limit: int) -> Tuple[int, float]:
+        """
+        下一次读取前检查令牌
+        :param limit: 缓冲区大小
+        :return: (可以读取的字节数, 0) 或 (0, 需要等待的秒数)
+        """
+        now = time.monotonic()
+        interactive = self.interactive(now)
+        if interactive:
+            limit = min(limit, self.interactive_bytes - self.run)
+        delay, level = 0.0, None
+        for name, bucket in self.buckets:
+            if interactive and name != 'connection':
+                continue
+            tokens = bucket.level(now)
+            if tokens < QUANTUM:
+                wait = (QUANTUM - tokens) / bucket.rate
+                if wait > delay:
+                    delay, level = wait, name
+            else:
+                limit = min(limit, int(tokens))
+        if delay:
+            DELAYS.inc(self.direction, level)
+            return 0, delay
+        return limit, 0.0
+
+    def delay(self) -> float:
+        """
+        下一次读取前需要等待的秒数(无法限制读取大小时使用, 如asyncio)
+        :return:
+        """
+        return self.allowance(QUANTUM)[1]
+
+    def consume(self, size: int):
+        """
+        扣除已转发的字节
+        :param size:
+        :return:
+        """
+        now = time.monotonic()
+        self.counts['interactive' if self.interactive(now) else 'bulk'] += size
+        self.run += size
+        self.last = now
+        for _, bucket in self.buckets:
+            bucket.take(size, now)
+
+    def close(self):
+        for name, count in self.counts.items():
+            if count:
+                BYTES.inc(self.direction, name, value=count)
+
+
+class Tunnel:
+    """一个隧道两个方向的整形, 结束时需要close"""
+    __slots__ = ('shaper', 'client', 'up', 'down')
+
+    def __init__(self, shaper: 'Shaper', client: str, up: Flow, down: Flow):
+        self.shaper = shaper
+        self.client = client
+        self.up = up
+        self.down = down
+
+    def close(self):
+        self.up.close()
+        self.down.close()
+        self.shaper.release(self.client)
+
+
+class Shaper:
+    """
+    分层令牌桶带宽整形: 每个连接 -> 每个客户端IP -> 全部, 每个方向分别计算
+    客户端的桶在最后一个连接结束时删除
+    """
+
+    def __init__(self, conf: Shaping = None):
+        self._lock = threading.Lock()
+        # 客户端IP -> [{方向: 桶}, 连接数]
+        self.clients: Dict[str, list] = {}
+        self.tunnels = 0
+        self.configure(conf or Shaping())
+
+    def configure(self, conf: Shaping):
+        self.conf = conf
+        self.enabled = bool(conf.per_connection or conf.per_client or conf.total)
+        self.total = {d: Bucket(conf.total, conf.burst_seconds) for d in DIRECTIONS} if conf.total else None
+
+    def open(self, client: str) -> Optional[Tunnel]:
+        """
+        开始一个隧道的整形
+        :param client: 客户端IP
+        :return: 不限制带宽时返回None
+        """
+        if not self.enabled:
+            return None
+        conf = self.conf
+        shared = None
+        with self._lock:
+            self.tunnels += 1
+            if conf.per_client:
+                entry = self.clients.get(client)
+                if entry is None:
+                    entry = self.clients[client] = [
+                        {d: Bucket(conf.per_client, conf.burst_seconds) for d in DIRECTIONS}, 0]
+                entry[1] += 1
+                shared = entry[0]
+        flows = []
+        for direction in DIRECTIONS:
+            buckets = []
+            if conf.per_connection:
+                buckets.append(('connection', Bucket(conf.per_connection, conf.burst_seconds)))
+            if shared is not None:
+                buckets.append(('client', shared[direction]))
+            if self.total is not None:
+                buckets.append(('global', self.total[direction]))
+            flows.append(Flow(direction, buckets, conf))
+        return Tunnel(self, client, *flows)
+
+    def release(self, client: str):
+        with self._lock:
+            self.tunnels -= 1
+            entry = self.clients.get(client)
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del self.clients[client]
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = {'tunnels': self.tunnels, 'clients': len(self.clients)}
+        if self.total is not None:
+            now = time.monotonic()
+            stats['global_tokens'] = {d: bucket.level(now) for d, bucket in self.total.items()}
+        return stats
+
+
+shaper = Shaper()
+
+metrics.GaugeFunc('caul_shaping', 'Shaped tunnels, clients and global bucket tokens (bytes)',
+                  lambda: metrics.flatten(shaper.stats()) if shaper.enabled else {}, ('stat',))
+
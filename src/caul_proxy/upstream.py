@@ -0,0 +1,285 @@
+import contextlib
+import socket
+import threading
+import time
+from http import cookiejar
+from typing import Dict, Tuple, Iterator, List
+
+import requests
+import urllib3.response
+import urllib3.util
+from requests.adapters import HTTPAdapter
+from urllib3 import connection, connectionpool, exceptions
+
+from caul_proxy import http2, metrics
+from caul_proxy.config import Pool
+from caul_proxy.resolver import dns
+
+OriginKey = Tuple[str, str, int]
+# 解压后转发时, 原Content-Encoding/Content-Length不再适用
+DECODED_HEADERS = frozenset({'content-encoding', 'content-length'})
+
+
+class PoolExhausted(requests.exceptions.ConnectionError):
+    """等待上游连接超时"""
+
+
+def origin_key(url: str) -> OriginKey:
+    """
+    上游连接池的key: (scheme, host, port)
+    :param url:
+    :return:
+    """
+    url_parts = urllib3.util.parse_url(url)
+    scheme = (url_parts.scheme or 'http').lower()
+    port = url_parts.port or (80 if scheme == 'http' else 443)
+    return scheme, (url_parts.host or '').lower(), port
+
+
+class _ResolvedConnection:
+    """使用共享DNS缓存和Happy Eyeballs建立连接"""
+
+    def _new_conn(self):
+        # 未设置超时时为urllib3的默认值对象
+        timeout = self.timeout if isinstance(self.timeout, (int, float)) else None
+        try:
+            sock = dns.create_connection((self._dns_host, self.port), timeout=timeout)
+        except socket.timeout as e:
+            raise exceptions.ConnectTimeoutError(self, f'Connection to {self.host} timed out: {e}') from e
+        except OSError as e:
+            raise exceptions.NewConnectionError(self, f'Failed to establish a new connection: {e}') from e
+        for opt in self.socket_options or []:
+            sock.setsockopt(*opt)
+        return sock
+
+
+class HTTPConnection(_ResolvedConnection, connection.HTTPConnection):
+    pass
+
+
+class HTTPSConnection(_ResolvedConnection, connection.HTTPSConnection):
+    pass
+
+
+class HTTPConnectionPool(connectionpool.HTTPConnectionPool):
+    ConnectionCls = HTTPConnection
+
+
+class HTTPSConnectionPool(connectionpool.HTTPSConnectionPool):
+    ConnectionCls = HTTPSConnection
+
+
+class _Origin:
+    """单个上游: 独立的Session和连接数限制"""
+    __slots__ = ('session', 'slots', 'active', 'last_used')
+
+    def __init__(self, max_conn: int):
+        self.session = requests.Session()
+        # 代理不保存任何上游cookie, 避免串到其他客户端
+        self.session.cookies.set_policy(cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+        # 启用HTTP/2时, 协商为h2的HTTPS上游多路复用, 否则仍使用HTTP/1.1连接池
+        adapter_class = http2.H2Adapter if http2.pool.enabled else HTTPAdapter
+        adapter = adapter_class(pool_connections=1, pool_maxsize=max_conn, max_retries=0)
+        adapter.poolmanager.pool_classes_by_scheme = {'http': HTTPConnectionPool, 'https': HTTPSConnectionPool}
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.slots = threading.BoundedSemaphore(max_conn)
+        self.active = 0
+        self.last_used = time.monotonic()
+
+    def counters(self) -> Tuple[int, int]:
+        """(新建连接数, 请求数)"""
+        connections, reqs = 0, 0
+        for adapter in set(self.session.adapters.values()):
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools.get(key)
+                if pool is None:
+                    continue
+                connections += pool.num_connections
+                reqs += pool.num_requests
+        return connections, reqs
+
+    def close(self):
+        self.session.close()
+
+
+class SessionPool:
+    """
+    上游keep-alive连接池, 线程安全
+    按改写后的 scheme/host/port 分组, 每组一个Session
+    """
+
+    def __init__(self, conf: Pool = None):
+        self._lock = threading.Lock()
+        self._origins: Dict[OriginKey, _Origin] = {}
+        self._last_sweep = time.monotonic()
+        # 已回收上游的累计计数
+        self._closed_connections = 0
+        self._closed_requests = 0
+        self.evicted = 0
+        self.configure(conf or Pool())
+
+    def configure(self, conf: Pool):
+        self.max_per_host = conf.max_per_host
+        self.max_total = conf.max_total
+        self.idle_timeout = conf.idle_timeout
+        self._slots = threading.BoundedSemaphore(conf.max_total)
+        http2.pool.configure(conf)
+
+    @contextlib.contextmanager
+    def request(self, method: str, url: str, timeout: float = None, **kwargs) -> requests.Response:
+        """
+        通过连接池发送请求, 响应在with结束时关闭并归还连接
+        :param method:
+        :param url:
+        :param timeout:
+        :param kwargs: requests.Session.request参数
+        :return:
+        """
+        # 代理原样返回3xx, 不跟随重定向
+        kwargs.setdefault('allow_redirects', False)
+        # 已协商HTTP/2的上游由流数限制并发, 不占用连接数
+        multiplexed = http2.pool.multiplexed(url)
+        # 配置了CA/不校验时显式传入, 否则requests会用REQUESTS_CA_BUNDLE等环境变量覆盖
+        if http2.pool.enabled and http2.pool.verify is not True:
+            kwargs.setdefault('verify', http2.pool.verify)
+        slots = self._slots
+        if not multiplexed and not slots.acquire(timeout=timeout):
+            raise PoolExhausted(f'Upstream Pool Exhausted: {self.max_total}')
+        origin = None
+        try:
+            origin = self._checkout(origin_key(url))
+            if not multiplexed and not origin.slots.acquire(timeout=timeout):
+                raise PoolExhausted(f'Upstream Pool Exhausted: {url}')
+            try:
+                response = origin.session.request(method=method, url=url, timeout=timeout, stream=True, **kwargs)
+                with response:
+                    yield response
+            finally:
+                multiplexed or origin.slots.release()
+        finally:
+            origin and self._checkin(origin)
+            multiplexed or slots.release()
+
+    def _checkout(self, key: OriginKey) -> _Origin:
+        with self._lock:
+            origin = self._origins.get(key)
+            if origin is None:
+                origin = _Origin(self.max_per_host)
+                self._origins[key] = origin
+            origin.active += 1
+            return origin
+
+    def _checkin(self, origin: _Origin):
+        now = time.monotonic()
+        with self._lock:
+            origin.active -= 1
+            origin.last_used = now
+            if now - self._last_sweep < self.idle_timeout / 2:
+                return
+            self._last_sweep = now
+            idles = [key for key, o in self._origins.items()
+                     if not o.active and now - o.last_used > self.idle_timeout]
+            evicted = [self._origins.pop(key) for key in idles]
+        # 关闭连接放到锁外
+        for o in evicted:
+            self._evict(o)
+
+    def _evict(self, origin: _Origin):
+        connections, reqs = origin.counters()
+        origin.close()
+        with self._lock:
+            self._closed_connections += connections
+            self._closed_requests += reqs
+            self.evicted += 1
+
+    def stats(self) -> dict:
+        """
+        连接复用统计
+        :return:
+        """
+        with self._lock:
+            origins = list(self._origins.values())
+            connections, reqs = self._closed_connections, self._closed_requests
+            evicted = self.evicted
+        active = 0
+        for origin in origins:
+            c, r = origin.counters()
+            connections += c
+            reqs += r
+            active += origin.active
+        return {
+            'origins': len(origins),
+            'active': active,
+            'requests': reqs,
+            'new_connections': connections,
+            'reused_connections': max(reqs - connections, 0),
+            'evicted_origins': evicted,
+        }
+
+    def close(self):
+        with self._lock:
+            origins = list(self._origins.values())
+            self._origins.clear()
+        for origin in origins:
+            self._evict(origin)
+
+
+sessions = SessionPool()
+
+
+def reuse_ratio() -> float:
+    stats = sessions.stats()
+    return stats['reused_connections'] / stats['requests'] if stats['requests'] else 0.0
+
+
+def is_decoded(response: requests.Response) -> bool:
+    """
+    iter_content是否会解压响应体(与urllib3选择解码器的规则一致)
+    :param response:
+    :return:
+    """
+    encoding = response.headers.get('Content-Encoding', '').lower()
+    decoders = urllib3.response.HTTPResponse.CONTENT_DECODERS
+    return encoding in decoders or any(e.strip() in decoders for e in encoding.split(','))
+
+
+def body_headers(response: requests.Response, decode: bool = False) -> List[Tuple[str, str]]:
+    """
+    与iter_body一致的响应头, raw.headers保留重复的header(Set-Cookie)
+    :param response:
+    :param decode: 解压后转发
+    :return:
+    """
+    headers = list(response.raw.headers.items())
+    if decode and is_decoded(response):
+        headers = [(k, v) for k, v in headers if k.lower() not in DECODED_HEADERS]
+    return headers
+
+
+def iter_body(response: requests.Response, decode: bool = False, chunk_size: int = 65536) -> Iterator[bytes]:
+    """
+    读取响应体: decode时由iter_content解压, 否则原样读取编码后的字节
+    :param response:
+    :param decode:
+    :param chunk_size:
+    :return:
+    """
+    if decode:
+        yield from response.iter_content(chunk_size=chunk_size)
+        return
+    raw = response.raw
+    if raw.chunked and raw.supports_chunked_reads():
+        yield from raw.read_chunked(chunk_size, decode_content=False)
+        return
+    # read1: 有数据即返回, 不等凑满chunk_size
+    while True:
+        data = raw.read1(chunk_size, decode_content=False)
+        if not data:
+            return
+        yield data
+
+
+metrics.GaugeFunc('caul_upstream_pool', 'Upstream connection pool (requests engine)',
+                  lambda: metrics.flatten(sessions.stats()), ('stat',))
+metrics.GaugeFunc('caul_upstream_reuse_ratio', 'Share of upstream requests on a reused connection', reuse_ratio)
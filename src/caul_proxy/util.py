@@ -4,10 +4,12 @@ import hashlib
 import json
 import os
 import re
+import threading
 from asyncio.events import AbstractEventLoop
+from collections import OrderedDict
 from concurrent import futures
 from pathlib import Path
-from typing import Callable, Any, TypeVar, List
+from typing import Callable, Any, TypeVar, List, Hashable, Iterable, Tuple, Optional
 
 _TYPE_PARSERS_ = {
     bool: lambda v: str(v).lower() in ['true', '1', 'yes'] if v else False,
@@ -17,6 +19,10 @@ _TYPE_PARSERS_ = {
 
 T = TypeVar("T")
 
+# 逐跳header(RFC 7230 6.1), 代理不转发
+HOP_HEADERS = frozenset({'connection', 'keep-alive', 'proxy-connection', 'proxy-authenticate', 'proxy-authorization',
+                         'te', 'trailer', 'trailers', 'transfer-encoding', 'upgrade'})
+
 executor = futures.ThreadPoolExecutor(max_workers=min(32, os.cpu_count() + 4), thread_name_prefix="AsyncThread")
 
 
@@ -157,3 +163,71 @@ def parse_value(value: Any, typing: type = str):
 
 def err_msg(e: BaseException) -> str:
     return str(e) or e.__class__.__name__
+
+
+def hop_headers(connection: str = None) -> frozenset:
+    """
+    逐跳header(小写), 包括Connection中列出的header
+    :param connection: Connection header的值
+    :return:
+    """
+    if not connection:
+        return HOP_HEADERS
+    return HOP_HEADERS.union(name.strip().lower() for name in connection.split(',') if name.strip())
+
+
+def header_value(headers: Iterable[Tuple[str, str]], name: str) -> Optional[str]:
+    """
+    (name, value)列表中第一个同名header的值, 名称不区分大小写
+    :param headers:
+    :param name:
+    :return:
+    """
+    name = name.lower()
+    return next((v for k, v in headers if k.lower() == name), None)
+
+
+class LRUCache:
+    """
+    线程安全的LRU缓存, 记录命中/未命中次数
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def items(self) -> list:
+        with self._lock:
+            return list(self._data.items())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        return {'size': len(self._data), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses}
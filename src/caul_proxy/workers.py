@@ -0,0 +1,362 @@
+import json
+import logging
+import os
+import pickle
+import signal
+import socket
+import socketserver
+import struct
+import threading
+import time
+import traceback
+from logging.handlers import SocketHandler
+from typing import Callable, Dict, Optional
+
+from caul_proxy import metrics, reload, util
+from caul_proxy.config import settings, logger
+
+# worker进程中为True: 监听端口设置SO_REUSEPORT, 由内核在各worker间分配连接
+REUSE_PORT = False
+# worker启动后运行不足该时间(秒)即退出, 视为崩溃, 按指数退避重启
+MIN_UPTIME = 5
+MAX_BACKOFF = 30
+
+
+def reuse_port(sock: socket.socket):
+    """
+    worker进程中设置SO_REUSEPORT, 需在bind之前调用
+    :param sock:
+    :return:
+    """
+    if REUSE_PORT:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+
+def bind(server: socketserver.TCPServer):
+    """
+    绑定并监听, server需以bind_and_activate=False创建
+    :param server:
+    :return:
+    """
+    reuse_port(server.socket)
+    try:
+        server.server_bind()
+        server.server_activate()
+    except Exception:
+        server.server_close()
+        raise
+
+
+def listen(ip: str, port: int, backlog: int = 2048) -> socket.socket:
+    """
+    创建监听socket, 供自行绑定端口的引擎(uvicorn)使用
+    :param ip:
+    :param port:
+    :param backlog:
+    :return:
+    """
+    sock = socket.socket(socket.AF_INET6 if ':' in ip else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    reuse_port(sock)
+    sock.bind((ip, port))
+    sock.listen(backlog)
+    return sock
+
+
+class LogHandler(SocketHandler):
+    """worker进程的日志发给supervisor, 由其handler统一输出(避免多进程写同一个日志文件)"""
+
+    def __init__(self, sock: socket.socket, name: str):
+        super().__init__(None, None)
+        self.sock = sock
+        self.worker = name
+
+    def makeSocket(self, timeout=1):
+        return self.sock
+
+    def emit(self, record: logging.LogRecord):
+        record.name = self.worker
+        super().emit(record)
+
+
+class Worker:
+    """supervisor中的worker记录"""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.name = f'worker{index}'
+        self.pid = 0
+        self.started = 0.0
+        self.failures = 0
+        # 下次允许启动的时间
+        self.next_start = 0.0
+        self.channel: Optional[socket.socket] = None
+        self.logs: Optional[socket.socket] = None
+        self._lock = threading.Lock()
+
+    def dump(self, timeout: float = 2) -> Optional[list]:
+        """
+        请求worker的指标
+        :param timeout:
+        :return: 失败时返回None
+        """
+        with self._lock:
+            channel = self.channel
+            if channel is None:
+                return None
+            try:
+                channel.settimeout(timeout)
+                channel.sendall(b'?')
+                size, = struct.unpack('>L', recv_exactly(channel, 4))
+                return json.loads(recv_exactly(channel, size))
+            except (OSError, ValueError) as e:
+                logger.warning(f'Metrics From {self.name}(pid={self.pid}): {util.err_msg(e)}')
+                return None
+
+
+def recv_exactly(sock: socket.socket, size: int) -> bytes:
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('Channel Closed')
+        data.extend(chunk)
+    return bytes(data)
+
+
+class Supervisor:
+    """
+    预先fork多个worker进程, 各自以SO_REUSEPORT监听同一端口
+    配置/ACL/插件在fork前加载一次, worker继承后直接启动服务
+    supervisor负责: 重启退出的worker, 汇总指标(管理端口), 汇总日志, 配置文件变化时通知worker重新加载
+    """
+
+    def __init__(self, count: int, target: Callable[[], None], config: str, interval: float = 2):
+        self.workers = [Worker(i) for i in range(count)]
+        self.target = target
+        self.config = config
+        self.interval = interval
+        self.stopping = False
+        self.reload_requested = False
+        self.restarts = 0
+        self.admin = None
+        self.registry = metrics.Registry()
+        metrics.GaugeFunc('caul_workers', 'Live worker processes',
+                          lambda: sum(1 for worker in self.workers if worker.pid), registry=self.registry)
+        metrics.GaugeFunc('caul_worker_restarts', 'Worker processes restarted after exit',
+                          lambda: self.restarts, registry=self.registry)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        for worker in self.workers:
+            self.spawn(worker)
+        self.admin = metrics.serve(settings.admin, self.expose)
+        logger.info(f'Supervisor(pid={os.getpid()}): {len(self.workers)} workers')
+        signature = reload.file_signature(self.config)
+        checked = time.monotonic()
+        while not self.stopping:
+            self.reap()
+            now = time.monotonic()
+            for worker in self.workers:
+                if not worker.pid and now >= worker.next_start and not self.stopping:
+                    self.restarts += 1
+                    self.spawn(worker)
+            # 配置文件变化或SIGHUP: 通知各worker重新加载
+            if self.interval and now - checked >= self.interval:
+                checked = now
+                current = reload.file_signature(self.config)
+                if current is not None and current != signature:
+                    signature = current
+                    self.reload_requested = True
+            if self.reload_requested:
+                self.reload_requested = False
+                self.broadcast(signal.SIGHUP)
+            time.sleep(0.2)
+        self.shutdown()
+
+    def spawn(self, worker: Worker):
+        """
+        fork一个worker
+        :param worker:
+        :return:
+        """
+        channel, child_channel = socket.socketpair()
+        log_reader, log_writer = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            channel.close()
+            log_reader.close()
+            self._close_inherited()
+            self._run_worker(worker, child_channel, log_writer)
+            return
+        child_channel.close()
+        log_writer.close()
+        worker.pid = pid
+        worker.started = time.monotonic()
+        worker.channel = channel
+        worker.logs = log_reader
+        threading.Thread(target=read_logs, args=(log_reader,), name=f'Logs-{worker.name}', daemon=True).start()
+        logger.info(f'Start {worker.name}(pid={pid})')
+
+    def _close_inherited(self):
+        """
+        worker进程关闭继承的supervisor端socket, 否则supervisor退出时其他worker收不到EOF
+        :return:
+        """
+        if self.admin is not None:
+            self.admin.socket.close()
+        for other in self.workers:
+            for sock in (other.channel, other.logs):
+                if sock is not None:
+                    sock.close()
+
+    def _run_worker(self, worker: Worker, channel: socket.socket, log_writer: socket.socket):
+        global REUSE_PORT
+        code = 0
+        try:
+            for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+                signal.signal(signum, signal.SIG_DFL)
+            REUSE_PORT = True
+            handler = LogHandler(log_writer, worker.name)
+            for h in list(logger.handlers):
+                logger.removeHandler(h)
+            logger.addHandler(handler)
+            threading.Thread(target=serve_metrics, args=(channel,), name='MetricsChannel', daemon=True).start()
+            # 只响应supervisor转发的SIGHUP
+            reload.start(self.config, 0)
+            self.target()
+        except BaseException as e:
+            if not isinstance(e, (KeyboardInterrupt, SystemExit)):
+                code = 1
+                logger.error(f'{worker.name} Failed: {util.err_msg(e)}\n{traceback.format_exc()}')
+        finally:
+            logging.shutdown()
+            os._exit(code)
+
+    def reap(self):
+        """
+        回收退出的worker, 计算重启时间
+        :return:
+        """
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            for worker in self.workers:
+                if worker.pid != pid:
+                    continue
+                worker.pid = 0
+                with worker._lock:
+                    worker.channel.close()
+                    worker.channel = None
+                uptime = time.monotonic() - worker.started
+                # 频繁退出时退避, 避免fork风暴
+                worker.failures = worker.failures + 1 if uptime < MIN_UPTIME else 0
+                delay = min(2 ** worker.failures - 1, MAX_BACKOFF)
+                worker.next_start = time.monotonic() + delay
+                if not self.stopping:
+                    logger.warning(f'{worker.name}(pid={pid}) Exited: {describe(status)}, '
+                                   f'Restart In {delay}s')
+
+    def broadcast(self, signum: int):
+        for worker in self.workers:
+            if worker.pid:
+                try:
+                    os.kill(worker.pid, signum)
+                except ProcessLookupError:
+                    pass
+
+    def shutdown(self, timeout: float = 10):
+        """
+        停止所有worker, 超时后强制结束
+        :param timeout:
+        :return:
+        """
+        logger.info('Stop Workers')
+        self.broadcast(signal.SIGTERM)
+        deadline = time.monotonic() + timeout
+        while any(worker.pid for worker in self.workers) and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        self.broadcast(signal.SIGKILL)
+        self.reap()
+
+    def expose(self) -> str:
+        """
+        管理端口: 汇总各worker的指标
+        :return:
+        """
+        dumps: Dict[str, list] = {}
+        for worker in self.workers:
+            dump = worker.dump()
+            if dump is not None:
+                dumps[str(worker.index)] = dump
+        return metrics.REGISTRY.expose(metrics.REGISTRY.aggregate(dumps), per_worker=True) + self.registry.expose()
+
+    def _on_stop(self, signum, frame):
+        self.stopping = True
+
+    def _on_reload(self, signum, frame):
+        self.reload_requested = True
+
+
+def serve_metrics(channel: socket.socket):
+    """
+    worker进程: 响应supervisor的指标请求, supervisor退出时结束本进程
+    :param channel:
+    :return:
+    """
+    while True:
+        try:
+            request = channel.recv(1)
+        except OSError:
+            request = b''
+        if not request:
+            os.kill(os.getpid(), signal.SIGTERM)
+            return
+        data = json.dumps(metrics.REGISTRY.dump()).encode('utf-8')
+        try:
+            channel.sendall(struct.pack('>L', len(data)) + data)
+        except OSError:
+            pass
+
+
+def read_logs(sock: socket.socket):
+    """
+    supervisor进程: 读取worker的日志记录(SocketHandler格式)并输出
+    :param sock:
+    :return:
+    """
+    with sock:
+        while True:
+            try:
+                size, = struct.unpack('>L', recv_exactly(sock, 4))
+                record = logging.makeLogRecord(pickle.loads(recv_exactly(sock, size)))
+            except (OSError, pickle.UnpicklingError):
+                return
+            logger.handle(record)
+
+
+def describe(status: int) -> str:
+    if os.WIFSIGNALED(status):
+        return f'signal {os.WTERMSIG(status)}'
+    return f'code {os.WEXITSTATUS(status)}'
+
+
+def start(count: int, target: Callable[[], None], config: str, interval: float = 2):
+    """
+    启动supervisor(阻塞), 需要在主线程调用
+    :param count: worker数量
+    :param target: worker进程中启动服务
+    :param config: 配置文件, 变化时通知worker重新加载
+    :param interval:
+    :return:
+    """
+    if not hasattr(os, 'fork') or not hasattr(socket, 'SO_REUSEPORT'):
+        raise RuntimeError('Workers Require fork and SO_REUSEPORT')
+    Supervisor(count, target, config, interval).run()
@@ -1,10 +1,13 @@
+import enum
+import importlib
 import os
 import sys
 
 import typer
 
-from caul_proxy import server_requests
+from caul_proxy import acl, ratelimit, reload, metrics, workers, shaping
 from caul_proxy.config import settings
+from caul_proxy.resolver import dns
 from caul_proxy.plugins import runner
 
 # Remove '' and current working directory from the first entry
@@ -25,18 +28,47 @@ if __package__ == "":
     sys.path.insert(0, path)
 
 
+class Engine(str, enum.Enum):
+    requests = "requests"
+    socket = "socket"
+    socks5 = "socks5"
+    socks5_async = "socks5_async"
+    uvicorn = "uvicorn"
+    h2 = "h2"
+
+
 def main(
         host: str = typer.Option("0.0.0.0"),
         port: int = typer.Option(5008),
         timeout: int = typer.Option(60),
         config: str = typer.Option("config.yaml"),
+        engine: Engine = typer.Option(Engine.requests),
+        workers_num: int = typer.Option(1, "--workers", help="worker进程数, 大于1时预先fork并以SO_REUSEPORT监听同一端口"),
 ):
     # 加载配置文件
     settings.load_yaml(config)
+    # 编译ACL
+    acl.load(settings)
+    # 限流
+    ratelimit.load(settings)
+    # DNS缓存
+    dns.configure(settings.dns)
+    # 隧道带宽整形
+    shaping.shaper.configure(settings.shaping)
     # 加载插件
     runner.load_plugins(settings)
+    server = importlib.import_module(f'caul_proxy.server_{engine.value}')
+    if workers_num > 1:
+        # 多进程: supervisor负责热加载通知/管理端口, worker继承已加载的配置
+        workers.start(workers_num, lambda: server.start_server(ip=host, port=port, timeout=timeout),
+                      config, settings.reload_interval)
+        return
+    # 配置热加载
+    reload.start(config, settings.reload_interval)
+    # 管理端口
+    metrics.serve(settings.admin)
     # 启动服务
-    server_requests.start_server(ip=host, port=port, timeout=timeout)
+    server.start_server(ip=host, port=port, timeout=timeout)
 
 
 if __name__ == '__main__':